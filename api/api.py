@@ -1,12 +1,18 @@
 # encoding: utf-8
 
 import os
+import sys
+import json
+import uuid
+import base64
+import hashlib
 import logging
-import yaml
 import sqlite3
-import datetime
+import time
+import threading
+from urllib.parse import urlencode, urlsplit
 from flask import Flask
-from flask import jsonify, request, redirect, send_from_directory, Response
+from flask import jsonify, request, redirect, send_from_directory, Response, stream_with_context
 
 log = logging.getLogger('werkzeug')
 log.disabled = True
@@ -14,13 +20,37 @@ log.disabled = True
 try:
     from db import conn
     from config import auth_manager
+    from config import API_POOL_INDEX, API_POOL_REFRESH_INTERVAL, API_POOL_MAX_STALENESS, API_POOL_FULL_RESYNC_INTERVAL
+    from config import API_PICK_STRATEGY, API_SERVER, API_WORKERS, API_THREADS
+    from config import SUBSCRIPTION_CACHE_SIZE, SUBSCRIPTION_CACHE_MIN_TTL
+    from config import CLASH_PROXY_PROVIDER, CLASH_PROVIDER_INTERVAL
+    from config import FEEDBACK_FLUSH_INTERVAL, FEEDBACK_FAIL_THRESHOLD, FEEDBACK_FAIL_RATIO, FEEDBACK_WINDOW, FEEDBACK_MAX_BATCH
+    from config import LEASE_DEFAULT_TTL, LEASE_MAX_TTL, LEASE_MAX_COUNT
     from auth.auth_manager import token_required
+    from api.pool_index import ProxyPoolIndex, STRATEGIES
+    from api.render_cache import RenderCache, RenderedEntry
+    from api.feedback import FeedbackAggregator
+    from api.lease import LeaseManager
+    from api import clash_yaml
+    from utils.country import to_code, parse_codes, flag
 except:
     import sys
     sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
     from db import conn
     from config import auth_manager
+    from config import API_POOL_INDEX, API_POOL_REFRESH_INTERVAL, API_POOL_MAX_STALENESS, API_POOL_FULL_RESYNC_INTERVAL
+    from config import API_PICK_STRATEGY, API_SERVER, API_WORKERS, API_THREADS
+    from config import SUBSCRIPTION_CACHE_SIZE, SUBSCRIPTION_CACHE_MIN_TTL
+    from config import CLASH_PROXY_PROVIDER, CLASH_PROVIDER_INTERVAL
+    from config import FEEDBACK_FLUSH_INTERVAL, FEEDBACK_FAIL_THRESHOLD, FEEDBACK_FAIL_RATIO, FEEDBACK_WINDOW, FEEDBACK_MAX_BATCH
+    from config import LEASE_DEFAULT_TTL, LEASE_MAX_TTL, LEASE_MAX_COUNT
     from auth.auth_manager import token_required
+    from api.pool_index import ProxyPoolIndex, STRATEGIES
+    from api.render_cache import RenderCache, RenderedEntry
+    from api.feedback import FeedbackAggregator
+    from api.lease import LeaseManager
+    from api import clash_yaml
+    from utils.country import to_code, parse_codes, flag
 
 STATIC_FOLDER = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'frontend', 'deployment', 'public')
 
@@ -30,6 +60,75 @@ app = Flask(
     static_folder=STATIC_FOLDER
 )
 
+# 可用代理索引，第一次使用时创建
+_pool_index = None
+_pool_index_lock = threading.Lock()
+
+def _get_pool_index():
+    """
+    获取可用代理索引，没有启用（API_POOL_INDEX）时返回None
+    """
+    global _pool_index
+    if not API_POOL_INDEX:
+        return None
+    if _pool_index is None:
+        with _pool_index_lock:
+            if _pool_index is None:
+                _pool_index = ProxyPoolIndex(API_POOL_MAX_STALENESS, API_POOL_REFRESH_INTERVAL, API_POOL_FULL_RESYNC_INTERVAL).start()
+    return _pool_index
+
+def _pick_proxy(protocol=None):
+    """
+    随机获取一个可用代理，请求中可以带有country参数（国家代码或名称），按国家筛选，
+    以及c、nc、max_latency、max_age参数（见_filter_params）
+    strategy参数指定选择策略（见pool_index.STRATEGIES），默认为API_PICK_STRATEGY，
+    只在使用可用代理索引时生效，查询数据库时总是均匀随机
+    protocol : 协议，None表示不限
+    返回 : Proxy，没有可用代理时返回None
+    """
+    country = request.args.get('country') or None
+    strategy = request.args.get('strategy')
+    if strategy not in STRATEGIES:
+        strategy = API_PICK_STRATEGY
+    filters = _filter_params()
+    if country is not None:
+        country = to_code(country) or country.strip().upper()
+        filters['countries'] = (country,)
+    index = _get_pool_index()
+    if index is not None and not any(filters[k] is not None for k in ('exclude_countries', 'max_latency', 'max_age')) \
+            and (filters['countries'] is None or len(filters['countries']) == 1):
+        return index.pick(protocol, filters['countries'][0] if filters['countries'] else None, strategy)
+    # 没有启用索引或者索引不支持的筛选条件时查询数据库
+    proxies = conn.queryValidated((protocol,) if protocol is not None else None, limit=1, **filters)
+    return proxies[0] if len(proxies) > 0 else None
+
+def _stream_proxy_list(protocol=None):
+    """
+    流式返回全部可用代理，按验证时间从新到旧，从数据库分批读取，不会一次性把所有代理读入内存
+    请求参数：
+        format : 默认用逗号分隔，为nl时每行一个代理
+        limit : 最多返回多少个，默认不限
+        offset : 跳过前多少个，默认为0
+        c、nc、max_latency、max_age : 筛选条件，见_filter_params
+    protocol : 协议，None表示不限
+    """
+    newline = request.args.get('format') == 'nl'
+    limit = request.args.get('limit', -1, type=int)
+    offset = request.args.get('offset', 0, type=int)
+    filters = _filter_params()
+
+    def generate():
+        first = True
+        for chunk in conn.iterValidated(protocol, limit=limit, offset=offset, **filters):
+            lines = [f'{p}://{ip}:{port}' for p, ip, port in chunk]
+            if newline:
+                yield '\n'.join(lines) + '\n'
+            else:
+                yield ('' if first else ',') + ','.join(lines)
+            first = False
+
+    return Response(stream_with_context(generate()), mimetype='text/plain')
+
 ############# 认证相关接口 ################
 
 # 登录接口 - 优化版本，提供优先级处理
@@ -134,14 +233,8 @@ def auth_status():
         db_response_time = 0
         
         try:
-            db_start = time.time()
             # 简单的数据库查询测试
-            from db import conn
-            cursor = conn.cursor()
-            cursor.execute('SELECT 1')
-            cursor.fetchone()
-            cursor.close()
-            db_response_time = time.time() - db_start
+            db_response_time = conn.ping()
         except Exception as e:
             db_status = f"异常: {str(e)}"
             db_response_time = -1
@@ -149,17 +242,9 @@ def auth_status():
         # 检查代理爬取和验证进程状态
         proxy_status = conn.getProxiesStatus()
         
-        # 检查当前数据库锁状态
-        lock_status = "未知"
-        try:
-            # 尝试获取锁，如果立即成功说明没有锁竞争
-            if conn_lock.acquire(blocking=False):
-                conn_lock.release()
-                lock_status = "无锁竞争"
-            else:
-                lock_status = "存在锁竞争"
-        except:
-            lock_status = "无法检测"
+        # 本进程等待数据库锁的统计信息，可以对比启用只读连接池（DB_READ_POOL_SIZE）前后的差别
+        lock_wait = conn.getLockWaitStats(reset=request.args.get('reset') == '1')
+        lock_status = "存在锁竞争" if any(item['max_ms'] > 100 for item in lock_wait.values()) else "无锁竞争"
         
         total_time = time.time() - start_time
         
@@ -173,6 +258,7 @@ def auth_status():
                     'response_time': round(db_response_time, 3)
                 },
                 'lock_status': lock_status,
+                'lock_wait': lock_wait,
                 'proxy_status': proxy_status,
                 'recommendations': _get_performance_recommendations(proxy_status, db_response_time)
             }
@@ -291,9 +377,8 @@ def ping():
 @app.route('/fetch_random', methods=['GET'])
 @token_required
 def fetch_random():
-    proxies = conn.getValidatedRandom(1)
-    if len(proxies) > 0:
-        p = proxies[0]
+    p = _pick_proxy()
+    if p is not None:
         return f'{p.protocol}://{p.ip}:{p.port}'
     else:
         return ''
@@ -304,9 +389,8 @@ def fetch_random():
 @app.route('/fetch_http', methods=['GET'])
 @token_required
 def fetch_http():
-    proxies =conn.get_by_protocol('http', 1)
-    if len(proxies) > 0:
-        p = proxies[0]
+    p = _pick_proxy('http')
+    if p is not None:
         return f'{p.protocol}://{p.ip}:{p.port}'
     else:
         return ''
@@ -315,25 +399,14 @@ def fetch_http():
 @app.route('/fetch_http_all', methods=['GET'])
 @token_required
 def fetch_http_all():
-    proxies = conn.get_by_protocol('http', -1)
-    if len(proxies) == 1:
-        p = proxies[0]
-        return f'{p.protocol}://{p.ip}:{p.port}'
-    elif len(proxies) > 1:
-        proxy_list = []
-        for p in proxies:
-            proxy_list.append(f'{p.protocol}://{p.ip}:{p.port}')
-        return ','.join(proxy_list)
-    else:
-        return ''
+    return _stream_proxy_list('http')
         
 #api 获取协议为https的一条结果
 @app.route('/fetch_https', methods=['GET'])
 @token_required
 def fetch_https():
-    proxies =conn.get_by_protocol('https', 1)
-    if len(proxies) > 0:
-        p = proxies[0]
+    p = _pick_proxy('https')
+    if p is not None:
         return f'{p.protocol}://{p.ip}:{p.port}'
     else:
         return ''
@@ -342,25 +415,14 @@ def fetch_https():
 @app.route('/fetch_https_all', methods=['GET'])
 @token_required
 def fetch_https_all():
-    proxies = conn.get_by_protocol('https', -1)
-    if len(proxies) == 1:
-        p = proxies[0]
-        return f'{p.protocol}://{p.ip}:{p.port}'
-    elif len(proxies) > 1:
-        proxy_list = []
-        for p in proxies:
-            proxy_list.append(f'{p.protocol}://{p.ip}:{p.port}')
-        return ','.join(proxy_list)
-    else:
-        return ''
+    return _stream_proxy_list('https')
                 
 #api 获取协议为socks4的一条结果
 @app.route('/fetch_socks4', methods=['GET'])
 @token_required
 def fetch_socks4():
-    proxies =conn.get_by_protocol('socks4', 1)
-    if len(proxies) > 0:
-        p = proxies[0]
+    p = _pick_proxy('socks4')
+    if p is not None:
         return f'{p.protocol}://{p.ip}:{p.port}'
     else:
         return ''
@@ -369,25 +431,14 @@ def fetch_socks4():
 @app.route('/fetch_socks4_all', methods=['GET'])
 @token_required
 def fetch_socks4_all():
-    proxies = conn.get_by_protocol('socks4', -1)
-    if len(proxies) == 1:
-        p = proxies[0]
-        return f'{p.protocol}://{p.ip}:{p.port}'
-    elif len(proxies) > 1:
-        proxy_list = []
-        for p in proxies:
-            proxy_list.append(f'{p.protocol}://{p.ip}:{p.port}')
-        return ','.join(proxy_list)
-    else:
-        return ''
+    return _stream_proxy_list('socks4')
         
 #api 获取协议为socks5的一条结果
 @app.route('/fetch_socks5', methods=['GET'])
 @token_required
 def fetch_socks5():
-    proxies =conn.get_by_protocol('socks5', 1)
-    if len(proxies) > 0:
-        p = proxies[0]
+    p = _pick_proxy('socks5')
+    if p is not None:
         return f'{p.protocol}://{p.ip}:{p.port}'
     else:
         return ''
@@ -396,17 +447,7 @@ def fetch_socks5():
 @app.route('/fetch_socks5_all', methods=['GET'])
 @token_required
 def fetch_socks5_all():
-    proxies = conn.get_by_protocol('socks5', -1)
-    if len(proxies) == 1:
-        p = proxies[0]
-        return f'{p.protocol}://{p.ip}:{p.port}'
-    elif len(proxies) > 1:
-        proxy_list = []
-        for p in proxies:
-            proxy_list.append(f'{p.protocol}://{p.ip}:{p.port}')
-        return ','.join(proxy_list)
-    else:
-        return ''
+    return _stream_proxy_list('socks5')
                         
 ############# 新增加接口end ################    
 
@@ -414,12 +455,372 @@ def fetch_socks5_all():
 @app.route('/fetch_all', methods=['GET'])
 @token_required
 def fetch_all():
-    proxies = conn.getValidatedRandom(-1)
-    proxies = [f'{p.protocol}://{p.ip}:{p.port}' for p in proxies]
-    return ','.join(proxies)
+    return _stream_proxy_list()
+
+############# 客户端反馈 ################
+
+# 客户端反馈的汇总，第一次使用时创建
+_feedback = None
+_feedback_lock = threading.Lock()
+
+def _get_feedback():
+    global _feedback
+    if _feedback is None:
+        with _feedback_lock:
+            if _feedback is None:
+                index = _get_pool_index()
+                _feedback = FeedbackAggregator(
+                    FEEDBACK_FLUSH_INTERVAL, FEEDBACK_FAIL_THRESHOLD, FEEDBACK_FAIL_RATIO, FEEDBACK_WINDOW,
+                    on_failed=(lambda key: index.discard(*key)) if index is not None else None
+                ).start()
+    return _feedback
+
+def _parse_report(item):
+    """
+    解析一条反馈
+    item : {"proxy": "http://1.2.3.4:8080", "success": true, "latency": 350}，proxy的格式与/fetch_random返回的相同
+    返回 : (protocol, ip, port, success, latency)，格式不正确时返回None
+    """
+    if not isinstance(item, dict) or not isinstance(item.get('proxy'), str) or not isinstance(item.get('success'), bool):
+        return None
+    try:
+        url = urlsplit(item['proxy'].strip())
+        port = url.port
+    except ValueError:
+        return None
+    if url.scheme not in ('http', 'https', 'socks4', 'socks5') or not url.hostname or port is None:
+        return None
+    latency = item.get('latency')
+    if latency is not None and (isinstance(latency, bool) or not isinstance(latency, (int, float)) or latency < 0):
+        return None
+    return (url.scheme, url.hostname, port, item['success'], int(latency) if latency is not None else None)
+
+# 上报使用代理的结果
+# 请求体: {"reports": [{"proxy": "http://1.2.3.4:8080", "success": false, "latency": 350}, ...]}，latency单位毫秒，可以省略
+# 一个代理在短时间内多次失败时会被标记为不可用并立即重新验证，详见api/feedback.py
+@app.route('/report', methods=['POST'])
+@token_required
+def report():
+    data = request.get_json(silent=True)
+    items = data.get('reports') if isinstance(data, dict) else None
+    if not isinstance(items, list):
+        return jsonify(dict(success=False, message='请求体格式错误，需要reports列表')), 400
+    if len(items) > FEEDBACK_MAX_BATCH:
+        return jsonify(dict(success=False, message=f'一次最多上报{FEEDBACK_MAX_BATCH}条反馈')), 400
+    reports = [_parse_report(item) for item in items]
+    accepted = [r for r in reports if r is not None]
+    if accepted:
+        _get_feedback().add(accepted)
+    return jsonify(dict(success=True, accepted=len(accepted), rejected=len(reports) - len(accepted)))
+
+############# 代理租约 ################
+
+# 代理租约，第一次使用时创建，需要启用可用代理索引
+_lease_manager = None
+_lease_manager_lock = threading.Lock()
+
+def _get_lease_manager():
+    global _lease_manager
+    if _lease_manager is None:
+        with _lease_manager_lock:
+            if _lease_manager is None:
+                index = _get_pool_index()
+                if index is None:
+                    return None
+                _lease_manager = LeaseManager(index, LEASE_DEFAULT_TTL, LEASE_MAX_TTL)
+    return _lease_manager
+
+def _lease_request():
+    """
+    读取租约接口的请求体
+    返回 : (LeaseManager, dict)，出错时返回(None, 错误响应)
+    """
+    manager = _get_lease_manager()
+    if manager is None:
+        return None, (jsonify(dict(success=False, message='没有启用可用代理索引（API_POOL_INDEX）')), 400)
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        data = {}
+    ttl = data.get('ttl')
+    if ttl is not None and (isinstance(ttl, bool) or not isinstance(ttl, (int, float))):
+        return None, (jsonify(dict(success=False, message='ttl必须是数字')), 400)
+    if not isinstance(data.get('lease_id', ''), str):
+        return None, (jsonify(dict(success=False, message='lease_id必须是字符串')), 400)
+    return manager, data
+
+# 获取若干个代理的租约，租约有效期内这些代理不会分配给其他调用方
+# 请求体: {"count": 5, "ttl": 300, "protocol": "http", "country": "US", "strategy": "weighted"}，都可以省略
+@app.route('/lease/checkout', methods=['POST'])
+@token_required
+def lease_checkout():
+    manager, data = _lease_request()
+    if manager is None:
+        return data
+    count = data.get('count', 1)
+    if isinstance(count, bool) or not isinstance(count, int) or not 0 < count <= LEASE_MAX_COUNT:
+        return jsonify(dict(success=False, message=f'count必须是1到{LEASE_MAX_COUNT}之间的整数')), 400
+    protocol = data.get('protocol') or None
+    if protocol not in (None, 'http', 'https', 'socks4', 'socks5'):
+        return jsonify(dict(success=False, message='不支持的协议')), 400
+    country = data.get('country') or None
+    if country is not None:
+        country = to_code(str(country)) or str(country).strip().upper()
+    strategy = data.get('strategy')
+    if strategy not in STRATEGIES:
+        strategy = API_PICK_STRATEGY
+    leases = manager.checkout(count, data.get('ttl'), protocol, country, strategy)
+    return jsonify(dict(success=True, leases=[lease.to_dict() for lease in leases]))
+
+# 延长租约，请求体: {"lease_id": "...", "ttl": 300}
+@app.route('/lease/renew', methods=['POST'])
+@token_required
+def lease_renew():
+    manager, data = _lease_request()
+    if manager is None:
+        return data
+    lease = manager.renew(data.get('lease_id'), data.get('ttl'))
+    if lease is None:
+        return jsonify(dict(success=False, message='租约不存在或者已经到期')), 404
+    return jsonify(dict(success=True, lease=lease.to_dict()))
+
+# 归还租约，请求体: {"lease_id": "...", "success": false, "latency": 350}
+# success可以省略，带有success时同时作为一条客户端反馈（见/report）
+@app.route('/lease/release', methods=['POST'])
+@token_required
+def lease_release():
+    manager, data = _lease_request()
+    if manager is None:
+        return data
+    lease = manager.release(data.get('lease_id'))
+    if lease is None:
+        return jsonify(dict(success=False, message='租约不存在或者已经到期')), 404
+    if isinstance(data.get('success'), bool):
+        feedback = _parse_report(dict(data, proxy=lease.to_dict()['proxy']))
+        if feedback is not None:
+            _get_feedback().add([feedback])
+    return jsonify(dict(success=True))
+
+############# 订阅接口公用 ################
+
+# 订阅内容的渲染缓存，SUBSCRIPTION_CACHE_SIZE为0时不缓存
+_render_cache = RenderCache(SUBSCRIPTION_CACHE_SIZE, SUBSCRIPTION_CACHE_MIN_TTL) if SUBSCRIPTION_CACHE_SIZE > 0 else None
+# 使用max_latency/max_age筛选的订阅，缓存最多使用多久，单位s
+_FILTER_VERSION_PERIOD = 60
+
+def _subscription_auth(name):
+    """
+    订阅接口使用URL参数中的username和password认证
+    name : 订阅的名称，用于错误信息
+    返回 : 认证失败时返回错误响应，成功时返回None
+    """
+    username = request.args.get('username')
+    password = request.args.get('password')
+
+    if not username or not password:
+        return jsonify({
+            'success': False,
+            'message': f'{name} 订阅需要认证，请提供 username 和 password 参数'
+        }), 401
+
+    # 验证账号密码
+    user = auth_manager.authenticate(username, password)
+    if not user:
+        return jsonify({
+            'success': False,
+            'message': '用户名或密码错误'
+        }), 401
+    return None
+
+# Clash 支持的代理协议
+_CLASH_PROTOCOLS = ('http', 'https', 'socks5')
+
+def _filter_params():
+    """
+    读取获取代理和订阅接口共用的筛选参数：
+        c : 只返回这些国家的代理，多个国家用逗号分隔，可以是国家代码或者名称（如: c=US,JP）
+        nc : 排除这些国家的代理
+        max_latency : 最大延迟，单位毫秒
+        max_age : 最近一次验证距今最多多久，单位s
+    返回 : dict，可以直接作为conn.queryValidated、conn.iterValidated的参数
+    """
+    return dict(
+        countries=parse_codes(request.args.get('c')),
+        exclude_countries=parse_codes(request.args.get('nc')),
+        max_latency=request.args.get('max_latency', None, type=int),
+        max_age=request.args.get('max_age', None, type=int)
+    )
+
+def _subscription_params(supported_protocols=None):
+    """
+    读取订阅接口的筛选参数，结果同时作为渲染缓存的键
+    supported_protocols : 订阅格式支持的协议，没有指定protocol参数时只查询这些协议，
+                          避免limit把名额用在不支持的代理上
+    返回 : (协议, 国家代码, 排除的国家代码, 最大延迟, 最大验证间隔, 数量限制)，列表为tuple或者None
+    """
+    protocol = request.args.get('protocol', None)
+    protocols = tuple(x.strip() for x in protocol.split(',') if x.strip()) if protocol else None
+    filters = _filter_params()
+    return (
+        protocols or supported_protocols,
+        filters['countries'], filters['exclude_countries'], filters['max_latency'], filters['max_age'],
+        request.args.get('limit', -1, type=int)
+    )
+
+def _load_subscription_proxies(params):
+    """
+    从数据库获取符合条件的代理，筛选和数量限制都在查询中完成
+    params : _subscription_params的返回值
+    返回 : list[Proxy]
+    """
+    protocols, countries, exclude_countries, max_latency, max_age, limit = params
+    return conn.queryValidated(protocols, countries, exclude_countries, max_latency, max_age, limit)
+
+def _cached_subscription(endpoint, params, render, version=None):
+    """
+    返回订阅内容，内容没有变化时使用缓存，并支持If-None-Match/If-Modified-Since
+    endpoint : 接口名称
+    params : _subscription_params的返回值
+    render : 函数，render(params)返回 (内容, mimetype)
+    version : 内容的版本，默认使用代理池的版本；内容与代理池无关时传入固定的值
+    """
+    if version is None:
+        version = conn.getPoolVersion()
+        # 代理池版本号不随延迟和验证时间变化，使用max_latency/max_age筛选时结果会随时间变化，
+        # 按时间分段加入版本号，最多每_FILTER_VERSION_PERIOD秒（或者max_age秒）重新渲染一次
+        max_latency, max_age = params[3], params[4]
+        if max_latency is not None or max_age is not None:
+            period = min(max_age, _FILTER_VERSION_PERIOD) if max_age is not None else _FILTER_VERSION_PERIOD
+            version = (version, int(time.time() // max(period, 1)))
+    if _render_cache is not None:
+        entry = _render_cache.get((endpoint,) + params, version, lambda: render(params))
+    else:
+        entry = RenderedEntry(*render(params), version)
+    resp = Response(entry.body, mimetype=entry.mimetype)
+    resp.set_etag(entry.etag)
+    resp.last_modified = entry.last_modified
+    resp.cache_control.no_cache = True # 客户端每次都需要重新验证，内容没有变化时返回304
+    resp = resp.make_conditional(request)
+    if resp.status_code == 304 and _render_cache is not None:
+        _render_cache.stats['not_modified'] += 1
+    return resp
 
 ############# Clash 订阅接口 ################
 
+def _clash_proxy_name(p):
+    """
+    生成代理在Clash中的名称
+    """
+    if p.country and p.country.strip() and p.country.strip() != '未知':
+        # 有国家信息：显示国旗+国家+IP
+        return f'{flag(p.country_code)} {p.country.strip()}_{p.ip}'
+    # 没有国家信息：只显示IP+端口
+    return f'{p.ip}_{p.port}'
+
+def _clash_proxy_nodes(proxies):
+    """
+    将代理转换为 Clash 格式，跳过Clash不支持的协议
+    返回 : list[dict]
+    """
+    nodes = []
+    for p in proxies:
+        if p.protocol in ['http', 'https']:
+            node_type = 'http'
+        elif p.protocol == 'socks5':
+            node_type = 'socks5'
+        else:
+            continue
+        proxy_node = {
+            'name': _clash_proxy_name(p),
+            'type': node_type,
+            'server': p.ip,
+            'port': p.port
+        }
+        if p.username and p.password:
+            proxy_node['username'] = p.username
+            proxy_node['password'] = p.password
+        nodes.append(proxy_node)
+    return nodes
+
+def _render_clash(params):
+    """
+    生成完整的 Clash 配置
+    返回 : (内容, mimetype)
+    """
+    proxies = _load_subscription_proxies(params)
+    if not proxies:
+        return '# 暂无可用代理\nproxies: []\n', 'text/yaml; charset=utf-8'
+
+    nodes = _clash_proxy_nodes(proxies)
+    if not nodes:
+        return '# 暂无支持的代理类型（需要 http/https/socks5）\nproxies: []\n', 'text/yaml; charset=utf-8'
+
+    # 构建完整的 Clash 配置并转换为 YAML 格式
+    yaml_content = clash_yaml.dump(clash_yaml.build_config(nodes))
+
+    # 添加注释头
+    header = f"""# ProxyPool Clash 订阅配置
+# 代理数量: {len(nodes)}
+# 项目地址: https://github.com/huppugo1/ProxyPoolWithUI
+
+"""
+    return header + yaml_content, 'text/yaml; charset=utf-8'
+
+def _render_clash_proxies(params):
+    """
+    生成 Clash 代理节点列表
+    返回 : (内容, mimetype)
+    """
+    proxies = _load_subscription_proxies(params)
+    if not proxies:
+        return '# 暂无可用代理\nproxies: []\n', 'text/yaml; charset=utf-8'
+
+    proxy_list = _clash_proxy_nodes(proxies)
+    if not proxy_list:
+        return '# 暂无支持的代理类型（需要 http/https/socks5）\nproxies: []\n', 'text/yaml; charset=utf-8'
+
+    # 转换为 YAML 格式
+    yaml_content = clash_yaml.dump({'proxies': proxy_list})
+
+    # 添加注释头
+    header = f"""# ProxyPool Clash 代理列表
+# 代理数量: {len(proxy_list)}
+
+"""
+    return header + yaml_content, 'text/yaml; charset=utf-8'
+
+def _clash_provider_mode():
+    """
+    /clash 是否使用 proxy-provider 模式，参数provider优先，没有时使用CLASH_PROXY_PROVIDER
+    """
+    provider = request.args.get('provider')
+    if provider is None:
+        return CLASH_PROXY_PROVIDER
+    return provider.lower() in ('1', 'true', 'yes')
+
+def _clash_provider_url():
+    """
+    proxy-provider 的节点列表地址：/clash/proxies 加上当前请求的参数（账号密码和筛选参数）
+    """
+    args = [(k, v) for k, v in request.args.items(multi=True) if k != 'provider']
+    return request.url_root + 'clash/proxies?' + urlencode(args)
+
+def _render_clash_provider(params):
+    """
+    生成使用 proxy-provider 的 Clash 配置，只与节点列表的地址有关，与代理池的内容无关
+    params : (节点列表的地址,)
+    返回 : (内容, mimetype)
+    """
+    url, = params
+    # 不同筛选参数的订阅保存为不同的文件，避免客户端中的多个订阅互相覆盖
+    path = f'./proxy_providers/proxypool_{hashlib.sha1(url.encode("utf-8")).hexdigest()[:8]}.yaml'
+    yaml_content = clash_yaml.dump(clash_yaml.build_provider_config(url, path, CLASH_PROVIDER_INTERVAL))
+
+    header = f"""# ProxyPool Clash 订阅配置（proxy-provider 模式，节点列表由客户端每{CLASH_PROVIDER_INTERVAL}秒从 /clash/proxies 更新）
+# 项目地址: https://github.com/huppugo1/ProxyPoolWithUI
+
+"""
+    return header + yaml_content, 'text/yaml; charset=utf-8'
+
 # Clash 订阅接口 - 完整配置
 @app.route('/clash', methods=['GET'])
 def clash_subscribe():
@@ -428,213 +829,25 @@ def clash_subscribe():
     支持参数：
     - username: 用户名（必填）
     - password: 密码（必填）
-    - c: 按国家筛选，多个国家用逗号分隔 (如: c=CN,US)
+    - c: 按国家筛选，多个国家用逗号分隔，可以是国家代码或名称 (如: c=CN,US)
     - nc: 排除指定国家 (如: nc=CN)
-    - protocol: 筛选协议类型（http/https/socks5）
-    - limit: 限制代理数量，默认返回全部
+    - protocol: 筛选协议类型（http/https/socks5），多个协议用逗号分隔
+    - max_latency: 最大延迟，单位毫秒
+    - max_age: 最近一次验证距今最多多久，单位秒
+    - limit: 限制代理数量，默认返回全部，在所有筛选条件之后生效
+    - provider: 是否使用 proxy-provider 模式（0/1），默认由 CLASH_PROXY_PROVIDER 决定
+      此时返回的配置不包含代理节点，代理组通过 use 引用从 /clash/proxies（相同的参数）下载的节点列表
+    代理池没有变化时返回缓存的内容，支持ETag
     """
     try:
-        # URL 参数认证
-        username = request.args.get('username')
-        password = request.args.get('password')
-        
-        if not username or not password:
-            return jsonify({
-                'success': False,
-                'message': 'Clash 订阅需要认证，请提供 username 和 password 参数'
-            }), 401
-        
-        # 验证账号密码
-        user = auth_manager.authenticate(username, password)
-        if not user:
-            return jsonify({
-                'success': False,
-                'message': '用户名或密码错误'
-            }), 401
-        
-        
-        # 获取查询参数
-        countries = request.args.get('c', '').upper().split(',') if request.args.get('c') else None
-        exclude_countries = request.args.get('nc', '').upper().split(',') if request.args.get('nc') else None
-        protocol = request.args.get('protocol', None)
-        limit = request.args.get('limit', -1, type=int)
-        
-        
-        # 从数据库获取代理
-        if protocol:
-            proxies = conn.get_by_protocol(protocol, limit)
-        else:
-            proxies = conn.getValidatedRandom(limit)
-        
-        # 按国家筛选
-        if countries and countries != ['']:
-            # 简单的国家代码映射
-            country_map = {
-                'CN': '中国', 'HK': '香港', 'TW': '台湾',
-                'US': '美国', 'CA': '加拿大',
-                'JP': '日本', 'SG': '新加坡',
-                'AU': '澳大利亚', 'RU': '俄罗斯',
-                'CH': '瑞士', 'DE': '德国', 'FR': '法国',
-                'GB': '英国', 'NL': '荷兰'
-            }
-            country_names = [country_map.get(c, c) for c in countries if c]
-            proxies = [p for p in proxies if p.country in country_names]
-        
-        # 排除指定国家
-        if exclude_countries and exclude_countries != ['']:
-            country_map = {
-                'CN': '中国', 'HK': '香港', 'TW': '台湾',
-                'US': '美国', 'CA': '加拿大',
-                'JP': '日本', 'SG': '新加坡',
-                'AU': '澳大利亚', 'RU': '俄罗斯',
-                'CH': '瑞士', 'DE': '德国', 'FR': '法国',
-                'GB': '英国', 'NL': '荷兰'
-            }
-            exclude_names = [country_map.get(c, c) for c in exclude_countries if c]
-            proxies = [p for p in proxies if p.country not in exclude_names]
-        
-        if not proxies:
-            return Response('# 暂无可用代理\nproxies: []\n', mimetype='text/yaml; charset=utf-8')
-        
-        # 构建完整的 Clash 配置
-        clash_config = {
-            'port': 7890,
-            'socks-port': 7891,
-            'allow-lan': False,
-            'mode': 'rule',
-            'log-level': 'info',
-            'external-controller': '127.0.0.1:9090',
-            'proxies': []
-        }
-        
-        # 将代理转换为 Clash 格式
-        proxy_names = []
-        
-        # 扩展的国家 emoji 映射表
-        country_emoji_map = {
-            '中国': '🇨🇳', '香港': '🇭🇰', '台湾': '🇹🇼',
-            '美国': '🇺🇸', '加拿大': '🇨🇦',
-            '日本': '🇯🇵', '新加坡': '🇸🇬',
-            '澳大利亚': '🇦🇺', '俄罗斯': '🇷🇺', '俄罗斯联邦': '🇷🇺',
-            '瑞士': '🇨🇭', '德国': '🇩🇪', '法国': '🇫🇷',
-            '英国': '🇬🇧', '荷兰': '🇳🇱',
-            '韩国': '🇰🇷', '印度': '🇮🇳', '泰国': '🇹🇭',
-            '越南': '🇻🇳', '菲律宾': '🇵🇭', '印尼': '🇮🇩', '印度尼西亚': '🇮🇩',
-            '马来西亚': '🇲🇾', '巴西': '🇧🇷', '阿根廷': '🇦🇷',
-            '墨西哥': '🇲🇽', '智利': '🇨🇱', '哥伦比亚': '🇨🇴',
-            '西班牙': '🇪🇸', '意大利': '🇮🇹', '波兰': '🇵🇱',
-            '土耳其': '🇹🇷', '以色列': '🇮🇱', '阿联酋': '🇦🇪',
-            '南非': '🇿🇦', '埃及': '🇪🇬', '尼日利亚': '🇳🇬',
-            '乌克兰': '🇺🇦', '罗马尼亚': '🇷🇴', '捷克': '🇨🇿',
-            '希腊': '🇬🇷', '葡萄牙': '🇵🇹', '瑞典': '🇸🇪',
-            '挪威': '🇳🇴', '丹麦': '🇩🇰', '芬兰': '🇫🇮',
-            '奥地利': '🇦🇹', '比利时': '🇧🇪', '爱尔兰': '🇮🇪',
-            '阿尔巴尼亚': '🇦🇱', '保加利亚': '🇧🇬', '塞尔维亚': '🇷🇸',
-            '克罗地亚': '🇭🇷', '匈牙利': '🇭🇺', '斯洛伐克': '🇸🇰',
-            '斯洛文尼亚': '🇸🇮', '立陶宛': '🇱🇹', '拉脱维亚': '🇱🇻',
-            '爱沙尼亚': '🇪🇪', '乌拉圭': '🇺🇾', '巴拉圭': '🇵🇾',
-            '新西兰': '🇳🇿', '巴基斯坦': '🇵🇰', '孟加拉国': '🇧🇩'
-        }
-        
-        for p in proxies:
-            # 生成代理名称
-            if p.country and p.country.strip() and p.country.strip() != '未知':
-                # 有国家信息：显示国旗+国家+IP
-                country_name = p.country.strip()
-                country_emoji = country_emoji_map.get(country_name, '🌍')
-                proxy_name = f'{country_emoji} {country_name}_{p.ip}'
-            else:
-                # 没有国家信息：只显示IP+端口
-                proxy_name = f'{p.ip}_{p.port}'
-            
-            if p.protocol in ['http', 'https']:
-                proxy_node = {
-                    'name': proxy_name,
-                    'type': 'http',
-                    'server': p.ip,
-                    'port': p.port
-                }
-                if p.username and p.password:
-                    proxy_node['username'] = p.username
-                    proxy_node['password'] = p.password
-                    
-            elif p.protocol == 'socks5':
-                proxy_node = {
-                    'name': proxy_name,
-                    'type': 'socks5',
-                    'server': p.ip,
-                    'port': p.port
-                }
-                if p.username and p.password:
-                    proxy_node['username'] = p.username
-                    proxy_node['password'] = p.password
-            else:
-                continue
-            
-            clash_config['proxies'].append(proxy_node)
-            proxy_names.append(proxy_name)
-        
-        if not clash_config['proxies']:
-            return Response('# 暂无支持的代理类型（需要 http/https/socks5）\nproxies: []\n', 
-                          mimetype='text/yaml; charset=utf-8')
-        
-        # 添加代理组
-        clash_config['proxy-groups'] = [
-            {
-                'name': '全局选择',
-                'type': 'select',
-                'proxies': ['延迟最低', '负载均衡', '失败切换'] + proxy_names[:50]  # 只显示前50个以避免太长
-            },
-            {
-                'name': '延迟最低',
-                'type': 'url-test',
-                'proxies': proxy_names,
-                'url': 'http://www.gstatic.com/generate_204',
-                'interval': 300
-            },
-            {
-                'name': '负载均衡',
-                'type': 'load-balance',
-                'proxies': proxy_names,
-                'url': 'http://www.gstatic.com/generate_204',
-                'interval': 300
-            },
-            {
-                'name': '失败切换',
-                'type': 'fallback',
-                'proxies': proxy_names,
-                'url': 'http://www.gstatic.com/generate_204',
-                'interval': 300
-            }
-        ]
-        
-        # 添加基本规则
-        clash_config['rules'] = [
-            'DOMAIN-SUFFIX,local,DIRECT',
-            'IP-CIDR,127.0.0.0/8,DIRECT',
-            'IP-CIDR,192.168.0.0/16,DIRECT',
-            'IP-CIDR,10.0.0.0/8,DIRECT',
-            'IP-CIDR,172.16.0.0/12,DIRECT',
-            'GEOIP,CN,DIRECT',
-            'MATCH,全局选择'
-        ]
-        
-        # 转换为 YAML 格式
-        yaml_content = yaml.dump(clash_config, 
-                                allow_unicode=True, 
-                                default_flow_style=False,
-                                sort_keys=False)
-        
-        # 添加注释头
-        header = f"""# ProxyPool Clash 订阅配置
-# 生成时间: {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
-# 代理数量: {len(clash_config['proxies'])}
-# 项目地址: https://github.com/huppugo1/ProxyPoolWithUI
+        error = _subscription_auth('Clash')
+        if error is not None:
+            return error
+        if _clash_provider_mode():
+            # 配置的内容只与节点列表的地址有关，使用固定的版本，代理池变化时不需要重新生成
+            return _cached_subscription('clash_provider', (_clash_provider_url(),), _render_clash_provider, version=0)
+        return _cached_subscription('clash', _subscription_params(_CLASH_PROTOCOLS), _render_clash)
 
-"""
-        
-        return Response(header + yaml_content, mimetype='text/yaml; charset=utf-8')
-        
     except Exception as e:
         error_msg = f'# 生成 Clash 配置失败: {str(e)}\n'
         return Response(error_msg, mimetype='text/yaml; charset=utf-8', status=500)
@@ -647,158 +860,20 @@ def clash_proxies():
     支持参数：
     - username: 用户名（必填）
     - password: 密码（必填）
-    - c: 按国家筛选，多个国家用逗号分隔 (如: c=CN,US)
+    - c: 按国家筛选，多个国家用逗号分隔，可以是国家代码或名称 (如: c=CN,US)
     - nc: 排除指定国家 (如: nc=CN)
-    - protocol: 筛选协议类型（http/https/socks5）
-    - limit: 限制代理数量，默认返回全部
+    - protocol: 筛选协议类型（http/https/socks5），多个协议用逗号分隔
+    - max_latency: 最大延迟，单位毫秒
+    - max_age: 最近一次验证距今最多多久，单位秒
+    - limit: 限制代理数量，默认返回全部，在所有筛选条件之后生效
+    代理池没有变化时返回缓存的内容，支持ETag
     """
     try:
-        # URL 参数认证
-        username = request.args.get('username')
-        password = request.args.get('password')
-        
-        if not username or not password:
-            return jsonify({
-                'success': False,
-                'message': 'Clash 订阅需要认证，请提供 username 和 password 参数'
-            }), 401
-        
-        # 验证账号密码
-        user = auth_manager.authenticate(username, password)
-        if not user:
-            return jsonify({
-                'success': False,
-                'message': '用户名或密码错误'
-            }), 401
-        
-        
-        # 获取查询参数
-        countries = request.args.get('c', '').upper().split(',') if request.args.get('c') else None
-        exclude_countries = request.args.get('nc', '').upper().split(',') if request.args.get('nc') else None
-        protocol = request.args.get('protocol', None)
-        limit = request.args.get('limit', -1, type=int)
-        
-        
-        # 从数据库获取代理
-        if protocol:
-            proxies = conn.get_by_protocol(protocol, limit)
-        else:
-            proxies = conn.getValidatedRandom(limit)
-        
-        # 按国家筛选
-        if countries and countries != ['']:
-            country_map = {
-                'CN': '中国', 'HK': '香港', 'TW': '台湾',
-                'US': '美国', 'CA': '加拿大',
-                'JP': '日本', 'SG': '新加坡',
-                'AU': '澳大利亚', 'RU': '俄罗斯',
-                'CH': '瑞士', 'DE': '德国', 'FR': '法国',
-                'GB': '英国', 'NL': '荷兰'
-            }
-            country_names = [country_map.get(c, c) for c in countries if c]
-            proxies = [p for p in proxies if p.country in country_names]
-        
-        # 排除指定国家
-        if exclude_countries and exclude_countries != ['']:
-            country_map = {
-                'CN': '中国', 'HK': '香港', 'TW': '台湾',
-                'US': '美国', 'CA': '加拿大',
-                'JP': '日本', 'SG': '新加坡',
-                'AU': '澳大利亚', 'RU': '俄罗斯',
-                'CH': '瑞士', 'DE': '德国', 'FR': '法国',
-                'GB': '英国', 'NL': '荷兰'
-            }
-            exclude_names = [country_map.get(c, c) for c in exclude_countries if c]
-            proxies = [p for p in proxies if p.country not in exclude_names]
-        
-        if not proxies:
-            return Response('# 暂无可用代理\nproxies: []\n', mimetype='text/yaml; charset=utf-8')
-        
-        # 构建代理列表
-        proxy_list = []
-        
-        # 扩展的国家 emoji 映射表
-        country_emoji_map = {
-            '中国': '🇨🇳', '香港': '🇭🇰', '台湾': '🇹🇼',
-            '美国': '🇺🇸', '加拿大': '🇨🇦',
-            '日本': '🇯🇵', '新加坡': '🇸🇬',
-            '澳大利亚': '🇦🇺', '俄罗斯': '🇷🇺', '俄罗斯联邦': '🇷🇺',
-            '瑞士': '🇨🇭', '德国': '🇩🇪', '法国': '🇫🇷',
-            '英国': '🇬🇧', '荷兰': '🇳🇱',
-            '韩国': '🇰🇷', '印度': '🇮🇳', '泰国': '🇹🇭',
-            '越南': '🇻🇳', '菲律宾': '🇵🇭', '印尼': '🇮🇩', '印度尼西亚': '🇮🇩',
-            '马来西亚': '🇲🇾', '巴西': '🇧🇷', '阿根廷': '🇦🇷',
-            '墨西哥': '🇲🇽', '智利': '🇨🇱', '哥伦比亚': '🇨🇴',
-            '西班牙': '🇪🇸', '意大利': '🇮🇹', '波兰': '🇵🇱',
-            '土耳其': '🇹🇷', '以色列': '🇮🇱', '阿联酋': '🇦🇪',
-            '南非': '🇿🇦', '埃及': '🇪🇬', '尼日利亚': '🇳🇬',
-            '乌克兰': '🇺🇦', '罗马尼亚': '🇷🇴', '捷克': '🇨🇿',
-            '希腊': '🇬🇷', '葡萄牙': '🇵🇹', '瑞典': '🇸🇪',
-            '挪威': '🇳🇴', '丹麦': '🇩🇰', '芬兰': '🇫🇮',
-            '奥地利': '🇦🇹', '比利时': '🇧🇪', '爱尔兰': '🇮🇪',
-            '阿尔巴尼亚': '🇦🇱', '保加利亚': '🇧🇬', '塞尔维亚': '🇷🇸',
-            '克罗地亚': '🇭🇷', '匈牙利': '🇭🇺', '斯洛伐克': '🇸🇰',
-            '斯洛文尼亚': '🇸🇮', '立陶宛': '🇱🇹', '拉脱维亚': '🇱🇻',
-            '爱沙尼亚': '🇪🇪', '乌拉圭': '🇺🇾', '巴拉圭': '🇵🇾',
-            '新西兰': '🇳🇿', '巴基斯坦': '🇵🇰', '孟加拉国': '🇧🇩'
-        }
-        
-        for p in proxies:
-            # 生成代理名称
-            if p.country and p.country.strip() and p.country.strip() != '未知':
-                # 有国家信息：显示国旗+国家+IP
-                country_name = p.country.strip()
-                country_emoji = country_emoji_map.get(country_name, '🌍')
-                proxy_name = f'{country_emoji} {country_name}_{p.ip}'
-            else:
-                # 没有国家信息：只显示IP+端口
-                proxy_name = f'{p.ip}_{p.port}'
-            
-            if p.protocol in ['http', 'https']:
-                proxy_node = {
-                    'name': proxy_name,
-                    'type': 'http',
-                    'server': p.ip,
-                    'port': p.port
-                }
-                if p.username and p.password:
-                    proxy_node['username'] = p.username
-                    proxy_node['password'] = p.password
-                    
-            elif p.protocol == 'socks5':
-                proxy_node = {
-                    'name': proxy_name,
-                    'type': 'socks5',
-                    'server': p.ip,
-                    'port': p.port
-                }
-                if p.username and p.password:
-                    proxy_node['username'] = p.username
-                    proxy_node['password'] = p.password
-            else:
-                continue
-            
-            proxy_list.append(proxy_node)
-        
-        if not proxy_list:
-            return Response('# 暂无支持的代理类型（需要 http/https/socks5）\nproxies: []\n', 
-                          mimetype='text/yaml; charset=utf-8')
-        
-        # 转换为 YAML 格式
-        yaml_content = yaml.dump({'proxies': proxy_list}, 
-                                allow_unicode=True, 
-                                default_flow_style=False,
-                                sort_keys=False)
-        
-        # 添加注释头
-        header = f"""# ProxyPool Clash 代理列表
-# 生成时间: {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
-# 代理数量: {len(proxy_list)}
+        error = _subscription_auth('Clash')
+        if error is not None:
+            return error
+        return _cached_subscription('clash_proxies', _subscription_params(_CLASH_PROTOCOLS), _render_clash_proxies)
 
-"""
-        
-        return Response(header + yaml_content, mimetype='text/yaml; charset=utf-8')
-        
     except Exception as e:
         import traceback
         error_msg = f'# 生成 Clash 代理列表失败: {str(e)}\nproxies: []\n'
@@ -810,6 +885,70 @@ def clash_proxies():
 
 ############# V2Ray 订阅接口 ################
 
+def _render_v2ray(params):
+    """
+    生成 V2Ray 订阅内容
+    返回 : (内容, mimetype)
+    """
+    proxies = _load_subscription_proxies(params)
+    if not proxies:
+        return '# 暂无可用代理\n', 'text/plain; charset=utf-8'
+
+    # 检查是否有支持的代理
+    supported_proxies = [p for p in proxies if p.protocol in ['http', 'https', 'socks4', 'socks5']]
+    if not supported_proxies:
+        return '# 暂无支持的代理类型（需要 http/https/socks4/socks5）\n', 'text/plain; charset=utf-8'
+
+    # 根据代理类型生成不同的链接格式
+    proxy_links = []
+    for p in supported_proxies:
+        country = p.country or '未知'
+        remark = f'{country}_{p.ip}'
+        remark_encoded = remark  # 直接使用备注，不进行编码
+
+        if p.protocol in ['http', 'https']:
+            # HTTP/HTTPS 代理生成 VMess 格式
+            # 由代理地址生成固定的id，代理没有变化时订阅内容（以及ETag）保持不变
+            vmess_uuid = str(uuid.uuid5(uuid.NAMESPACE_URL, f'{p.protocol}://{p.ip}:{p.port}'))
+
+            vmess_data = {
+                'v': '2',
+                'ps': remark,
+                'add': p.ip,
+                'port': str(p.port),
+                'id': vmess_uuid,
+                'aid': '0',
+                'net': 'tcp',
+                'type': 'none',
+                'host': '',
+                'path': '',
+                'tls': 'none'
+            }
+
+            if p.username and p.password:
+                vmess_data['net'] = 'http'
+                vmess_data['type'] = 'http'
+                vmess_data['host'] = f"{p.username}:{p.password}@{p.ip}:{p.port}"
+
+            vmess_json = json.dumps(vmess_data)
+            vmess_base64 = base64.b64encode(vmess_json.encode('utf-8')).decode('utf-8')
+            proxy_link = f"vmess://{vmess_base64}"
+
+        else:
+            # SOCKS 代理生成 socks:// 格式
+            if p.username and p.password:
+                auth_info = f"{p.username}:{p.password}"
+                auth_base64 = base64.b64encode(auth_info.encode('utf-8')).decode('utf-8')
+                proxy_link = f"socks://{auth_base64}@{p.ip}:{p.port}#{remark_encoded}"
+            else:
+                proxy_link = f"socks://{p.ip}:{p.port}#{remark_encoded}"
+
+        proxy_links.append(proxy_link)
+
+    # 将所有代理链接聚合后用 Base64 编码，不添加注释头
+    all_links = '\n'.join(proxy_links)
+    return base64.b64encode(all_links.encode('utf-8')).decode('utf-8'), 'text/plain; charset=utf-8'
+
 # V2Ray 订阅接口
 @app.route('/v2ray', methods=['GET'])
 def v2ray_subscribe():
@@ -818,145 +957,20 @@ def v2ray_subscribe():
     支持参数：
     - username: 用户名（必填）
     - password: 密码（必填）
-    - c: 按国家筛选，多个国家用逗号分隔 (如: c=CN,US)
+    - c: 按国家筛选，多个国家用逗号分隔，可以是国家代码或名称 (如: c=CN,US)
     - nc: 排除指定国家 (如: nc=CN)
-    - protocol: 筛选协议类型（http/https/socks5）
-    - limit: 限制代理数量，默认返回全部
+    - protocol: 筛选协议类型（http/https/socks5），多个协议用逗号分隔
+    - max_latency: 最大延迟，单位毫秒
+    - max_age: 最近一次验证距今最多多久，单位秒
+    - limit: 限制代理数量，默认返回全部，在所有筛选条件之后生效
+    代理池没有变化时返回缓存的内容，支持ETag
     """
     try:
-        # URL 参数认证
-        username = request.args.get('username')
-        password = request.args.get('password')
-        
-        if not username or not password:
-            return jsonify({
-                'success': False,
-                'message': 'V2Ray 订阅需要认证，请提供 username 和 password 参数'
-            }), 401
-        
-        # 验证账号密码
-        user = auth_manager.authenticate(username, password)
-        if not user:
-            return jsonify({
-                'success': False,
-                'message': '用户名或密码错误'
-            }), 401
-        
-        print(f"[v2ray] 用户 {username} 认证成功")
-        
-        # 获取查询参数
-        countries = request.args.get('c', '').upper().split(',') if request.args.get('c') else None
-        exclude_countries = request.args.get('nc', '').upper().split(',') if request.args.get('nc') else None
-        protocol = request.args.get('protocol', None)
-        limit = request.args.get('limit', -1, type=int)
-        
-        print(f"[v2ray] 请求参数: countries={countries}, exclude={exclude_countries}, protocol={protocol}, limit={limit}")
-        
-        # 从数据库获取代理
-        if protocol:
-            proxies = conn.get_by_protocol(protocol, limit)
-        else:
-            proxies = conn.getValidatedRandom(limit)
-        
-        # 按国家筛选
-        if countries and countries != ['']:
-            country_map = {
-                'CN': '中国', 'HK': '香港', 'TW': '台湾',
-                'US': '美国', 'CA': '加拿大',
-                'JP': '日本', 'SG': '新加坡',
-                'AU': '澳大利亚', 'RU': '俄罗斯',
-                'CH': '瑞士', 'DE': '德国', 'FR': '法国',
-                'GB': '英国', 'NL': '荷兰'
-            }
-            country_names = [country_map.get(c, c) for c in countries if c]
-            proxies = [p for p in proxies if p.country in country_names]
-            print(f"[v2ray] 国家筛选后: {len(proxies)} 个代理")
-        
-        # 排除指定国家
-        if exclude_countries and exclude_countries != ['']:
-            country_map = {
-                'CN': '中国', 'HK': '香港', 'TW': '台湾',
-                'US': '美国', 'CA': '加拿大',
-                'JP': '日本', 'SG': '新加坡',
-                'AU': '澳大利亚', 'RU': '俄罗斯',
-                'CH': '瑞士', 'DE': '德国', 'FR': '法国',
-                'GB': '英国', 'NL': '荷兰'
-            }
-            exclude_names = [country_map.get(c, c) for c in exclude_countries if c]
-            proxies = [p for p in proxies if p.country not in exclude_names]
-            print(f"[v2ray] 排除国家后: {len(proxies)} 个代理")
-        
-        if not proxies:
-            return Response('# 暂无可用代理\n', mimetype='text/plain; charset=utf-8')
-        
-        # 检查是否有支持的代理
-        supported_proxies = [p for p in proxies if p.protocol in ['http', 'https', 'socks4', 'socks5']]
-        if not supported_proxies:
-            return Response('# 暂无支持的代理类型（需要 http/https/socks4/socks5）\n', mimetype='text/plain; charset=utf-8')
-        
-        # 根据代理类型生成不同的链接格式
-        import base64
-        import json
-        import uuid
-        
-        proxy_links = []
-        for i, p in enumerate(proxies):
-            if p.protocol in ['http', 'https', 'socks4', 'socks5']:
-                country = p.country or '未知'
-                remark = f'{country}_{p.ip}'
-                remark_encoded = remark  # 直接使用备注，不进行编码
-                
-                if p.protocol in ['http', 'https']:
-                    # HTTP/HTTPS 代理生成 VMess 格式
-                    vmess_uuid = str(uuid.uuid4())
-                    
-                    vmess_data = {
-                        'v': '2',
-                        'ps': remark,
-                        'add': p.ip,
-                        'port': str(p.port),
-                        'id': vmess_uuid,
-                        'aid': '0',
-                        'net': 'tcp',
-                        'type': 'none',
-                        'host': '',
-                        'path': '',
-                        'tls': 'none'
-                    }
-                    
-                    if p.username and p.password:
-                        vmess_data['net'] = 'http'
-                        vmess_data['type'] = 'http'
-                        vmess_data['host'] = f"{p.username}:{p.password}@{p.ip}:{p.port}"
-                    
-                    vmess_json = json.dumps(vmess_data)
-                    vmess_base64 = base64.b64encode(vmess_json.encode('utf-8')).decode('utf-8')
-                    proxy_link = f"vmess://{vmess_base64}"
-                    
-                elif p.protocol in ['socks4', 'socks5']:
-                    # SOCKS 代理生成 socks:// 格式
-                    if p.username and p.password:
-                        auth_info = f"{p.username}:{p.password}"
-                        auth_base64 = base64.b64encode(auth_info.encode('utf-8')).decode('utf-8')
-                        proxy_link = f"socks://{auth_base64}@{p.ip}:{p.port}#{remark_encoded}"
-                    else:
-                        proxy_link = f"socks://{p.ip}:{p.port}#{remark_encoded}"
-                
-                proxy_links.append(proxy_link)
-        
-        # 将所有代理链接聚合后用 Base64 编码
-        all_links = '\n'.join(proxy_links)
-        result_base64 = base64.b64encode(all_links.encode('utf-8')).decode('utf-8')
-        result = result_base64
-        
-        print(f"[v2ray] 成功生成配置，包含 {len(proxy_links)} 个代理")
-        print(f"[v2ray] 处理的代理类型: {[p.protocol for p in proxies]}")
-        print(f"[v2ray] 支持的代理数量: {len([p for p in proxies if p.protocol in ['http', 'https', 'socks4', 'socks5']])}")
-        print(f"[v2ray] Base64编码结果长度: {len(result)}")
-        
-        # 直接返回 Base64 编码的结果，不添加注释头
-        return Response(result, mimetype='text/plain; charset=utf-8')
-        
+        error = _subscription_auth('V2Ray')
+        if error is not None:
+            return error
+        return _cached_subscription('v2ray', _subscription_params(), _render_v2ray)
+
     except Exception as e:
         import traceback
         error_msg = f'# 生成 V2Ray 配置失败: {str(e)}\n'
@@ -1032,6 +1046,18 @@ def proxies_status():
             pending_proxies_cnt=0
         )), 500
 
+# 获取可用代理索引的状态，包括索引大小、各分组的代理数量、刷新耗时等
+@app.route('/pool_status', methods=['GET'])
+@token_required
+def pool_status():
+    index = _get_pool_index()
+    render_cache = _render_cache.report() if _render_cache is not None else None
+    feedback = _feedback.report() if _feedback is not None else None
+    if index is None:
+        return jsonify(dict(success=False, message='没有启用可用代理索引（API_POOL_INDEX）', render_cache=render_cache, feedback=feedback))
+    leases = _lease_manager.report() if _lease_manager is not None else None
+    return jsonify(dict(success=True, render_cache=render_cache, feedback=feedback, leases=leases, **index.report()))
+
 # 获取爬取器状态
 @app.route('/fetchers_status', methods=['GET'])
 @token_required
@@ -1075,10 +1101,10 @@ def clear_fetchers_status():
 def fetcher_enable():
     name = request.args.get('name')
     enable = request.args.get('enable')
-    if enable == '1':
-        conn.pushFetcherEnable(name, True)
-    else:
-        conn.pushFetcherEnable(name, False)
+    try:
+        conn.pushFetcherEnable(name, enable == '1')
+    except ValueError:
+        return jsonify(dict(success=False, message=f'爬取器{name}不存在')), 400
     return jsonify(dict(success=True))
 
 # 手动添加代理
@@ -1182,21 +1208,75 @@ def handle_preflight():
 
 app.after_request(after_request)
 
-def main(proc_lock):
-    if proc_lock is not None:
-        conn.set_proc_lock(proc_lock)
-    
-    # 优化Flask配置，启用多线程以提高网络响应性能
+def _gunicorn_available():
+    if sys.platform == 'win32':
+        return False
+    try:
+        import gunicorn.app.base
+    except ImportError:
+        return False
+    return True
+
+def _run_gunicorn(host, port, workers, threads):
+    """
+    使用gunicorn运行，gthread worker，每个进程workers个线程
+    worker是从当前进程fork出来的：全局的SQLite连接在fork之后重新打开，可用代理索引、订阅缓存等在worker中第一次使用时创建，
+    各个worker通过只读连接池读取数据库（WAL模式下读取不会被写入阻塞），写操作仍然通过进程锁或者写入队列
+    """
+    from gunicorn.app.base import BaseApplication
+
+    def post_fork(server, worker):
+        conn.reopen()
+
+    class Application(BaseApplication):
+        def load_config(self):
+            options = dict(
+                bind=f'{host}:{port}',
+                workers=workers,
+                threads=threads,
+                worker_class='gthread',
+                keepalive=5,
+                timeout=60,
+                graceful_timeout=10,
+                post_fork=post_fork,
+                accesslog=None
+            )
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return app
+
+    Application().run()
+
+def serve(host='0.0.0.0', port=5000, server=API_SERVER, workers=API_WORKERS, threads=API_THREADS):
+    """
+    运行API服务器
+    server : flask或者gunicorn，gunicorn不可用时使用flask
+    """
+    if server == 'gunicorn' and not _gunicorn_available():
+        print('[API] gunicorn不可用（没有安装或者在Windows上运行），使用flask')
+        server = 'flask'
+    if server == 'gunicorn':
+        print(f'[API] 使用gunicorn，{workers}个进程，每个进程{threads}个线程')
+        _run_gunicorn(host, port, workers, threads)
+        return
     # 数据库连接已经配置为支持多线程访问（check_same_thread=False）
     # 并且使用了WAL模式和适当的锁机制来保证线程安全
     app.run(
-        host='0.0.0.0', 
-        port=5000, 
+        host=host,
+        port=port,
         threaded=True,  # 启用多线程，提高并发处理能力
         processes=1,    # 单进程，避免数据库连接冲突
         debug=False,    # 生产环境关闭调试模式
         use_reloader=False  # 关闭自动重载，避免多进程问题
     )
 
+def main(proc_lock, write_queue=None):
+    if proc_lock is not None:
+        conn.set_proc_lock(proc_lock)
+    conn.set_write_queue(write_queue)
+    serve()
+
 if __name__ == '__main__':
     main(None)
@@ -0,0 +1,209 @@
+# encoding: utf-8
+"""
+Clash 配置的 YAML 生成
+Clash 配置的结构是固定的（顶层为若干标量、代理列表、代理组列表和规则列表），
+因此不使用 yaml.dump（纯Python实现，代理数量多时需要数秒），而是按照固定的格式直接拼接文本：
+    代理节点使用单行的流式映射：- {name: "...", type: http, server: "...", port: 8080}
+    代理组使用块映射，其中的代理名称列表每行一个
+也可以生成使用 proxy-provider 的配置（build_provider_config），代理组通过 use 引用节点列表，配置本身不包含代理
+所有字符串都使用双引号，并对引号、反斜杠、控制字符等进行转义，名称中含有emoji、冒号、#等字符时也能正确解析
+可以运行 python benchmarks/bench_clash.py 检查生成的YAML能否被正确解析，并比较与 yaml.dump 的耗时
+"""
+
+import re
+
+HEALTH_CHECK_URL = 'http://www.gstatic.com/generate_204'
+HEALTH_CHECK_INTERVAL = 300
+PROVIDER_NAME = 'proxypool'
+
+# 需要转义的字符：双引号、反斜杠、C0/C1控制字符、DEL、YAML中的换行符（U+2028/U+2029）、BOM以及非字符
+_NEEDS_ESCAPE = re.compile('["\\\\\x00-\x1f\x7f-\x9f\u2028\u2029\ufeff\ufffe\uffff]')
+_ESCAPES = {'"': '\\"', '\\': '\\\\', '\n': '\\n', '\t': '\\t', '\r': '\\r', '\0': '\\0'}
+# 可以不加引号的键
+_PLAIN_KEY = re.compile(r'^[A-Za-z][A-Za-z0-9_-]*$')
+
+
+def _escape_char(m):
+    c = m.group(0)
+    escaped = _ESCAPES.get(c)
+    if escaped is not None:
+        return escaped
+    code = ord(c)
+    return f'\\x{code:02x}' if code < 0x100 else f'\\u{code:04x}'
+
+
+def quote(s):
+    """
+    将字符串转换为YAML双引号标量
+    """
+    if _NEEDS_ESCAPE.search(s) is None:
+        return f'"{s}"'
+    return '"' + _NEEDS_ESCAPE.sub(_escape_char, s) + '"'
+
+
+def _key(k):
+    return k if _PLAIN_KEY.match(k) else quote(k)
+
+
+def _scalar(v, quoted):
+    """
+    quoted : 字符串 -> 转义后的文本，同一个名称会在多个代理组中出现，只需要转义一次
+    """
+    if isinstance(v, str):
+        q = quoted.get(v)
+        if q is None:
+            q = quoted[v] = quote(v)
+        return q
+    if v is True:
+        return 'true'
+    if v is False:
+        return 'false'
+    if v is None:
+        return 'null'
+    if isinstance(v, (int, float)):
+        return repr(v)
+    raise TypeError(f'不支持的类型：{type(v).__name__}')
+
+
+def _flow_mapping(d, quoted):
+    return '{' + ', '.join(f'{_key(k)}: {_scalar(v, quoted)}' for k, v in d.items()) + '}'
+
+
+def _block_mapping(d, indent, out, quoted):
+    pad = ' ' * indent
+    for k, v in d.items():
+        k = _key(k)
+        if isinstance(v, dict):
+            if v:
+                out.append(f'{pad}{k}:')
+                _block_mapping(v, indent + 2, out, quoted)
+            else:
+                out.append(f'{pad}{k}: {{}}')
+        elif isinstance(v, list):
+            if v:
+                out.append(f'{pad}{k}:')
+                _block_sequence(v, indent, out, quoted)
+            else:
+                out.append(f'{pad}{k}: []')
+        else:
+            out.append(f'{pad}{k}: {_scalar(v, quoted)}')
+
+
+def _block_sequence(items, indent, out, quoted):
+    pad = ' ' * indent
+    for item in items:
+        if not isinstance(item, dict):
+            out.append(f'{pad}- {_scalar(item, quoted)}')
+        elif not item:
+            out.append(f'{pad}- {{}}')
+        elif not any(isinstance(v, (list, dict)) for v in item.values()):
+            out.append(f'{pad}- {_flow_mapping(item, quoted)}')
+        else:
+            # 块映射的第一行以"- "开头，其余的行缩进两格
+            start = len(out)
+            _block_mapping(item, indent + 2, out, quoted)
+            out[start] = f'{pad}- ' + out[start][indent + 2:]
+
+
+def dump(config):
+    """
+    将Clash配置转换为YAML文本
+    config : dict，值可以是标量、dict或者list，list中的元素可以是标量或者dict
+             值全部是标量的dict（例如代理节点）在列表中输出为单行的流式映射，其他dict输出为块映射
+    返回 : str
+    """
+    quoted = {}
+    out = []
+    _block_mapping(config, 0, out, quoted)
+    out.append('')
+    return '\n'.join(out)
+
+
+_AUTO_GROUPS = [('延迟最低', 'url-test'), ('负载均衡', 'load-balance'), ('失败切换', 'fallback')]
+
+_RULES = [
+    'DOMAIN-SUFFIX,local,DIRECT',
+    'IP-CIDR,127.0.0.0/8,DIRECT',
+    'IP-CIDR,192.168.0.0/16,DIRECT',
+    'IP-CIDR,10.0.0.0/8,DIRECT',
+    'IP-CIDR,172.16.0.0/12,DIRECT',
+    'GEOIP,CN,DIRECT',
+    'MATCH,全局选择'
+]
+
+
+def _base_config():
+    return {
+        'port': 7890,
+        'socks-port': 7891,
+        'allow-lan': False,
+        'mode': 'rule',
+        'log-level': 'info',
+        'external-controller': '127.0.0.1:9090',
+    }
+
+
+def _proxy_groups(proxy_names=None, provider=None):
+    """
+    生成代理组
+    proxy_names : 代理名称的列表，组中直接列出所有代理
+    provider : proxy-provider的名称，组中通过use引用，此时不需要proxy_names
+    """
+    select = {
+        'name': '全局选择',
+        'type': 'select',
+        'proxies': [name for name, _ in _AUTO_GROUPS] + (proxy_names[:50] if provider is None else [])  # 只显示前50个以避免太长
+    }
+    if provider is not None:
+        select['use'] = [provider]
+    groups = [select]
+    for name, group_type in _AUTO_GROUPS:
+        group = {'name': name, 'type': group_type}
+        if provider is None:
+            group['proxies'] = proxy_names
+        else:
+            group['use'] = [provider]
+        group['url'] = HEALTH_CHECK_URL
+        group['interval'] = HEALTH_CHECK_INTERVAL
+        groups.append(group)
+    return groups
+
+
+def build_config(nodes):
+    """
+    生成完整的Clash配置
+    nodes : list[dict]，代理节点
+    返回 : dict
+    """
+    config = _base_config()
+    config['proxies'] = nodes
+    config['proxy-groups'] = _proxy_groups(proxy_names=[node['name'] for node in nodes])
+    config['rules'] = list(_RULES)
+    return config
+
+
+def build_provider_config(url, path, interval):
+    """
+    生成使用proxy-provider的Clash配置，配置中不包含代理节点，客户端定期从url下载节点列表
+    url : 节点列表的地址（/clash/proxies）
+    path : 客户端保存节点列表的文件路径，不同的订阅需要使用不同的路径
+    interval : 客户端更新节点列表的间隔，单位s
+    返回 : dict
+    """
+    config = _base_config()
+    config['proxy-providers'] = {
+        PROVIDER_NAME: {
+            'type': 'http',
+            'url': url,
+            'interval': interval,
+            'path': path,
+            'health-check': {
+                'enable': True,
+                'url': HEALTH_CHECK_URL,
+                'interval': HEALTH_CHECK_INTERVAL
+            }
+        }
+    }
+    config['proxy-groups'] = _proxy_groups(provider=PROVIDER_NAME)
+    config['rules'] = list(_RULES)
+    return config
@@ -0,0 +1,117 @@
+# encoding: utf-8
+"""
+客户端反馈（/report）的汇总
+客户端使用代理之后上报结果（代理、是否成功、延迟），反馈先在内存中按代理汇总，定期批量写入数据库：
+    一段时间内失败次数达到阈值、且失败占比足够高的代理，按照Proxy.validate中验证失败的方式更新
+    （validated=0，validate_failed_cnt加一，to_validate_date设为当前时间），立即从可用代理中移除并尽快重新验证
+    只有成功反馈的代理，用上报的平均延迟更新latency（只统计带有延迟的反馈，都没有延迟时不更新）
+反馈不会直接删除代理，是否删除仍然由验证器决定
+"""
+
+import sys
+import time
+import datetime
+import logging
+import threading
+from db import conn
+
+logging.basicConfig(stream=sys.stdout, format="%(asctime)s-%(levelname)s:%(name)s:%(message)s", level='INFO')
+
+
+class FeedbackAggregator(object):
+    """
+    客户端反馈的汇总
+    flush_interval : 写入数据库的间隔，单位s
+    fail_threshold : 失败次数达到多少时认为代理已经不可用
+    fail_ratio : 同时失败次数占比至少为多少
+    window : 没有达到阈值的失败反馈最多保留多久，单位s
+    on_failed : 代理被认为不可用时立即调用，参数为(protocol, ip, port)，用于从内存中的可用代理索引中移除
+    """
+
+    def __init__(self, flush_interval, fail_threshold, fail_ratio, window, on_failed=None):
+        self.logger = logging.getLogger('feedback')
+        self.flush_interval = flush_interval
+        self.fail_threshold = fail_threshold
+        self.fail_ratio = fail_ratio
+        self.window = window
+        self.on_failed = on_failed
+        self.lock = threading.Lock()
+        self.entries = {} # (protocol, ip, port) -> [成功次数, 失败次数, 成功的延迟之和, 带有延迟的成功次数, 第一次反馈的时间]
+        self.failed = set() # 已经达到阈值、等待写入数据库的代理
+        self.stats = dict(reports=0, failed_proxies=0, updated_latency=0, flush_cnt=0)
+        self.thread = threading.Thread(target=self._run, name='feedback', daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def _is_failed(self, entry):
+        succ, fail = entry[0], entry[1]
+        return fail >= self.fail_threshold and fail >= (succ + fail) * self.fail_ratio
+
+    def add(self, reports):
+        """
+        添加一批反馈
+        reports : list[(protocol, ip, port, success, latency)]，latency单位毫秒，可以为None
+        """
+        now = time.time()
+        newly_failed = []
+        with self.lock:
+            for protocol, ip, port, success, latency in reports:
+                key = (protocol, ip, port)
+                entry = self.entries.get(key)
+                if entry is None:
+                    entry = self.entries[key] = [0, 0, 0, 0, now]
+                if success:
+                    entry[0] += 1
+                    if latency is not None:
+                        entry[2] += latency
+                        entry[3] += 1
+                else:
+                    entry[1] += 1
+                if key not in self.failed and self._is_failed(entry):
+                    self.failed.add(key)
+                    newly_failed.append(key)
+            self.stats['reports'] += len(reports)
+        if self.on_failed is not None:
+            for key in newly_failed:
+                self.on_failed(key)
+
+    def flush(self):
+        """
+        将汇总的反馈写入数据库
+        """
+        now = time.time()
+        failed, succeeded = [], []
+        with self.lock:
+            for key, entry in list(self.entries.items()):
+                if key in self.failed:
+                    failed.append(key)
+                elif entry[0] > 0 and entry[1] == 0:
+                    if entry[3] > 0:
+                        succeeded.append((int(entry[2] / entry[3]),) + key)
+                elif now - entry[4] < self.window:
+                    continue
+                del self.entries[key]
+            self.failed.clear()
+        if failed or succeeded:
+            conn.pushClientFeedback(failed, succeeded, datetime.datetime.now())
+        self.stats['failed_proxies'] += len(failed)
+        self.stats['updated_latency'] += len(succeeded)
+        self.stats['flush_cnt'] += 1
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                self.logger.error(f'写入客户端反馈失败：{e}')
+
+    def report(self):
+        """
+        返回汇总的状态
+        """
+        with self.lock:
+            pending = len(self.entries)
+        return dict(pending=pending, **self.stats)
@@ -0,0 +1,150 @@
+# encoding: utf-8
+"""
+代理租约（/lease/*）
+调用方通过checkout一次获取若干个代理以及对应的租约，租约有效期内同一个代理不会再分配给其他调用方，
+调用方可以renew延长租约，用完之后release归还；没有归还的租约到期之后自动失效
+租约只保存在API进程的内存中：以租约ID索引，另外用一个按到期时间排序的堆找出到期的租约，
+checkout通过可用代理索引（ProxyPoolIndex.acquire）选择代理，索引记录哪些代理已经被租用，
+每次选择都是O(1)，不查询数据库，也不需要遍历分组
+"""
+
+import time
+import uuid
+import heapq
+import threading
+
+
+class Lease(object):
+    """
+    一个租约
+    """
+
+    __slots__ = ('lease_id', 'proxy', 'expires')
+
+    def __init__(self, lease_id, proxy, expires):
+        self.lease_id = lease_id
+        self.proxy = proxy
+        self.expires = expires
+
+    @property
+    def key(self):
+        return (self.proxy.protocol, self.proxy.ip, self.proxy.port)
+
+    def to_dict(self):
+        p = self.proxy
+        return {
+            'lease_id': self.lease_id,
+            'proxy': f'{p.protocol}://{p.ip}:{p.port}',
+            'country_code': p.country_code,
+            'latency': p.latency,
+            'expires_in': max(int(self.expires - time.time()), 0)
+        }
+
+
+class LeaseManager(object):
+    """
+    租约管理
+    index : ProxyPoolIndex，可用代理索引
+    default_ttl : 默认的租约时长，单位s
+    max_ttl : 最长的租约时长，单位s
+    """
+
+    def __init__(self, index, default_ttl, max_ttl):
+        self.index = index
+        self.default_ttl = default_ttl
+        self.max_ttl = max_ttl
+        self.lock = threading.Lock()
+        self.leases = {}  # 租约ID -> Lease
+        self.heap = []    # (到期时间, 租约ID)，renew之后旧的条目留在堆中，弹出时与租约的到期时间比较后丢弃
+        self.stats = dict(checkout=0, leased=0, renewed=0, released=0, expired=0, exhausted=0)
+
+    def _ttl(self, ttl):
+        if ttl is None or ttl <= 0:
+            return self.default_ttl
+        return min(ttl, self.max_ttl)
+
+    def _expire(self, now):
+        """
+        删除已经到期的租约，需要持有self.lock
+        """
+        heap = self.heap
+        while heap and heap[0][0] <= now:
+            expires, lease_id = heapq.heappop(heap)
+            lease = self.leases.get(lease_id)
+            if lease is not None and lease.expires == expires:
+                self._drop(lease)
+                self.stats['expired'] += 1
+
+    def _drop(self, lease):
+        del self.leases[lease.lease_id]
+        self.index.release(*lease.key)
+
+    def checkout(self, count=1, ttl=None, protocol=None, country=None, strategy='uniform'):
+        """
+        获取count个当前没有被租用的代理
+        protocol : 协议，None表示不限
+        country : 国家代码，None表示不限
+        strategy : 选择策略，见pool_index.STRATEGIES
+        返回 : list[Lease]，没有足够的代理时数量少于count
+        """
+        ttl = self._ttl(ttl)
+        # 索引过期时的同步刷新可能需要较长时间，在获取self.lock之前进行，不阻塞renew/release
+        self.index.ensure_fresh()
+        with self.lock:
+            now = time.time()
+            self._expire(now)
+            leases = []
+            for _ in range(count):
+                p = self.index.acquire(protocol, country, strategy)
+                if p is None:
+                    break
+                lease = Lease(uuid.uuid4().hex, p, now + ttl)
+                self.leases[lease.lease_id] = lease
+                heapq.heappush(self.heap, (lease.expires, lease.lease_id))
+                leases.append(lease)
+            self.stats['checkout'] += 1
+            self.stats['leased'] += len(leases)
+            if len(leases) < count:
+                self.stats['exhausted'] += 1
+        return leases
+
+    def renew(self, lease_id, ttl=None):
+        """
+        延长租约，新的到期时间为当前时间加上ttl
+        返回 : Lease，租约不存在或者已经到期时返回None
+        """
+        ttl = self._ttl(ttl)
+        with self.lock:
+            now = time.time()
+            self._expire(now)
+            lease = self.leases.get(lease_id)
+            if lease is None:
+                return None
+            lease.expires = now + ttl
+            heapq.heappush(self.heap, (lease.expires, lease_id))
+            self.stats['renewed'] += 1
+            return lease
+
+    def release(self, lease_id):
+        """
+        归还租约
+        返回 : Lease，租约不存在或者已经到期时返回None
+        """
+        with self.lock:
+            self._expire(time.time())
+            lease = self.leases.get(lease_id)
+            if lease is None:
+                return None
+            self._drop(lease)
+            self.stats['released'] += 1
+            return lease
+
+    def report(self):
+        """
+        返回租约的状态
+        """
+        with self.lock:
+            self._expire(time.time())
+            active = len(self.leases)
+            heap_size = len(self.heap)
+        return dict(active=active, heap_size=heap_size, **self.stats)
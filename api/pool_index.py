@@ -0,0 +1,437 @@
+# encoding: utf-8
+"""
+API进程中的可用代理索引
+将所有通过了验证的代理保存在内存中，按照协议和国家分组，随机获取一个代理的时间复杂度为O(1)，不需要查询数据库
+索引通过validate_date增量刷新：每次只读取上次刷新之后验证过的代理，验证成功的加入索引，验证失败的从索引中删除，
+可用代理的国家、账号密码发生变化时validate_date不变，这些代理由触发器记录在proxies_changes表中，增量刷新时按序号一并读取，
+另外每隔一段时间进行一次全量刷新，以处理其他原因导致的不一致（例如手动删除了数据库中的代理）
+获取代理时可以指定选择策略（STRATEGIES）：uniform（均匀随机）、weighted（按延迟和最近的验证结果加权随机）、
+fastest（在延迟最低的几个代理中随机）、round_robin（轮流选择）；加权随机使用别名表（alias method），
+每个分组的别名表在分组发生变化之后、下一次加权选择时重新构建，之后每次选择都是O(1)
+租约（api/lease.py）通过acquire/release使用索引：索引记录被租用的代理，每个分组在第一次acquire时构建没有被租用的代理的集合，
+之后随着租用、归还以及分组的变化一起更新，选择没有被租用的代理也是O(1)
+"""
+
+import sys
+import time
+import heapq
+import random
+import datetime
+import logging
+import threading
+from db import conn
+
+logging.basicConfig(stream=sys.stdout, format="%(asctime)s-%(levelname)s:%(name)s:%(message)s", level='INFO')
+
+# 增量刷新时，向前多读取一段时间内验证过的代理，单位s
+# 验证器先记录验证时间再批量写入数据库，因此可能有验证时间早于上次刷新时间、但是在上次刷新之后才写入的代理
+_WATERMARK_OVERLAP = 60
+
+STRATEGIES = ('uniform', 'weighted', 'fastest', 'round_robin')
+# 计算权重时延迟的下限和默认值（没有延迟信息时），单位毫秒
+_LATENCY_FLOOR = 50
+_LATENCY_DEFAULT = 3000
+# 最近的验证结果每记录一次，之前的结果乘以这个系数，越早的结果影响越小
+_HISTORY_DECAY = 0.8
+# fastest策略在延迟最低的多少个代理中随机选择，避免所有请求都集中在同一个代理上
+_FASTEST_TOP = 5
+# acquire时按策略选择的代理已经被租用，最多重新选择几次，之后在没有被租用的代理中均匀随机选择
+_ACQUIRE_TRIES = 4
+
+
+class _IndexedSet(object):
+    """
+    支持O(1)添加、删除和随机选择的集合
+    """
+
+    __slots__ = ('items', 'pos', 'dirty', 'prob', 'alias', 'fastest', 'rr', 'free')
+
+    def __init__(self):
+        self.items = []
+        self.pos = {}
+        self.dirty = True   # 集合或者其中代理的权重发生了变化，别名表需要重新构建
+        self.prob = None    # 别名表，与items对应
+        self.alias = None
+        self.fastest = None # 延迟最低的几个代理
+        self.rr = 0         # round_robin的位置
+        self.free = None    # 没有被租用的代理（_IndexedSet），第一次acquire时构建
+
+    def add(self, key):
+        """
+        返回 : 是否新加入了集合，已经在集合中时不改变dirty
+        """
+        if key in self.pos:
+            return False
+        self.dirty = True
+        self.pos[key] = len(self.items)
+        self.items.append(key)
+        return True
+
+    def remove(self, key):
+        i = self.pos.pop(key, None)
+        if i is None:
+            return
+        self.dirty = True
+        last = self.items.pop()
+        if i < len(self.items):
+            self.items[i] = last
+            self.pos[last] = i
+
+    def choice(self):
+        return random.choice(self.items) if self.items else None
+
+    def build(self, weights):
+        """
+        根据权重构建别名表（Vose's alias method），O(n)
+        weights : 与items对应的权重
+        """
+        n = len(weights)
+        total = sum(weights)
+        prob = [w * n / total for w in weights]
+        alias = [0] * n
+        small = [i for i, p in enumerate(prob) if p < 1]
+        large = [i for i, p in enumerate(prob) if p >= 1]
+        while small and large:
+            i, j = small.pop(), large.pop()
+            alias[i] = j
+            prob[j] -= 1 - prob[i]
+            (small if prob[j] < 1 else large).append(j)
+        # 剩下的只是浮点误差
+        for i in small + large:
+            prob[i] = 1
+        self.prob, self.alias = prob, alias
+        self.dirty = False
+
+    def weighted_choice(self):
+        if not self.items:
+            return None
+        i = random.randrange(len(self.items))
+        return self.items[i] if random.random() < self.prob[i] else self.items[self.alias[i]]
+
+    def next(self):
+        if not self.items:
+            return None
+        self.rr = (self.rr + 1) % len(self.items)
+        return self.items[self.rr]
+
+    def __len__(self):
+        return len(self.items)
+
+
+class ProxyPoolIndex(object):
+    """
+    可用代理索引
+    max_staleness : 索引最多允许多久没有刷新，超过之后在获取代理时先同步刷新一次，单位s
+    refresh_interval : 后台线程增量刷新的间隔，单位s
+    full_resync_interval : 全量刷新的间隔，单位s
+    """
+
+    def __init__(self, max_staleness, refresh_interval, full_resync_interval):
+        self.logger = logging.getLogger('pool_index')
+        self.max_staleness = max_staleness
+        self.refresh_interval = refresh_interval
+        self.full_resync_interval = full_resync_interval
+        self.lock = threading.Lock()          # 保护索引数据
+        self.refresh_lock = threading.Lock()  # 同一时间只有一个线程进行刷新
+        self.proxies = {}     # (protocol, ip, port) -> Proxy
+        self.partitions = {}  # (protocol, country_code) -> _IndexedSet，protocol或country_code为None表示不限
+        self.history = {}     # (protocol, ip, port) -> [成功次数, 失败次数]，增量刷新时看到的验证结果，按_HISTORY_DECAY衰减
+        self.leased = set()   # 被租用的代理 (protocol, ip, port)，见acquire/release
+        self.watermark = None # 上次刷新时开始查询的时间
+        self.change_seq = 0   # 已经读取过的proxies_changes的最大序号
+        self.last_refresh_time = 0
+        self.last_full_time = 0
+        self.stats = dict(refresh_cnt=0, refresh_seconds=0.0, last_refresh_ms=0.0, last_refresh_rows=0,
+                          full_cnt=0, last_full_ms=0.0, sync_refresh_cnt=0)
+        self.thread = threading.Thread(target=self._run, name='pool_index', daemon=True)
+
+    def start(self):
+        """
+        进行一次全量刷新，并启动后台刷新线程
+        """
+        self.refresh(full=True)
+        self.thread.start()
+        return self
+
+    @staticmethod
+    def _partition_keys(p):
+        return ((None, None), (p.protocol, None), (None, p.country_code), (p.protocol, p.country_code))
+
+    def _add(self, proxies, partitions, p, reweight=False):
+        """
+        加入或者更新一个代理，只有新加入分组或者权重发生变化时才需要重新构建分组的别名表
+        reweight : 代理的验证记录发生了变化（见_record），权重需要重新计算
+        """
+        key = (p.protocol, p.ip, p.port)
+        old = proxies.get(key)
+        if old is not None and old.country_code != p.country_code:
+            self._remove(proxies, partitions, key)
+        reweight = reweight or (old is not None and old.latency != p.latency)
+        proxies[key] = p
+        for part in self._partition_keys(p):
+            s = partitions.get(part)
+            if s is None:
+                s = partitions[part] = _IndexedSet()
+            if not s.add(key) and reweight:
+                s.dirty = True
+            if s.free is not None and key not in self.leased:
+                s.free.add(key)
+
+    def _remove(self, proxies, partitions, key):
+        p = proxies.pop(key, None)
+        if p is None:
+            return
+        for part in self._partition_keys(p):
+            s = partitions.get(part)
+            if s is not None:
+                s.remove(key)
+                if s.free is not None:
+                    s.free.remove(key)
+                if len(s) == 0:
+                    del partitions[part]
+
+    def refresh(self, full=False, if_stale=False):
+        """
+        刷新索引
+        full : 是否进行全量刷新
+        if_stale : 为True时，只有索引超过max_staleness没有刷新才进行刷新，用于多个线程同时发现索引过期的情况
+        """
+        with self.refresh_lock:
+            if if_stale and time.time() - self.last_refresh_time <= self.max_staleness:
+                return
+            full = full or self.watermark is None
+            start = time.perf_counter()
+            query_time = datetime.datetime.now()
+            changed = []
+            if not full:
+                change_seq, missed, changed = conn.getChangedSince(self.change_seq)
+                if missed:
+                    # 需要的变更记录已经被清理，改为全量刷新
+                    full, changed = True, []
+            if full:
+                # 先读取序号，读取代理期间的变化在下次增量刷新时再处理一次
+                change_seq = conn.getChangeSeq()
+                rows = conn.getValidatedRandom(-1)
+                proxies, partitions = {}, {}
+                for p in rows:
+                    self._add(proxies, partitions, p)
+                with self.lock:
+                    self.proxies, self.partitions = proxies, partitions
+                    self.history = {key: h for key, h in self.history.items() if key in proxies}
+            else:
+                rows = conn.getValidatedSince(self.watermark - datetime.timedelta(seconds=_WATERMARK_OVERLAP))
+                with self.lock:
+                    # 变更记录比验证结果先读取，先处理变更记录，再用更新的验证结果覆盖
+                    for p in changed:
+                        if p.validated:
+                            self._add(self.proxies, self.partitions, p)
+                        else:
+                            self._remove(self.proxies, self.partitions, (p.protocol, p.ip, p.port))
+                    for p in rows:
+                        key = (p.protocol, p.ip, p.port)
+                        recorded = self._record(key, p.validated, p._validate_date)
+                        if p.validated:
+                            self._add(self.proxies, self.partitions, p, recorded)
+                        else:
+                            self._remove(self.proxies, self.partitions, key)
+                    # 使用过加权选择的分组在这里重新构建别名表，不在请求中构建
+                    for s in self.partitions.values():
+                        if s.prob is not None:
+                            self._prepare(s)
+            elapsed = time.perf_counter() - start
+
+            self.watermark = query_time
+            self.change_seq = change_seq
+            self.last_refresh_time = time.time()
+            self.stats['refresh_cnt'] += 1
+            self.stats['refresh_seconds'] += elapsed
+            self.stats['last_refresh_ms'] = round(elapsed * 1000, 3)
+            self.stats['last_refresh_rows'] = len(rows) + len(changed)
+            if full:
+                self.last_full_time = self.last_refresh_time
+                self.stats['full_cnt'] += 1
+                self.stats['last_full_ms'] = round(elapsed * 1000, 3)
+
+    def _run(self):
+        while True:
+            time.sleep(self.refresh_interval)
+            try:
+                self.refresh(full=time.time() - self.last_full_time >= self.full_resync_interval)
+            except Exception as e:
+                self.logger.error(f'刷新可用代理索引失败：{e}')
+
+    def ensure_fresh(self):
+        """
+        索引超过max_staleness没有刷新时，同步刷新一次
+        """
+        if time.time() - self.last_refresh_time > self.max_staleness:
+            self.stats['sync_refresh_cnt'] += 1
+            self.refresh(if_stale=True)
+
+    def _record(self, key, success, validate_date):
+        """
+        记录一次验证结果，用于计算权重
+        validate_date : 验证时间，增量刷新会重复读到同一次验证的结果，验证时间与上次记录的相同时不重复记录；为None时总是记录
+        返回 : 是否记录了，记录之后代理的权重发生变化
+        """
+        h = self.history.get(key)
+        if h is None:
+            h = self.history[key] = [0.0, 0.0, None]
+        elif validate_date is not None and h[2] == validate_date:
+            return False
+        h[0] *= _HISTORY_DECAY
+        h[1] *= _HISTORY_DECAY
+        h[0 if success else 1] += 1
+        if validate_date is not None:
+            h[2] = validate_date
+        return True
+
+    @staticmethod
+    def _weight(latency, h):
+        """
+        代理的权重：与延迟成反比，再乘以最近验证的成功率（加一平滑，没有记录时为1/2）
+        latency : 延迟，单位毫秒
+        h : self.history中的记录，可以为None
+        """
+        succ, fail = (h[0], h[1]) if h is not None else (0, 0)
+        return 1000 / max(latency, _LATENCY_FLOOR) * (succ + 1) / (succ + fail + 2)
+
+    def _prepare(self, s):
+        """
+        分组发生变化之后重新构建别名表以及延迟最低的代理列表，O(n)，需要持有self.lock
+        """
+        if not s.dirty:
+            return
+        proxies, history = self.proxies, self.history
+        latencies = [proxies[key].latency or _LATENCY_DEFAULT for key in s.items]
+        s.build([self._weight(latency, history.get(key)) for key, latency in zip(s.items, latencies)])
+        s.fastest = [s.items[i] for i in heapq.nsmallest(_FASTEST_TOP, range(len(latencies)), key=latencies.__getitem__)]
+
+    def discard(self, protocol, ip, port):
+        """
+        立即从索引中移除一个代理，例如客户端反馈代理不可用时；之后如果代理重新通过验证，刷新时会再加入索引
+        """
+        with self.lock:
+            key = (protocol, ip, port)
+            self._record(key, False, None)
+            self._remove(self.proxies, self.partitions, key)
+
+    def pick(self, protocol=None, country=None, strategy='uniform'):
+        """
+        获取一个可用代理
+        protocol : 协议，None表示不限
+        country : 国家代码，None表示不限
+        strategy : 选择策略，见STRATEGIES，不支持的策略按uniform处理
+        返回 : Proxy，没有符合条件的代理时返回None
+        """
+        self.ensure_fresh()
+        with self.lock:
+            s = self.partitions.get((protocol, country))
+            if s is None:
+                return None
+            key = self._choose(s, strategy)
+            return self.proxies[key] if key is not None else None
+
+    def _choose(self, s, strategy):
+        """
+        按策略在分组中选择一个代理，需要持有self.lock
+        返回 : (protocol, ip, port)，分组为空时返回None
+        """
+        if strategy == 'weighted':
+            self._prepare(s)
+            return s.weighted_choice()
+        if strategy == 'fastest':
+            self._prepare(s)
+            return random.choice(s.fastest) if s.fastest else None
+        if strategy == 'round_robin':
+            return s.next()
+        return s.choice()
+
+    def _free(self, s):
+        """
+        分组中没有被租用的代理，第一次用到时构建，O(n)，需要持有self.lock
+        """
+        if s.free is None:
+            s.free = _IndexedSet()
+            for key in s.items:
+                if key not in self.leased:
+                    s.free.add(key)
+        return s.free
+
+    def acquire(self, protocol=None, country=None, strategy='uniform'):
+        """
+        获取一个没有被租用的可用代理，并标记为已租用，直到调用release
+        不会同步刷新索引，需要时由调用方先调用ensure_fresh
+        参数与pick相同
+        返回 : Proxy，没有符合条件的代理时返回None
+        """
+        with self.lock:
+            s = self.partitions.get((protocol, country))
+            if s is None:
+                return None
+            free = self._free(s)
+            if len(free) == 0:
+                return None
+            key = None
+            if strategy != 'uniform':
+                for _ in range(_ACQUIRE_TRIES):
+                    k = self._choose(s, strategy)
+                    if k in free.pos:
+                        key = k
+                        break
+            if key is None:
+                key = free.choice()
+            self.leased.add(key)
+            p = self.proxies[key]
+            for part in self._partition_keys(p):
+                t = self.partitions.get(part)
+                if t is not None and t.free is not None:
+                    t.free.remove(key)
+            return p
+
+    def release(self, protocol, ip, port):
+        """
+        归还acquire获取的代理，之后可以再被acquire选中
+        """
+        with self.lock:
+            key = (protocol, ip, port)
+            self.leased.discard(key)
+            p = self.proxies.get(key)
+            if p is None:
+                return
+            for part in self._partition_keys(p):
+                t = self.partitions.get(part)
+                if t is not None and t.free is not None:
+                    t.free.add(key)
+
+    def all(self, protocol=None, country=None):
+        """
+        获取所有符合条件的可用代理
+        返回 : list[Proxy]
+        """
+        self.ensure_fresh()
+        with self.lock:
+            s = self.partitions.get((protocol, country))
+            return [self.proxies[key] for key in s.items] if s is not None else []
+
+    def report(self):
+        """
+        返回索引的状态
+        """
+        with self.lock:
+            size = len(self.proxies)
+            leased = len(self.leased)
+            partitions = {f'{protocol}/{country}': len(s) for (protocol, country), s in self.partitions.items()
+                          if protocol is not None and country is not None}
+        stats = dict(self.stats)
+        stats['avg_refresh_ms'] = round(stats.pop('refresh_seconds') * 1000 / max(stats['refresh_cnt'], 1), 3)
+        return dict(
+            size=size,
+            leased=leased,
+            partitions=partitions,
+            staleness=round(time.time() - self.last_refresh_time, 3),
+            max_staleness=self.max_staleness,
+            watermark=str(self.watermark) if self.watermark is not None else None,
+            change_seq=self.change_seq,
+            **stats
+        )
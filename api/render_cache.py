@@ -0,0 +1,115 @@
+# encoding: utf-8
+"""
+订阅内容（/clash、/clash/proxies、/v2ray）的渲染缓存
+缓存以(接口, 筛选参数)为键，同时记录渲染时可用代理集合的版本号（conn.getPoolVersion，由触发器维护），
+版本号变化之后缓存失效；为了避免代理池频繁变化时每次请求都重新渲染，渲染之后至少使用min_ttl秒
+每个条目保存渲染结果以及对应的ETag和生成时间，客户端带有If-None-Match/If-Modified-Since时可以直接返回304；
+ETag只取决于内容，重新渲染之后内容没有变化时ETag和修改时间都不变
+"""
+
+import time
+import hashlib
+import datetime
+import threading
+from collections import OrderedDict
+
+
+class RenderedEntry(object):
+    """
+    一次渲染的结果
+    """
+
+    __slots__ = ('body', 'mimetype', 'etag', 'last_modified', 'version', 'created')
+
+    def __init__(self, body, mimetype, version):
+        self.body = body.encode('utf-8') if isinstance(body, str) else body
+        self.mimetype = mimetype
+        self.etag = hashlib.sha1(self.body).hexdigest()
+        # HTTP日期只精确到秒
+        self.last_modified = datetime.datetime.utcnow().replace(microsecond=0)
+        self.version = version
+        self.created = time.time()
+
+
+class RenderCache(object):
+    """
+    限制大小的LRU缓存
+    max_entries : 最多缓存多少个条目（不同的接口和参数组合）
+    min_ttl : 渲染之后至少使用多少秒，期间即使版本号变化也不重新渲染，单位s
+    """
+
+    def __init__(self, max_entries, min_ttl):
+        self.max_entries = max_entries
+        self.min_ttl = min_ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.render_locks = {} # 键 -> 渲染锁，同一个键同时只有一个线程渲染，其他线程等待结果
+        self.stats = dict(hits=0, misses=0, not_modified=0, evictions=0, render_seconds=0.0)
+
+    def _lookup(self, key, version):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry.version != version and time.time() - entry.created >= self.min_ttl:
+                return None
+            self.entries.move_to_end(key)
+            return entry
+
+    def get(self, key, version, render):
+        """
+        获取缓存的渲染结果，没有或者已经过期时调用render重新渲染
+        key : 缓存的键，需要包含所有影响渲染结果的参数
+        version : 当前的可用代理集合版本号
+        render : 无参数的函数，返回 (内容, mimetype)；抛出异常时不缓存
+        返回 : RenderedEntry
+        """
+        entry = self._lookup(key, version)
+        if entry is not None:
+            self.stats['hits'] += 1
+            return entry
+
+        with self.lock:
+            render_lock = self.render_locks.setdefault(key, threading.Lock())
+        try:
+            with render_lock:
+                # 等待其他线程渲染完毕之后再检查一次
+                entry = self._lookup(key, version)
+                if entry is not None:
+                    self.stats['hits'] += 1
+                    return entry
+                start = time.perf_counter()
+                body, mimetype = render()
+                entry = RenderedEntry(body, mimetype, version)
+                self.stats['render_seconds'] += time.perf_counter() - start
+                self.stats['misses'] += 1
+                with self.lock:
+                    old = self.entries.get(key)
+                    # 内容没有变化时保留原来的修改时间，If-Modified-Since仍然有效
+                    if old is not None and old.etag == entry.etag:
+                        entry.last_modified = old.last_modified
+                    self.entries[key] = entry
+                    self.entries.move_to_end(key)
+                    while len(self.entries) > self.max_entries:
+                        old_key, _ = self.entries.popitem(last=False)
+                        self.render_locks.pop(old_key, None)
+                        self.stats['evictions'] += 1
+            return entry
+        finally:
+            # 渲染失败（或者条目已经被淘汰）时没有对应的条目，删除渲染锁，避免不同参数的请求使锁越来越多
+            with self.lock:
+                if key not in self.entries:
+                    self.render_locks.pop(key, None)
+
+    def report(self):
+        """
+        返回缓存的状态
+        """
+        with self.lock:
+            size = len(self.entries)
+            total_bytes = sum(len(entry.body) for entry in self.entries.values())
+        stats = dict(self.stats)
+        stats['avg_render_ms'] = round(stats.pop('render_seconds') * 1000 / max(stats['misses'], 1), 3)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = round(stats['hits'] / lookups, 4) if lookups > 0 else 0
+        return dict(size=size, bytes=total_bytes, max_entries=self.max_entries, min_ttl=self.min_ttl, **stats)
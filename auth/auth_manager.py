@@ -4,6 +4,7 @@ import jwt
 import datetime
 import hashlib
 import os
+import copy
 import json
 from functools import wraps
 from flask import request, jsonify
@@ -22,6 +23,7 @@ class AuthManager:
         self.secret_key = secret_key
         self.token_expiration_hours = token_expiration_hours
         self.users_file = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'users.json')
+        self._users_cache = None  # (文件修改时间, 文件大小, 用户数据)，文件没有变化时不重新读取
         self._init_users_file()
     
     def _init_users_file(self):
@@ -43,10 +45,14 @@ class AuthManager:
         return hashlib.sha256(password.encode()).hexdigest()
     
     def _load_users(self):
-        """加载用户数据"""
+        """加载用户数据，返回的是副本，修改之后需要调用_save_users保存"""
         try:
-            with open(self.users_file, 'r', encoding='utf-8') as f:
-                return json.load(f)
+            st = os.stat(self.users_file)
+            cache = self._users_cache
+            if cache is None or cache[0] != st.st_mtime_ns or cache[1] != st.st_size:
+                with open(self.users_file, 'r', encoding='utf-8') as f:
+                    cache = self._users_cache = (st.st_mtime_ns, st.st_size, json.load(f))
+            return copy.deepcopy(cache[2])
         except Exception as e:
             print(f"[Auth] 加载用户数据失败: {e}")
             return {}
@@ -56,6 +62,7 @@ class AuthManager:
         try:
             with open(self.users_file, 'w', encoding='utf-8') as f:
                 json.dump(users, f, indent=2, ensure_ascii=False)
+            self._users_cache = None
             return True
         except Exception as e:
             print(f"[Auth] 保存用户数据失败: {e}")
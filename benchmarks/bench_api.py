@@ -0,0 +1,150 @@
+# encoding: utf-8
+"""
+API服务器的负载测试
+对于每个进程数，在本机启动一个API服务器（api.serve，使用当前的数据库），用多个客户端进程保持连接（keep-alive）并发请求，
+统计吞吐量以及延迟的中位数和P99
+客户端与服务器运行在同一台机器上，会互相争抢CPU；需要准确的数据时，可以只用本脚本启动服务器（--serve），
+在另一台机器上用wrk等工具测试，例如：
+    wrk -t4 -c64 -d30s -H "Authorization: Bearer <token>" http://<host>:5099/fetch_random
+
+用法（在项目根目录下运行）：
+    python benchmarks/bench_api.py [进程数 ...] [--path /fetch_random] [--duration 10] [--clients 4] [--threads 16]
+    python benchmarks/bench_api.py --serve 4    # 只启动4个进程的服务器，打印token，按Ctrl+C结束
+默认使用gunicorn测试 1 2 4 8 个进程，--server flask 可以测试Flask自带的开发服务器
+"""
+
+import os
+import sys
+import time
+import argparse
+import threading
+import subprocess
+import http.client
+import multiprocessing
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.append(ROOT)
+
+
+def make_token():
+    from config import auth_manager
+    return auth_manager.generate_token('admin', 'admin')
+
+
+def start_server(server, workers, threads, port):
+    code = (f'import sys; sys.path.insert(0, {ROOT!r}); from api import api; '
+            f'api.serve("127.0.0.1", {port}, {server!r}, {workers}, {threads})')
+    proc = subprocess.Popen([sys.executable, '-c', code], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            c = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            c.request('GET', '/ping')
+            if c.getresponse().status == 200:
+                c.close()
+                return proc
+        except OSError:
+            time.sleep(0.2)
+    proc.kill()
+    raise RuntimeError('API服务器没有启动')
+
+
+def _client(port, path, token, duration, threads, queue):
+    """
+    一个客户端进程，threads个线程各自保持一个连接，不断发送请求
+    """
+    headers = {'Authorization': f'Bearer {token}'}
+    results = []
+    stop = time.perf_counter() + duration
+
+    def run():
+        latencies, errors = [], 0
+        c = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+        while time.perf_counter() < stop:
+            start = time.perf_counter()
+            try:
+                c.request('GET', path, headers=headers)
+                r = c.getresponse()
+                r.read()
+                if r.status != 200:
+                    errors += 1
+                if r.getheader('Connection', '').lower() == 'close':
+                    c.close()
+            except (OSError, http.client.HTTPException):
+                errors += 1
+                c.close()
+                continue
+            latencies.append(time.perf_counter() - start)
+        c.close()
+        results.append((latencies, errors))
+
+    workers = [threading.Thread(target=run) for _ in range(threads)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    queue.put(([x for lat, _ in results for x in lat], sum(e for _, e in results)))
+
+
+def load(port, path, token, duration, clients, threads):
+    queue = multiprocessing.Queue()
+    procs = [multiprocessing.Process(target=_client, args=(port, path, token, duration, threads, queue)) for _ in range(clients)]
+    for p in procs:
+        p.start()
+    latencies, errors = [], 0
+    for _ in procs:
+        lat, err = queue.get()
+        latencies += lat
+        errors += err
+    for p in procs:
+        p.join()
+    latencies.sort()
+    n = len(latencies)
+    return dict(
+        rps=n / duration,
+        p50=latencies[n // 2] * 1000 if n else 0,
+        p99=latencies[min(int(n * 0.99), n - 1)] * 1000 if n else 0,
+        errors=errors
+    )
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('workers', nargs='*', type=int, default=[1, 2, 4, 8])
+    parser.add_argument('--server', default='gunicorn')
+    parser.add_argument('--server-threads', type=int, default=8)
+    parser.add_argument('--port', type=int, default=5099)
+    parser.add_argument('--path', default='/fetch_random')
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--clients', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--serve', type=int, default=None)
+    args = parser.parse_args(argv)
+    token = make_token()
+    if args.server == 'flask':
+        args.workers = [1] # Flask自带的开发服务器只有一个进程
+
+    if args.serve is not None:
+        proc = start_server(args.server, args.serve, args.server_threads, args.port)
+        print(f'服务器已启动：http://127.0.0.1:{args.port}，token：{token}')
+        try:
+            proc.wait()
+        except KeyboardInterrupt:
+            proc.terminate()
+        return 0
+
+    print(f'{args.server}，{args.path}，{args.clients}个客户端进程x{args.threads}个连接，每次{args.duration}s，CPU数量：{os.cpu_count()}')
+    for workers in args.workers:
+        proc = start_server(args.server, workers, args.server_threads, args.port)
+        try:
+            load(args.port, args.path, token, 1, args.clients, args.threads) # 预热，创建可用代理索引等
+            r = load(args.port, args.path, token, args.duration, args.clients, args.threads)
+        finally:
+            proc.terminate()
+            proc.wait()
+        print(f'  {workers}个进程: {r["rps"]:10.1f} 请求/s  P50 {r["p50"]:8.2f} ms  P99 {r["p99"]:8.2f} ms  错误 {r["errors"]}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
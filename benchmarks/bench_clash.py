@@ -0,0 +1,134 @@
+# encoding: utf-8
+"""
+Clash 订阅配置生成的正确性检查和性能测试
+检查：用 api/clash_yaml.py 生成配置，再用 yaml.safe_load 解析，结果必须与原始数据完全相同，
+      代理名称中包含emoji、冒号、引号、反斜杠、控制字符、YAML关键字等各种需要转义的内容
+性能：比较 yaml.dump（原来的方式）和 clash_yaml.dump 生成完整配置的耗时以及输出大小
+
+用法（在项目根目录下运行）：
+    python benchmarks/bench_clash.py [节点数量 ...]
+    python benchmarks/bench_clash.py --check    # 只进行正确性检查（CI中运行）
+默认测试 1000 10000 50000
+"""
+
+import os
+import sys
+import time
+import random
+
+import yaml
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from api import clash_yaml
+
+COUNTRIES = [('🇺🇸', '美国'), ('🇯🇵', '日本'), ('🇭🇰', '香港'), ('🇩🇪', '德国'), ('🌍', '未知地区')]
+
+# 需要特殊处理的名称
+TRICKY_NAMES = [
+    '', ' ', ' leading space', 'trailing space ', 'a: b', 'a:b', 'key: value # comment', '#comment',
+    '- dash', '-', '? question', ': colon', '* alias', '&anchor', '!tag', '%directive', '@at', '`backtick',
+    '|literal', '>folded', '{flow}', '[list]', 'a, b', "'single'", '"double"', 'back\\slash', '\\"',
+    'null', 'Null', '~', 'true', 'yes', 'No', 'on', 'off', '1', '1.0', '1.2.3.4', '0x1F', '0o17', '.inf', '.nan',
+    '1e3', '2001:db8::1', '12:30:45', 'line\nbreak', 'tab\there', 'cr\rhere', 'nul\x00here', 'bell\x07',
+    'del\x7f', 'nel\x85', 'nbsp\xa0', 'ls\u2028ps\u2029', 'bom\ufeff', 'nonchar\ufffe\uffff', '中文: 名称',
+    '🇺🇸 美国_1.2.3.4', '👨\u200d👩\u200d👧 family', 'emoji 😀 smile', '=', '<<', '---', '...',
+]
+
+
+def make_nodes(n, tricky=False):
+    """
+    生成n个代理节点，tricky为True时名称、服务器地址和账号密码中会混入TRICKY_NAMES
+    """
+    nodes = []
+    for i in range(n):
+        ip = f'{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}.{random.randint(1, 254)}'
+        emoji, country = COUNTRIES[i % len(COUNTRIES)]
+        name = f'{emoji} {country}_{ip}'
+        if tricky:
+            name = TRICKY_NAMES[i % len(TRICKY_NAMES)] + f'_{i}'
+        node = {
+            'name': name,
+            'type': 'http' if i % 2 == 0 else 'socks5',
+            'server': ip if not tricky else TRICKY_NAMES[(i + 7) % len(TRICKY_NAMES)],
+            'port': random.randint(1, 65535)
+        }
+        if i % 5 == 0:
+            node['username'] = f'user{i}' if not tricky else TRICKY_NAMES[(i + 3) % len(TRICKY_NAMES)]
+            node['password'] = f'pass:{i}#' if not tricky else TRICKY_NAMES[(i + 5) % len(TRICKY_NAMES)]
+        nodes.append(node)
+    return nodes
+
+
+def check():
+    """
+    检查生成的YAML解析之后与原始数据相同
+    返回 : 是否通过
+    """
+    ok = True
+    cases = [
+        ('普通节点', clash_yaml.build_config(make_nodes(200))),
+        ('特殊名称', clash_yaml.build_config(make_nodes(len(TRICKY_NAMES) * 3, tricky=True))),
+        ('只有节点列表', {'proxies': make_nodes(100, tricky=True)}),
+        ('proxy-provider', clash_yaml.build_provider_config(
+            'http://127.0.0.1:5000/clash/proxies?username=a%26b&c=US%2CJP', './proxy_providers/proxypool_0.yaml', 600)),
+        ('空列表', {'proxies': []}),
+    ]
+    for name, config in cases:
+        text = clash_yaml.dump(config)
+        try:
+            parsed = yaml.safe_load(text)
+        except yaml.YAMLError as e:
+            print(f'[FAIL] {name}：无法解析：{e}')
+            ok = False
+            continue
+        if parsed != config:
+            print(f'[FAIL] {name}：解析结果与原始数据不同')
+            for key in config:
+                if parsed.get(key) != config[key]:
+                    print(f'         字段{key}不同')
+            ok = False
+        else:
+            print(f'[ OK ] {name}')
+    for s in TRICKY_NAMES:
+        if yaml.safe_load(f'x: {clash_yaml.quote(s)}')['x'] != s:
+            print(f'[FAIL] 字符串 {s!r}')
+            ok = False
+    return ok
+
+
+def timeit(func, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1000, result
+
+
+def bench(n):
+    config = clash_yaml.build_config(make_nodes(n))
+    repeat = 3 if n <= 10000 else 1
+    print(f'{n}个节点（取{repeat}次中最快的一次）：')
+    ms, text = timeit(lambda: yaml.dump(config, allow_unicode=True, default_flow_style=False, sort_keys=False), repeat)
+    print(f'  yaml.dump        : {ms:10.2f} ms  {len(text.encode("utf-8")) / 1024:10.1f} KB')
+    if getattr(yaml, '__with_libyaml__', False):
+        ms, text = timeit(lambda: yaml.dump(config, Dumper=yaml.CDumper, allow_unicode=True, default_flow_style=False, sort_keys=False), repeat)
+        print(f'  yaml.dump(C)     : {ms:10.2f} ms  {len(text.encode("utf-8")) / 1024:10.1f} KB')
+    ms, text = timeit(lambda: clash_yaml.dump(config), repeat)
+    print(f'  clash_yaml.dump  : {ms:10.2f} ms  {len(text.encode("utf-8")) / 1024:10.1f} KB')
+
+
+def main(argv):
+    if '--check' in argv:
+        return 0 if check() else 1
+    if not check():
+        return 1
+    sizes = [int(x) for x in argv] if argv else [1000, 10000, 50000]
+    for n in sizes:
+        bench(n)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
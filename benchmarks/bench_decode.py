@@ -0,0 +1,104 @@
+# encoding: utf-8
+"""
+读取代理并解析为Proxy的性能测试
+在临时数据库中生成指定数量的代理，分别以文本和epoch毫秒（DB_EPOCH_TIMESTAMPS）两种格式保存时间字段，比较：
+    fetchall        : 只执行 SELECT * 并读取所有行，不解析
+    decode          : 读取并解析为Proxy（时间字段保持原始值）
+    decode+to_dict  : 再调用to_dict，此时才转换时间字段，相当于API返回全部代理时的开销
+文本格式另外测试使用 PARSE_DECLTYPES 的连接（原来的方式，读取每一行时都会转换时间字段）
+
+用法（在项目根目录下运行）：
+    python benchmarks/bench_decode.py [数据量 ...]
+默认测试 10000 100000
+"""
+
+import os
+import sys
+import time
+import random
+import sqlite3
+import datetime
+import tempfile
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from db.Proxy import Proxy
+from db.timestamps import to_epoch_ms, to_text
+
+# params()中时间字段的位置
+DATE_COLUMNS = (6, 7, 9)
+
+
+def create_db(path, n, epoch):
+    """
+    生成包含n个代理的数据库
+    epoch : 时间字段是否以epoch毫秒保存
+    """
+    convert = to_epoch_ms if epoch else to_text
+    c = sqlite3.connect(path)
+    for sql in Proxy.ddls:
+        c.execute(sql)
+    now = datetime.datetime.now()
+    rows = []
+    for i in range(n):
+        p = Proxy()
+        p.fetcher_name = 'bench'
+        p.protocol = ('http', 'https', 'socks4', 'socks5')[i % 4]
+        p.ip = f'{i >> 24 & 255}.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}'
+        p.port = 8080
+        p.validated = True
+        p.latency = random.randint(50, 5000)
+        p.validate_date = now - datetime.timedelta(seconds=random.randint(0, 3600))
+        p.to_validate_date = now + datetime.timedelta(seconds=random.randint(0, 3600))
+        p.country = 'CN'
+        row = list(p.params())
+        for j in DATE_COLUMNS:
+            row[j] = convert(row[j])
+        rows.append(row)
+    c.executemany('INSERT INTO proxies VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)', rows)
+    c.commit()
+    c.close()
+
+
+def timeit(func, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1000
+
+
+def bench_conn(name, c, repeat):
+    sql = 'SELECT * FROM proxies'
+    fetch = timeit(lambda: c.execute(sql).fetchall(), repeat)
+    decode = timeit(lambda: [Proxy.decode(row) for row in c.execute(sql)], repeat)
+    to_dict = timeit(lambda: [Proxy.decode(row).to_dict() for row in c.execute(sql)], repeat)
+    print(f'  {name:<22}: fetchall {fetch:9.2f} ms   decode {decode:9.2f} ms   decode+to_dict {to_dict:9.2f} ms')
+
+
+def bench(n, repeat=5):
+    with tempfile.TemporaryDirectory() as tmp:
+        text_path = os.path.join(tmp, 'text.db')
+        epoch_path = os.path.join(tmp, 'epoch.db')
+        create_db(text_path, n, epoch=False)
+        create_db(epoch_path, n, epoch=True)
+        print(f'数据量{n}（取{repeat}次中最快的一次）：')
+        for name, path, detect_types in [
+            ('文本+PARSE_DECLTYPES', text_path, sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES),
+            ('文本', text_path, 0),
+            ('epoch毫秒', epoch_path, 0),
+        ]:
+            c = sqlite3.connect(path, detect_types=detect_types)
+            bench_conn(name, c, repeat)
+            c.close()
+
+
+def main(argv):
+    sizes = [int(x) for x in argv] if argv else [10000, 100000]
+    for n in sizes:
+        bench(n)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
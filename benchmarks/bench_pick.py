@@ -0,0 +1,149 @@
+# encoding: utf-8
+"""
+可用代理索引（api/pool_index.py）选择策略的正确性检查和性能测试
+检查：weighted策略下每个代理被选中的频率与权重成正比，round_robin策略每一轮恰好选中每个代理一次，
+      fastest策略只选择延迟最低的几个代理，acquire（租约）不会重复选中没有归还的代理
+性能：各个策略每次选择的耗时，以及分组变化之后重新构建别名表的耗时
+
+用法（在项目根目录下运行）：
+    python benchmarks/bench_pick.py [代理数量 ...]
+    python benchmarks/bench_pick.py --check    # 只进行正确性检查（CI中运行）
+默认测试 1000 10000 100000
+"""
+
+import os
+import sys
+import time
+import random
+from collections import Counter
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from db.Proxy import Proxy
+from api import pool_index
+from api.pool_index import ProxyPoolIndex, STRATEGIES
+
+
+def make_index(n):
+    """
+    生成包含n个代理的索引，不读取数据库
+    """
+    index = ProxyPoolIndex(max_staleness=1e9, refresh_interval=1e9, full_resync_interval=1e9)
+    for i in range(n):
+        p = Proxy()
+        p.protocol = 'http' if i % 2 == 0 else 'socks5'
+        p.ip = f'10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}'
+        p.port = 8080
+        p.validated = True
+        p.latency = random.randint(20, 5000)
+        p.country_code = 'US'
+        index._add(index.proxies, index.partitions, p)
+    index.last_refresh_time = time.time()
+    return index
+
+
+def check():
+    """
+    返回 : 是否通过
+    """
+    ok = True
+    index = make_index(50)
+    # 记录一些验证结果，使权重不只取决于延迟
+    for key in list(index.proxies)[:10]:
+        index._record(key, False, None)
+    index.partitions[(None, None)].dirty = True
+    keys = index.partitions[(None, None)].items
+    weights = {key: index._weight(index.proxies[key].latency, index.history.get(key)) for key in keys}
+    total = sum(weights.values())
+
+    # 比较选中频率与权重之间的总变差距离，200000次选择时随机误差大约为0.006
+    draws = 200000
+    cnt = Counter((p.protocol, p.ip, p.port) for p in (index.pick(strategy='weighted') for _ in range(draws)))
+    distance = sum(abs(cnt[key] / draws - w / total) for key, w in weights.items()) / 2
+    if distance > 0.02:
+        print(f'[FAIL] weighted：选中频率与权重的总变差距离为{distance:.4f}')
+        ok = False
+    else:
+        print(f'[ OK ] weighted：选中频率与权重的总变差距离为{distance:.4f}')
+
+    picked = Counter((p.protocol, p.ip, p.port) for p in (index.pick(strategy='round_robin') for _ in range(len(keys) * 3)))
+    if set(picked) != set(keys) or set(picked.values()) != {3}:
+        print('[FAIL] round_robin：没有轮流选中每个代理')
+        ok = False
+    else:
+        print('[ OK ] round_robin')
+
+    fastest = set(sorted(keys, key=lambda key: index.proxies[key].latency)[:pool_index._FASTEST_TOP])
+    picked = set((p.protocol, p.ip, p.port) for p in (index.pick(strategy='fastest') for _ in range(1000)))
+    if not picked <= fastest:
+        print('[FAIL] fastest：选中了延迟不是最低的代理')
+        ok = False
+    else:
+        print('[ OK ] fastest')
+
+    # 删除代理之后别名表重新构建，不会再选中被删除的代理
+    removed = keys[0]
+    index.discard(*removed)
+    if any((p.protocol, p.ip, p.port) == removed for p in (index.pick(strategy='weighted') for _ in range(5000))):
+        print('[FAIL] discard：删除之后仍然被选中')
+        ok = False
+    else:
+        print('[ OK ] discard')
+
+    # 所有代理都被租用之后acquire返回None，归还之后可以再次选中
+    acquired = []
+    while True:
+        p = index.acquire('http', strategy='weighted')
+        if p is None:
+            break
+        acquired.append((p.protocol, p.ip, p.port))
+    expected = set(index.partitions[('http', None)].items)
+    if len(acquired) != len(set(acquired)) or set(acquired) != expected:
+        print('[FAIL] acquire：重复选中了没有归还的代理，或者没有选中全部代理')
+        ok = False
+    else:
+        index.release(*acquired[0])
+        p = index.acquire('http')
+        if p is None or (p.protocol, p.ip, p.port) != acquired[0]:
+            print('[FAIL] release：归还的代理没有被再次选中')
+            ok = False
+        else:
+            print('[ OK ] acquire/release')
+
+    if index.pick('socks4', strategy='weighted') is not None:
+        print('[FAIL] 不存在的分组应该返回None')
+        ok = False
+    return ok
+
+
+def bench(n):
+    index = make_index(n)
+    repeat = 100000
+    print(f'{n}个代理（每种策略选择{repeat}次）：')
+    for strategy in STRATEGIES:
+        index.pick(strategy=strategy)
+        start = time.perf_counter()
+        for _ in range(repeat):
+            index.pick(strategy=strategy)
+        elapsed = time.perf_counter() - start
+        print(f'  {strategy:12}: {elapsed * 1e6 / repeat:8.2f} us/次')
+    s = index.partitions[(None, None)]
+    s.dirty = True
+    start = time.perf_counter()
+    with index.lock:
+        index._prepare(s)
+    print(f'  重新构建别名表: {(time.perf_counter() - start) * 1000:8.2f} ms')
+
+
+def main(argv):
+    if '--check' in argv:
+        return 0 if check() else 1
+    if not check():
+        return 1
+    sizes = [int(x) for x in argv] if argv else [1000, 10000, 100000]
+    for n in sizes:
+        bench(n)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,99 @@
+# encoding: utf-8
+"""
+随机获取可用代理的性能测试
+在临时数据库中生成指定数量的代理（一半通过了验证），比较以下几种方式随机获取k个代理的耗时：
+    order_by_random : SELECT ... ORDER BY RANDOM() LIMIT k（原来的小数据量方式）
+    validate_date   : SELECT ... ORDER BY validate_date DESC LIMIT k（原来的大数据量方式，并不随机）
+    sampler         : db.sampling.ValidatedSampler（当前的实现，不包括定期重新读取rowid数组的耗时，该耗时单独列出）
+并统计sampler在小数据量下每个代理被抽中的次数，检查是否均匀
+
+用法（在项目根目录下运行）：
+    python benchmarks/bench_sampling.py [数据量 ...]
+默认测试 10000 100000 1000000
+"""
+
+import os
+import sys
+import time
+import random
+import sqlite3
+import datetime
+import tempfile
+from collections import Counter
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from db.Proxy import Proxy
+from db.sampling import ValidatedSampler
+
+PROTOCOLS = ['http', 'https', 'socks4', 'socks5']
+
+
+def create_db(path, n):
+    """
+    生成包含n个代理的数据库，其中一半通过了验证
+    """
+    c = sqlite3.connect(path, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
+    c.execute('PRAGMA journal_mode=WAL')
+    for sql in Proxy.ddls:
+        c.execute(sql)
+    now = datetime.datetime.now()
+    rows = []
+    for i in range(n):
+        p = Proxy()
+        p.fetcher_name = 'bench'
+        p.protocol = PROTOCOLS[i % len(PROTOCOLS)]
+        p.ip = f'{i >> 24 & 255}.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}'
+        p.port = 8080
+        p.validated = random.random() < 0.5
+        p.validate_date = now - datetime.timedelta(seconds=random.randint(0, 3600))
+        p.to_validate_date = now
+        rows.append(p.params())
+    c.executemany('INSERT INTO proxies VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)', rows)
+    c.commit()
+    return c
+
+
+def timeit(func, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def bench(n, k=10, repeat=20):
+    with tempfile.TemporaryDirectory() as tmp:
+        c = create_db(os.path.join(tmp, 'bench.db'), n)
+        sampler = ValidatedSampler(refresh_interval=3600)
+        sampler.sample(c, k)
+        print(f'数据量{n}，每次获取{k}个：')
+        print(f'  order_by_random : {timeit(lambda: c.execute("SELECT * FROM proxies WHERE validated=? ORDER BY RANDOM() LIMIT ?", (True, k)).fetchall(), repeat):.3f} ms')
+        print(f'  validate_date   : {timeit(lambda: c.execute("SELECT * FROM proxies WHERE validated=? ORDER BY validate_date DESC LIMIT ?", (True, k)).fetchall(), repeat):.3f} ms')
+        print(f'  sampler         : {timeit(lambda: sampler.sample(c, k), repeat):.3f} ms')
+        print(f'  sampler(socks5) : {timeit(lambda: sampler.sample(c, k, "socks5"), repeat):.3f} ms')
+        print(f'  读取rowid数组   : {sampler.report()["load_ms"]:.3f} ms')
+        c.close()
+
+
+def check_uniform(n=100, k=5, rounds=20000):
+    with tempfile.TemporaryDirectory() as tmp:
+        c = create_db(os.path.join(tmp, 'uniform.db'), n)
+        sampler = ValidatedSampler(refresh_interval=3600)
+        counter = Counter()
+        for _ in range(rounds):
+            counter.update(p.ip for p in sampler.sample(c, k))
+        validated = c.execute('SELECT count(*) FROM proxies WHERE validated=?', (True,)).fetchone()[0]
+        expected = rounds * k / validated
+        print(f'均匀性：{validated}个可用代理，抽样{rounds}次，每次{k}个，期望每个代理被抽中{expected:.0f}次，'
+              f'实际最少{min(counter.values())}次，最多{max(counter.values())}次，被抽中的代理{len(counter)}个')
+        c.close()
+
+
+def main(argv):
+    sizes = [int(x) for x in argv] if argv else [10000, 100000, 1000000]
+    for n in sizes:
+        bench(n)
+    check_uniform()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
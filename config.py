@@ -9,6 +9,56 @@ import os
 
 # 数据库文件路径
 DATABASE_PATH = os.path.join(os.path.dirname(__file__), 'data.db')
+# 是否使用单独的数据库写入进程：
+# 启用后，爬取器、验证器、API进程的写操作都通过队列交给写入进程批量执行，各进程之间不再使用进程锁，
+# 读操作不会被其他进程的写入阻塞；写操作改为异步执行，写入数据库之前会有短暂的延迟
+DB_WRITER_MODE = False
+DB_WRITER_BATCH_SIZE = 1000 # 写入进程每个事务最多执行多少个写操作
+# 只读连接池的大小，API等进程的查询使用连接池中的只读连接，不需要获取进程锁，设置为0则所有查询都使用加锁的全局连接
+DB_READ_POOL_SIZE = 8
+DB_SAMPLE_REFRESH_INTERVAL = 10 # 随机获取可用代理时，可用代理列表（rowid数组）最多多久重新读取一次，单位s
+# 时间字段是否以整数（epoch毫秒）存储，默认以文本存储；修改之后启动时会自动转换已有的数据，也可以手动运行 python -m db.migrate_timestamps
+DB_EPOCH_TIMESTAMPS = False
+
+# API进程在内存中保存所有可用代理的索引，随机获取代理时不需要查询数据库
+API_POOL_INDEX = True
+API_POOL_REFRESH_INTERVAL = 5 # 后台增量刷新的间隔，单位s
+API_POOL_MAX_STALENESS = 30 # 索引最多允许多久没有刷新，超过之后获取代理时会先同步刷新，单位s
+API_POOL_FULL_RESYNC_INTERVAL = 10 * 60 # 全量刷新的间隔，单位s
+# API服务器：flask（Flask自带的开发服务器，单进程，默认）或者gunicorn（多进程，每个进程多个线程，需要另外安装，不支持Windows）
+# 选择gunicorn但是没有安装或者在Windows上运行时，自动使用flask
+API_SERVER = 'flask'
+API_WORKERS = 1 # gunicorn的进程数；每个进程有各自的可用代理索引、订阅缓存、租约和反馈汇总，多个进程时租约只在同一个进程内互不重复
+API_THREADS = 8 # gunicorn每个进程的线程数
+# /fetch_random 等接口默认的选择策略：uniform（均匀随机）、weighted（按延迟和最近的验证结果加权随机）、fastest（延迟最低的几个中随机）、round_robin（轮流），可以用参数 strategy 指定
+API_PICK_STRATEGY = 'uniform'
+# 订阅接口（/clash、/clash/proxies、/v2ray）的渲染缓存，可用代理发生变化之后重新渲染，设置为0则不缓存
+SUBSCRIPTION_CACHE_SIZE = 64 # 最多缓存多少种不同参数的渲染结果
+SUBSCRIPTION_CACHE_MIN_TTL = 10 # 渲染之后至少使用多久，期间可用代理发生变化也不重新渲染，单位s
+# /clash 默认是否使用 proxy-provider 模式：配置中不包含代理节点，而是让客户端从 /clash/proxies 下载，可以用参数 provider=0/1 指定
+CLASH_PROXY_PROVIDER = False
+CLASH_PROVIDER_INTERVAL = 10 * 60 # proxy-provider 模式下客户端更新节点列表的间隔，单位s
+# 客户端反馈（POST /report）：客户端上报使用代理的结果，汇总之后定期写入数据库
+FEEDBACK_FLUSH_INTERVAL = 5 # 写入数据库的间隔，单位s
+FEEDBACK_FAIL_THRESHOLD = 3 # 一个代理的失败反馈达到多少次时，标记为不可用并立即重新验证
+FEEDBACK_FAIL_RATIO = 0.5 # 同时失败反馈占这个代理所有反馈的比例至少为多少
+FEEDBACK_WINDOW = 5 * 60 # 没有达到阈值的失败反馈最多保留多久，单位s
+FEEDBACK_MAX_BATCH = 1000 # 一次请求最多上报多少条反馈
+# 代理租约（/lease/checkout）：租约有效期内同一个代理不会分配给其他调用方
+LEASE_DEFAULT_TTL = 5 * 60 # 默认的租约时长，单位s
+LEASE_MAX_TTL = 60 * 60 # 最长的租约时长，单位s
+LEASE_MAX_COUNT = 100 # 一次最多获取多少个代理
+# 代理网关：同一个端口同时作为HTTP代理（CONNECT）和SOCKS5代理，每个连接从可用代理中随机选择一个上游代理转发
+# 网关没有认证，默认关闭；开启后默认只监听本机，监听其他地址时请通过防火墙等方式限制访问
+GATEWAY_ENABLE = False
+GATEWAY_HOST = '127.0.0.1'
+GATEWAY_PORT = 7899
+GATEWAY_MAX_CONNECTIONS = 1000 # 同时处理的客户端连接数上限
+GATEWAY_CONNECT_TIMEOUT = 5 # 连接一个上游代理并完成握手的超时时间，单位s
+GATEWAY_CONNECT_BUDGET = 15 # 每个客户端连接选择上游代理的总时间预算，连接失败时在预算内换一个上游代理重试，单位s
+GATEWAY_MAX_ATTEMPTS = 5 # 每个客户端连接最多尝试多少个上游代理
+GATEWAY_IDLE_TIMEOUT = 5 * 60 # 连接空闲多久之后关闭，单位s
+GATEWAY_BUFFER_SIZE = 64 * 1024 # 转发数据时每个方向的缓冲区大小，单位字节
 
 # 每次运行所有爬取器之后，睡眠多少时间，单位秒
 PROC_FETCHER_SLEEP = 5 * 60
@@ -17,7 +67,9 @@ PROC_FETCHER_SLEEP = 5 * 60
 PROC_VALIDATOR_SLEEP = 5
 
 # 验证器的配置参数
-VALIDATE_THREAD_NUM = 200 # 验证线程数量
+VALIDATE_ENGINE = 'thread' # 验证引擎，可选：thread（多线程）、async（asyncio事件循环）
+VALIDATE_THREAD_NUM = 200 # 验证线程数量，仅用于thread引擎
+VALIDATE_ASYNC_CONCURRENCY = 2000 # 同时进行验证的代理数量上限，仅用于async引擎
 # 验证器的逻辑是：
 # 使用代理访问 VALIDATE_URL 网站，超时时间设置为 VALIDATE_TIMEOUT
 # 如果没有超时：
@@ -30,6 +82,30 @@ VALIDATE_HEADER = 'location' # 仅用于HEAD验证方式，百度响应头Server
 VALIDATE_KEYWORD = 'www.qq.com'
 VALIDATE_TIMEOUT = 5 # 超时时间，单位s
 VALIDATE_MAX_FAILS = 3
+VALIDATE_PROXY_BUDGET = VALIDATE_TIMEOUT * VALIDATE_MAX_FAILS # 每个代理所有验证尝试的总时间预算，用完后不再重试，单位s
+
+# 预检查：在上述验证之前，先以较短的超时时间尝试连接代理服务器
+# 连接被拒绝、连接超时或者代理协议握手失败的代理，直接认为验证失败，不再进行上述验证
+VALIDATE_PRECHECK = True
+VALIDATE_PRECHECK_HANDSHAKE = True # 是否进行代理协议握手（HTTP CONNECT / SOCKS4 / SOCKS5）
+VALIDATE_PRECHECK_TIMEOUT = 3 # 预检查超时时间，单位s
+VALIDATE_PRECHECK_CONCURRENCY = 1000 # 同时进行预检查的连接数上限，仅用于thread引擎
+
+# 验证结果先缓存在内存中，攒够一批或者超过一定时间之后，在一个事务中写入数据库
+VALIDATE_SINK_BATCH_SIZE = 500 # 每批最多写入多少个验证结果
+VALIDATE_SINK_FLUSH_INTERVAL = 2 # 验证结果在内存中最多停留多少时间，单位s
+
+# 验证成功但是缺少国家和地址信息的代理，会在后台线程中查询IP地理位置并批量写回数据库
+GEO_ENRICH_RATE_PER_MINUTE = 45 # 每分钟最多调用多少次地理位置查询接口（ip-api.com 免费限制为45次/分钟）
+GEO_ENRICH_QUEUE_SIZE = 10000 # 等待查询的IP数量上限，超过之后新的IP会被丢弃，下次验证成功时再次加入
+GEO_ENRICH_BATCH_SIZE = 50 # 攒够多少个查询结果写入一次数据库
+GEO_ENRICH_FLUSH_INTERVAL = 10 # 查询结果在内存中最多停留多少时间，单位s
+# 离线IP数据库，存在时优先使用，查询不到时才访问网络接口
+# 可以使用 python -m utils.geoip_db convert <输入.csv> geoip.dat 从CSV文件生成
+GEOIP_DB_PATH = os.path.join(os.path.dirname(__file__), 'geoip.dat')
+# 网络接口查询到的地理位置会缓存在内存中，并保存到数据库的ip_locations表，重启之后仍然有效
+IP_LOCATION_CACHE_SIZE = 50000 # 内存中最多缓存多少个IP，超过之后淘汰最久没有使用的
+IP_LOCATION_CACHE_TTL = 7 * 24 * 3600 # 缓存有效期，单位s
 
 # ============= 认证配置 =============
 
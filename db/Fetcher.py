@@ -1,6 +1,7 @@
 # encoding: utf-8
 
 import datetime
+from .timestamps import to_datetime
 
 class Fetcher(object):
     """
@@ -59,5 +60,5 @@ class Fetcher(object):
         f.enable = bool(row[1])
         f.sum_proxies_cnt = row[2]
         f.last_proxies_cnt = row[3]
-        f.last_fetch_date = row[4]
+        f.last_fetch_date = to_datetime(row[4])
         return f
@@ -1,12 +1,46 @@
 # encoding: utf-8
 
+import time
 import datetime
 import random
+from .timestamps import to_datetime, to_display_text, minute_sql
+
+_NEW_MINUTE = minute_sql('NEW.to_validate_date')
+_OLD_MINUTE = minute_sql('OLD.to_validate_date')
+# proxies_changes中最多保留的变更记录数
+CHANGES_KEEP = 10000
+
+def _lazy_date(name):
+    """
+    时间属性，数据库中读取到的原始值（文本或者epoch毫秒）在第一次访问时才转换为datetime
+    """
+    attr = '_' + name
+    def getter(self):
+        value = getattr(self, attr)
+        if value is not None and value.__class__ is not datetime.datetime:
+            value = to_datetime(value)
+            setattr(self, attr, value)
+        return value
+    def setter(self, value):
+        setattr(self, attr, value)
+    return property(getter, setter)
+
 class Proxy(object):
     """
     代理，用于表示数据库中的一个记录
+    使用__slots__，时间属性在用到时才转换为datetime，以减少读取大量代理时的开销
     """
 
+    __slots__ = (
+        'fetcher_name', 'protocol', 'ip', 'port', 'validated', 'latency',
+        '_validate_date', '_to_validate_date', 'validate_failed_cnt', '_created_date',
+        'country', 'address', 'username', 'password', 'country_code'
+    )
+
+    validate_date = _lazy_date('validate_date')
+    to_validate_date = _lazy_date('to_validate_date')
+    created_date = _lazy_date('created_date')
+
     ddls = ["""
     CREATE TABLE IF NOT EXISTS proxies
     (
@@ -24,6 +58,7 @@ class Proxy(object):
         address VARCHAR(255),
         username VARCHAR(100),
         password VARCHAR(100),
+        country_code VARCHAR(2),
         PRIMARY KEY (protocol, ip, port)
     )
     """,
@@ -34,8 +69,157 @@ class Proxy(object):
     """
     CREATE INDEX IF NOT EXISTS proxies_to_validate_date_index
     ON proxies(to_validate_date ASC)
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS proxies_validate_date_index
+    ON proxies(validate_date ASC)
+    """,
+    # 以下索引对应conn.py中的常用查询，可以运行 python -m db.query_plan 检查各个查询是否使用了索引
+    # 部分索引（WHERE validated=1）只有在查询中也写明 validated=1 时才会被使用，不能使用参数
+    """
+    CREATE INDEX IF NOT EXISTS proxies_validated_to_validate_date_index
+    ON proxies(to_validate_date ASC) WHERE validated=1
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS proxies_unvalidated_to_validate_date_index
+    ON proxies(to_validate_date ASC) WHERE validated=0
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS proxies_validated_protocol_index
+    ON proxies(protocol) WHERE validated=1
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS proxies_validated_validate_date_index
+    ON proxies(validate_date DESC) WHERE validated=1
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS proxies_ip_index
+    ON proxies(ip)
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS proxies_validated_country_code_index
+    ON proxies(country_code) WHERE validated=1
+    """]
+
+    # 代理数量的统计信息，通过触发器在写入proxies表时同时维护，getProxiesStatus直接读取，不需要count(*)
+    # 待验证的代理数量与当前时间有关，因此按照to_validate_date所在的分钟分别计数（proxies_pending_hist），
+    # 查询时累加当前分钟及之前的计数，是精确到分钟的近似值
+    # 第一次创建时由init.py根据已有的数据计算统计信息；触发器在每次启动时重新创建，修改之后对已有的数据库也会生效
+    # 时间字段可能是文本或者整数（见timestamps.py），所在的分钟由minute_sql计算
+    # 注意：触发器中不能使用INSERT OR IGNORE，外层语句的冲突处理方式（例如ON CONFLICT DO UPDATE）会覆盖触发器中的
+    stats_ddls = ["""
+    CREATE TABLE IF NOT EXISTS proxies_stats
+    (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        sum_cnt INTEGER NOT NULL,
+        validated_cnt INTEGER NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS proxies_pending_hist
+    (
+        minute INTEGER PRIMARY KEY,
+        cnt INTEGER NOT NULL
+    )
+    """,
+    'DROP TRIGGER IF EXISTS proxies_stats_insert',
+    f"""
+    CREATE TRIGGER proxies_stats_insert AFTER INSERT ON proxies
+    BEGIN
+        UPDATE proxies_stats SET sum_cnt = sum_cnt + 1, validated_cnt = validated_cnt + (NEW.validated = 1) WHERE id = 1;
+        INSERT INTO proxies_pending_hist SELECT {_NEW_MINUTE}, 0
+        WHERE NOT EXISTS (SELECT 1 FROM proxies_pending_hist WHERE minute = {_NEW_MINUTE});
+        UPDATE proxies_pending_hist SET cnt = cnt + 1 WHERE minute = {_NEW_MINUTE};
+    END
+    """,
+    'DROP TRIGGER IF EXISTS proxies_stats_delete',
+    f"""
+    CREATE TRIGGER proxies_stats_delete AFTER DELETE ON proxies
+    BEGIN
+        UPDATE proxies_stats SET sum_cnt = sum_cnt - 1, validated_cnt = validated_cnt - (OLD.validated = 1) WHERE id = 1;
+        UPDATE proxies_pending_hist SET cnt = cnt - 1 WHERE minute = {_OLD_MINUTE};
+        DELETE FROM proxies_pending_hist WHERE minute = {_OLD_MINUTE} AND cnt <= 0;
+    END
+    """,
+    'DROP TRIGGER IF EXISTS proxies_stats_update',
+    f"""
+    CREATE TRIGGER proxies_stats_update AFTER UPDATE OF validated, to_validate_date ON proxies
+    BEGIN
+        UPDATE proxies_stats SET validated_cnt = validated_cnt + (NEW.validated = 1) - (OLD.validated = 1) WHERE id = 1;
+        UPDATE proxies_pending_hist SET cnt = cnt - 1 WHERE minute = {_OLD_MINUTE};
+        DELETE FROM proxies_pending_hist WHERE minute = {_OLD_MINUTE} AND cnt <= 0;
+        INSERT INTO proxies_pending_hist SELECT {_NEW_MINUTE}, 0
+        WHERE NOT EXISTS (SELECT 1 FROM proxies_pending_hist WHERE minute = {_NEW_MINUTE});
+        UPDATE proxies_pending_hist SET cnt = cnt + 1 WHERE minute = {_NEW_MINUTE};
+    END
+    """,
+    # 可用代理集合的版本号：可用代理增加、减少，或者可用代理的国家、账号密码发生变化时加1，
+    # API进程据此判断订阅内容的缓存是否过期（见api/render_cache.py）
+    """
+    CREATE TABLE IF NOT EXISTS proxies_version
+    (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        version INTEGER NOT NULL
+    )
+    """,
+    'INSERT INTO proxies_version SELECT 1, 0 WHERE NOT EXISTS (SELECT 1 FROM proxies_version)',
+    'DROP TRIGGER IF EXISTS proxies_version_insert',
+    """
+    CREATE TRIGGER proxies_version_insert AFTER INSERT ON proxies WHEN NEW.validated = 1
+    BEGIN
+        UPDATE proxies_version SET version = version + 1 WHERE id = 1;
+    END
+    """,
+    'DROP TRIGGER IF EXISTS proxies_version_delete',
+    """
+    CREATE TRIGGER proxies_version_delete AFTER DELETE ON proxies WHEN OLD.validated = 1
+    BEGIN
+        UPDATE proxies_version SET version = version + 1 WHERE id = 1;
+    END
+    """,
+    'DROP TRIGGER IF EXISTS proxies_version_update',
+    """
+    CREATE TRIGGER proxies_version_update AFTER UPDATE OF validated, country, username, password ON proxies
+    WHEN NEW.validated != OLD.validated OR (NEW.validated = 1 AND (
+        NEW.country IS NOT OLD.country OR NEW.username IS NOT OLD.username OR NEW.password IS NOT OLD.password))
+    BEGIN
+        UPDATE proxies_version SET version = version + 1 WHERE id = 1;
+    END
+    """,
+    # 可用代理的国家、账号密码的变更记录：这些变化（补全地理位置、爬取器更新账号密码）不会更新validate_date，
+    # API进程中的可用代理索引按validate_date增量刷新时读不到，因此由触发器记录下来，刷新时按seq读取（见api/pool_index.py）
+    # 只保留最近CHANGES_KEEP条，索引发现需要的记录已经被清理时进行全量刷新
+    """
+    CREATE TABLE IF NOT EXISTS proxies_changes
+    (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        protocol VARCHAR(32) NOT NULL,
+        ip VARCHAR(255) NOT NULL,
+        port INTEGER NOT NULL
+    )
+    """,
+    'DROP TRIGGER IF EXISTS proxies_changes_update',
+    f"""
+    CREATE TRIGGER proxies_changes_update AFTER UPDATE OF country_code, username, password ON proxies
+    WHEN NEW.validated = 1 AND (
+        NEW.country_code IS NOT OLD.country_code OR NEW.username IS NOT OLD.username OR NEW.password IS NOT OLD.password)
+    BEGIN
+        INSERT INTO proxies_changes (protocol, ip, port) VALUES (NEW.protocol, NEW.ip, NEW.port);
+        DELETE FROM proxies_changes WHERE seq <= (SELECT max(seq) FROM proxies_changes) - {CHANGES_KEEP};
+    END
     """]
 
+    # 根据proxies表中已有的数据重新计算统计信息
+    stats_rebuild_sqls = [
+        'DELETE FROM proxies_stats',
+        'DELETE FROM proxies_pending_hist',
+        'INSERT INTO proxies_stats SELECT 1, count(*), COALESCE(SUM(validated = 1), 0) FROM proxies',
+        f"""
+        INSERT INTO proxies_pending_hist
+        SELECT {minute_sql('to_validate_date')} AS minute, count(*) FROM proxies GROUP BY minute
+        """
+    ]
+
     def __init__(self):
         self.fetcher_name = None
         self.protocol = None
@@ -51,6 +235,7 @@ class Proxy(object):
         self.address = None
         self.username = None  # 用户名，None表示无认证
         self.password = None  # 密码，None表示无认证
+        self.country_code = None  # 规范化之后的国家代码，由country得到，见utils/country.py
     
     def params(self):
         """
@@ -62,16 +247,19 @@ class Proxy(object):
             self.validated, self.latency,
             self.validate_date, self.to_validate_date, self.validate_failed_cnt,
             self.created_date,
-            self.country, self.address, self.username, self.password
+            self.country, self.address, self.username, self.password,
+            self.country_code
         )
     
     def to_dict(self):
         """
         返回一个dict，包含自身的全部属性
         """
-        # 计算存活时间（秒）
+        # 计算存活时间（秒），以epoch毫秒存储时不需要转换为datetime
         alive_time = None
-        if self.created_date:
+        if isinstance(self._created_date, int):
+            alive_time = int(time.time() - self._created_date / 1000)
+        elif self.created_date:
             alive_time = int((datetime.datetime.now() - self.created_date).total_seconds())
         
         return {
@@ -81,12 +269,13 @@ class Proxy(object):
             'port': self.port,
             'validated': self.validated,
             'latency': self.latency,
-            'validate_date': str(self.validate_date) if self.validate_date is not None else None,
-            'to_validate_date': str(self.to_validate_date) if self.to_validate_date is not None else None,
+            'validate_date': to_display_text(self._validate_date),
+            'to_validate_date': to_display_text(self._to_validate_date),
             'validate_failed_cnt': self.validate_failed_cnt,
-            'created_date': str(self.created_date) if self.created_date is not None else None,
+            'created_date': to_display_text(self._created_date),
             'alive_time': alive_time,
             'country': self.country,
+            'country_code': self.country_code,
             'address': self.address,
             'username': self.username,
             'password': self.password
@@ -98,8 +287,18 @@ class Proxy(object):
         将sqlite返回的一行解析为Proxy
         row : sqlite返回的一行
         """
-        # 兼容旧数据（9, 10个字段）和新数据（14个字段）
-        assert len(row) in [9, 10, 14]
+        if len(row) == 15:
+            # 常见情况，不调用__init__，时间字段保存原始值，用到时再转换
+            p = Proxy.__new__(Proxy)
+            (p.fetcher_name, p.protocol, p.ip, p.port, validated, p.latency,
+             p._validate_date, p._to_validate_date, p.validate_failed_cnt, created_date,
+             p.country, p.address, p.username, p.password, p.country_code) = row
+            p.validated = bool(validated)
+            p._created_date = created_date if created_date else datetime.datetime.now()
+            return p
+
+        # 兼容旧数据（9, 10个字段）
+        assert len(row) in [9, 10]
         p = Proxy()
         p.fetcher_name = row[0]
         p.protocol = row[1]
@@ -112,22 +311,8 @@ class Proxy(object):
         p.validate_failed_cnt = row[8]
         
         # 处理 created_date (第10个字段)
-        if len(row) >= 10:
-            p.created_date = row[9] if row[9] else datetime.datetime.now()
-        else:
-            p.created_date = datetime.datetime.now()
-        
-        # 处理新增字段 (第11-14个字段)
-        if len(row) >= 14:
-            p.country = row[10]
-            p.address = row[11]
-            p.username = row[12]  # 可以为 None
-            p.password = row[13]  # 可以为 None
-        else:
-            p.country = None
-            p.address = None
-            p.username = None
-            p.password = None
+        if len(row) == 10 and row[9]:
+            p.created_date = row[9]
         
         return p
     
@@ -4,36 +4,58 @@
 封装的数据库接口
 """
 
-from config import DATABASE_PATH
+from config import DATABASE_PATH, DB_READ_POOL_SIZE, DB_SAMPLE_REFRESH_INTERVAL, DB_EPOCH_TIMESTAMPS
 from .Proxy import Proxy
 from .Fetcher import Fetcher
+from .sampling import ValidatedSampler
+from . import timestamps
+from utils.country import to_code
 import sqlite3
 import datetime
 import threading
+import functools
+import contextlib
+import random
+import time
+import signal
 import sys
 import os
 
-# 添加父目录到路径
-sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from utils.ip_location import get_ip_location_cached
-
-conn = sqlite3.connect(
-    DATABASE_PATH, 
-    detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES,
-    timeout=10.0,  # 减少超时时间到 10 秒，避免长时间等待
-    check_same_thread=False  # 允許多線程訪問（配合鎖使用）
-)
-# 设置 WAL 模式，提高并发性能
-conn.execute('PRAGMA journal_mode=WAL')
-conn.execute('PRAGMA synchronous=NORMAL')  # 平衡性能和安全性
-# 优化数据库性能设置
-conn.execute('PRAGMA cache_size=10000')  # 增加缓存大小
-conn.execute('PRAGMA temp_store=MEMORY')  # 临时表存储在内存中
-conn.execute('PRAGMA mmap_size=268435456')  # 启用内存映射，提高读取性能
+# 写入时datetime的格式由DB_EPOCH_TIMESTAMPS决定；读取时不使用PARSE_DECLTYPES转换时间字段，由Proxy/Fetcher在用到时转换
+timestamps.install(DB_EPOCH_TIMESTAMPS)
+
+def _connect():
+    c = sqlite3.connect(
+        DATABASE_PATH, 
+        timeout=10.0,  # 减少超时时间到 10 秒，避免长时间等待
+        check_same_thread=False  # 允許多線程訪問（配合鎖使用）
+    )
+    # 设置 WAL 模式，提高并发性能
+    c.execute('PRAGMA journal_mode=WAL')
+    c.execute('PRAGMA synchronous=NORMAL')  # 平衡性能和安全性
+    # 优化数据库性能设置
+    c.execute('PRAGMA cache_size=10000')  # 增加缓存大小
+    c.execute('PRAGMA temp_store=MEMORY')  # 临时表存储在内存中
+    c.execute('PRAGMA mmap_size=268435456')  # 启用内存映射，提高读取性能
+    return c
+
+conn = _connect()
 # 线程锁
 conn_lock = threading.Lock()
 # 进程锁
 proc_lock = None
+# 数据库写入队列，不为None时表示使用单独的数据库写入进程，本进程的写操作都发送到该队列
+write_queue = None
+# 所有写操作，函数名 -> 执行写操作的函数（不负责加锁和提交事务）
+_write_ops = {}
+
+def reopen():
+    """
+    重新打开全局连接，用于fork出来的子进程（例如gunicorn的worker），子进程不能继续使用父进程打开的SQLite连接
+    只读连接池会自动为每个进程创建新的连接，不需要处理
+    """
+    global conn
+    conn = _connect()
 
 def set_proc_lock(proc_lock_sub):
     """
@@ -43,13 +65,58 @@ def set_proc_lock(proc_lock_sub):
     global proc_lock
     proc_lock = proc_lock_sub
 
+def set_write_queue(write_queue_sub):
+    """
+    设置数据库写入队列，设置之后本进程的写操作都会发送给数据库写入进程执行，本函数需要在主线程中调用
+    write_queue_sub : main中创建的multiprocessing.Queue，为None时表示直接写入数据库
+    """
+    global write_queue
+    write_queue = write_queue_sub
+    if write_queue is not None:
+        # 进程被terminate时以SystemExit的方式退出，使得队列中还没有发送出去的写操作可以发送完毕
+        # 如果在发送途中被强制结束，可能会导致队列损坏
+        def handler(signum, frame):
+            sys.exit(0)
+        signal.signal(signal.SIGTERM, handler)
+
+# 等待锁的统计信息，名称 -> [等待次数, 总等待时间, 最长等待时间]，单位s
+_lock_wait_stats = {}
+_lock_wait_stats_lock = threading.Lock()
+
+def _record_lock_wait(name, seconds):
+    with _lock_wait_stats_lock:
+        item = _lock_wait_stats.setdefault(name, [0, 0.0, 0.0])
+        item[0] += 1
+        item[1] += seconds
+        item[2] = max(item[2], seconds)
+
+def getLockWaitStats(reset=False):
+    """
+    获取本进程等待锁的统计信息
+    locks为等待线程锁和进程锁（_acquire_locks）的时间，read_pool为等待只读连接池中空闲连接的时间
+    reset : 是否清零
+    返回 : dict {名称: {'count': 等待次数, 'total_ms': 总等待时间, 'avg_ms': 平均等待时间, 'max_ms': 最长等待时间}}
+    """
+    with _lock_wait_stats_lock:
+        stats = {name: list(item) for name, item in _lock_wait_stats.items()}
+        if reset:
+            _lock_wait_stats.clear()
+    return {name: dict(
+        count=cnt,
+        total_ms=round(total * 1000, 3),
+        avg_ms=round(total * 1000 / cnt, 3) if cnt > 0 else 0,
+        max_ms=round(max_wait * 1000, 3)
+    ) for name, (cnt, total, max_wait) in stats.items()}
+
 def _acquire_locks():
     """
     获取所有必要的锁（线程锁和进程锁）
     """
+    start_time = time.perf_counter()
     conn_lock.acquire()
     if proc_lock is not None:
         proc_lock.acquire()
+    _record_lock_wait('locks', time.perf_counter() - start_time)
 
 def _release_locks():
     """
@@ -59,6 +126,141 @@ def _release_locks():
         proc_lock.release()
     conn_lock.release()
 
+class _ReadConnectionPool(object):
+    """
+    只读连接池
+    每个连接都是独立的SQLite连接，并设置了query_only，在WAL模式下读取不会被写入阻塞，
+    因此使用连接池中的连接进行查询时，不需要获取线程锁和进程锁
+    size : 最多创建多少个连接，连接都在使用中时等待其他线程归还
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.cond = threading.Condition()
+        self.idle = []
+        self.created = 0
+        self.pid = None
+
+    def _connect(self):
+        c = sqlite3.connect(
+            DATABASE_PATH,
+            timeout=10.0,
+            check_same_thread=False  # 连接会被不同的线程借用，但同一时间只有一个线程使用
+        )
+        c.execute('PRAGMA query_only=ON')
+        c.execute('PRAGMA cache_size=10000')
+        c.execute('PRAGMA temp_store=MEMORY')
+        c.execute('PRAGMA mmap_size=268435456')
+        return c
+
+    @contextlib.contextmanager
+    def connection(self):
+        """
+        借用一个只读连接，使用完毕后自动归还
+        """
+        start_time = time.perf_counter()
+        c = None
+        with self.cond:
+            if self.pid != os.getpid(): # fork出来的子进程不能使用父进程创建的连接
+                self.idle = []
+                self.created = 0
+                self.pid = os.getpid()
+            while not self.idle and self.created >= self.size:
+                self.cond.wait()
+            if self.idle:
+                c = self.idle.pop()
+            else:
+                self.created += 1
+        _record_lock_wait('read_pool', time.perf_counter() - start_time)
+
+        if c is None:
+            try:
+                c = self._connect()
+            except Exception:
+                with self.cond:
+                    self.created -= 1
+                    self.cond.notify()
+                raise
+        pid = self.pid
+        try:
+            yield c
+        finally:
+            with self.cond:
+                if pid == self.pid:
+                    self.idle.append(c)
+                    self.cond.notify()
+
+_read_pool = _ReadConnectionPool(DB_READ_POOL_SIZE) if DB_READ_POOL_SIZE > 0 else None
+
+@contextlib.contextmanager
+def _read_conn():
+    """
+    获取用于只读查询的连接
+    启用了只读连接池时从连接池中借用连接，不需要加锁；否则获取锁之后使用全局连接
+    """
+    if _read_pool is not None:
+        with _read_pool.connection() as c:
+            yield c
+    else:
+        _acquire_locks()
+        try:
+            yield conn
+        finally:
+            _release_locks()
+
+def _write_op(func):
+    """
+    装饰器，用于标记写操作
+    被装饰的函数只负责执行SQL，加锁以及事务由这里处理：
+    如果设置了写入队列，那么只是将操作发送到队列中，由数据库写入进程执行，函数立即返回
+    否则获取锁之后在一个事务中执行
+    """
+    _write_ops[func.__name__] = func
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if write_queue is not None:
+            write_queue.put((func.__name__, args, kwargs))
+            return
+        _acquire_locks()
+        try:
+            conn.execute('BEGIN EXCLUSIVE TRANSACTION;')
+            func(*args, **kwargs)
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            raise e
+        finally:
+            _release_locks()
+    return wrapper
+
+def applyWriteBatch(ops):
+    """
+    由数据库写入进程调用，在一个事务中执行一批写操作
+    每个操作使用一个savepoint，某个操作出错时只回滚这一个操作
+    ops : list[(函数名, args, kwargs)]
+    返回 : list[(函数名, 错误信息)]，执行出错的操作
+    """
+    errors = []
+    _acquire_locks()
+    try:
+        conn.execute('BEGIN EXCLUSIVE TRANSACTION;')
+        for name, args, kwargs in ops:
+            conn.execute('SAVEPOINT write_op')
+            try:
+                _write_ops[name](*args, **kwargs)
+            except Exception as e:
+                conn.execute('ROLLBACK TO write_op')
+                errors.append((name, str(e)))
+            conn.execute('RELEASE write_op')
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        raise e
+    finally:
+        _release_locks()
+    return errors
+
 def pushNewFetch(fetcher_name, protocol, ip, port, username=None, password=None, country=None, address=None):
     """
     爬取器新抓到了一个代理，调用本函数将代理放入数据库
@@ -74,66 +276,68 @@ def pushNewFetch(fetcher_name, protocol, ip, port, username=None, password=None,
     注意：如果爬取器提供了 country/address/username/password，直接写入
           如果没有提供，保持为 None，等验证成功后再获取
     """
-    p = Proxy()
-    p.fetcher_name = fetcher_name
-    p.protocol = protocol
-    p.ip = ip
-    p.port = port
-    p.username = username  # 由爬取器提供，可能为 None
-    p.password = password  # 由爬取器提供，可能为 None
-    p.country = country    # 由爬取器提供，可能为 None
-    p.address = address    # 由爬取器提供，可能为 None
-    
-    _acquire_locks()
+    pushNewFetchBatch(fetcher_name, [(protocol, ip, port, username, password, country, address)])
+
+# SQLite 3.24.0 及以上版本支持 INSERT ... ON CONFLICT DO UPDATE
+_SUPPORT_UPSERT = sqlite3.sqlite_version_info >= (3, 24, 0)
+
+@_write_op
+def pushNewFetchBatch(fetcher_name, proxies):
+    """
+    将爬取器一次爬取到的所有代理在一个事务中放入数据库
+    fetcher_name : 爬取器名称
+    proxies : list[(protocol, ip, port, username, password, country, address)]，后四项可以为None
     
-    try:
-        c = conn.cursor()
-        c.execute('BEGIN EXCLUSIVE TRANSACTION;')
-        # 更新proxies表 - 避免重复添加
-        c.execute('SELECT * FROM proxies WHERE protocol=? AND ip=? AND port=?', (p.protocol, p.ip, p.port))
-        row = c.fetchone()
-        if row is not None: # 已经存在(protocol, ip, port) - 不重复添加，只更新部分字段
-            old_p = Proxy.decode(row)
-            # 更新 fetcher_name, to_validate_date，如果爬取器提供了其他信息也一并更新
-            update_fields = []
-            update_values = []
-            
-            update_fields.append('fetcher_name=?')
-            update_values.append(p.fetcher_name)
-            
-            update_fields.append('to_validate_date=?')
-            update_values.append(min(datetime.datetime.now(), old_p.to_validate_date))
-            
-            # 如果提供了账号密码，更新
-            if username is not None:
-                update_fields.append('username=?')
-                update_values.append(username)
-            if password is not None:
-                update_fields.append('password=?')
-                update_values.append(password)
-            
-            # 如果提供了地理位置，更新
-            if country is not None:
-                update_fields.append('country=?')
-                update_values.append(country)
-            if address is not None:
-                update_fields.append('address=?')
-                update_values.append(address)
-            
-            update_values.extend([p.protocol, p.ip, p.port])
-            
-            sql = f"UPDATE proxies SET {','.join(update_fields)} WHERE protocol=? AND ip=? AND port=?"
-            c.execute(sql, tuple(update_values))
-        else:
-            # 新代理，插入所有字段
-            c.execute('INSERT INTO proxies VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?)', p.params())
-        c.close()
-        conn.commit()
-    except Exception as e:
-        conn.rollback()
-        raise e
-    finally:
-        _release_locks()
+    已经存在的代理(protocol, ip, port)不重复添加，只更新部分字段：
+    fetcher_name更新为本次的爬取器，to_validate_date取原有值和当前时间中较早的一个，
+    username/password/country/address只有本次提供了（不为None）才更新
+    """
+    if len(proxies) == 0:
+        return
+    now = datetime.datetime.now()
+    rows = []
+    for protocol, ip, port, username, password, country, address in proxies:
+        p = Proxy()
+        p.fetcher_name = fetcher_name
+        p.protocol = protocol
+        p.ip = ip
+        p.port = port
+        p.username = username  # 由爬取器提供，可能为 None
+        p.password = password  # 由爬取器提供，可能为 None
+        p.country = country    # 由爬取器提供，可能为 None
+        p.address = address    # 由爬取器提供，可能为 None
+        p.country_code = to_code(country)
+        p.to_validate_date = now
+        p.created_date = now
+        rows.append(p.params())
+
+    if _SUPPORT_UPSERT:
+        conn.executemany("""
+            INSERT INTO proxies VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
+            ON CONFLICT(protocol, ip, port) DO UPDATE SET
+                fetcher_name=excluded.fetcher_name,
+                to_validate_date=MIN(proxies.to_validate_date, excluded.to_validate_date),
+                username=COALESCE(excluded.username, proxies.username),
+                password=COALESCE(excluded.password, proxies.password),
+                country=COALESCE(excluded.country, proxies.country),
+                country_code=CASE WHEN excluded.country IS NULL THEN proxies.country_code ELSE excluded.country_code END,
+                address=COALESCE(excluded.address, proxies.address)
+        """, rows)
+    else:
+        # 旧版本SQLite：先插入不存在的代理，再按照相同的规则更新所有代理
+        conn.executemany('INSERT OR IGNORE INTO proxies VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)', rows)
+        conn.executemany("""
+            UPDATE proxies SET
+                fetcher_name=?,
+                to_validate_date=MIN(to_validate_date, ?),
+                username=COALESCE(?, username),
+                password=COALESCE(?, password),
+                country=COALESCE(?, country),
+                country_code=CASE WHEN ? IS NULL THEN country_code ELSE ? END,
+                address=COALESCE(?, address)
+            WHERE protocol=? AND ip=? AND port=?
+        """, [(fetcher_name, now, username, password, country, country, to_code(country), address, protocol, ip, port)
+              for protocol, ip, port, username, password, country, address in proxies])
 
 def getToValidate(max_count=1):
     """
@@ -144,16 +348,15 @@ def getToValidate(max_count=1):
     """
     _acquire_locks()
     c = conn.cursor()
-    c.execute('BEGIN EXCLUSIVE TRANSACTION;')
-    c.execute('SELECT * FROM proxies WHERE to_validate_date<=? AND validated=? ORDER BY to_validate_date LIMIT ?', (
+    # 只读事务，两次查询使用同一个快照，不需要阻塞其他进程的写入
+    c.execute('BEGIN TRANSACTION;')
+    c.execute('SELECT * FROM proxies WHERE to_validate_date<=? AND validated=1 ORDER BY to_validate_date LIMIT ?', (
         datetime.datetime.now(),
-        True,
         max_count
     ))
     proxies = [Proxy.decode(row) for row in c]
-    c.execute('SELECT * FROM proxies WHERE to_validate_date<=? AND validated=? ORDER BY to_validate_date LIMIT ?', (
+    c.execute('SELECT * FROM proxies WHERE to_validate_date<=? AND validated=0 ORDER BY to_validate_date LIMIT ?', (
         datetime.datetime.now(),
-        False,
         max_count - len(proxies)
     ))
     proxies = proxies + [Proxy.decode(row) for row in c]
@@ -168,111 +371,307 @@ def pushValidateResult(proxy, success, latency):
     proxy : 代理
     success : True/False，验证是否成功
     latency : 本次验证所用的时间(单位毫秒)
-    
-    注意：IP可用（验证成功）且没有国家和地址信息时，会自动获取并更新
     """
-    p = proxy
-    should_remove = p.validate(success, latency)
-    
-    # 只有在验证成功（IP可用）且缺少地理位置信息时才获取
-    need_update_location = False
-    if success and not should_remove and (p.country is None or p.address is None):
-        try:
-            location = get_ip_location_cached(p.ip)
-            p.country = location.get('country', '未知')
-            p.address = location.get('address', '无法获取')
-            need_update_location = True
-            print(f"获取IP地理位置成功: {p.ip} -> {p.country}, {p.address}")
-        except Exception as e:
-            print(f"获取IP地理位置失败 {p.ip}: {e}")
-            # 获取失败时不设置默认值，保持 None
+    pushValidateResultBatch([(proxy, success, latency)])
+
+def pushValidateResultBatch(results):
+    """
+    将验证器的一批结果在一个事务中添加进数据库中
+    results : list[(proxy, success, latency)]，每一项的含义与pushValidateResult的参数相同
     
-    _acquire_locks()
-    if should_remove:
-        conn.execute('DELETE FROM proxies WHERE protocol=? AND ip=? AND port=?', (p.protocol, p.ip, p.port))
-    else:
-        # 如果需要更新地理位置信息，则包含 country 和 address
-        if need_update_location:
-            conn.execute("""
-                UPDATE proxies
-                SET fetcher_name=?,validated=?,latency=?,validate_date=?,to_validate_date=?,validate_failed_cnt=?,country=?,address=?
-                WHERE protocol=? AND ip=? AND port=?
-            """, (
-                p.fetcher_name, p.validated, p.latency, p.validate_date, p.to_validate_date, p.validate_failed_cnt,
-                p.country, p.address,
-                p.protocol, p.ip, p.port
-            ))
+    注意：这里不会获取IP的地理位置，验证成功且缺少地理位置信息的代理由验证器交给GeoEnricher补全
+    """
+    removed, updated = validateResultRows(results)
+    pushValidateRows(removed, updated)
+
+def validateResultRows(results):
+    """
+    根据验证结果更新代理的状态（Proxy.validate），并生成需要写入数据库的行，不读写数据库
+    每个验证结果只能调用一次，写入失败需要重试时应该重新写入返回的行，而不是再次调用本函数
+    results : list[(proxy, success, latency)]
+    返回 : (removed, updated)，参数见pushValidateRows
+    """
+    removed = []
+    updated = []
+    for p, success, latency in results:
+        should_remove = p.validate(success, latency)
+        if should_remove:
+            removed.append((p.protocol, p.ip, p.port))
         else:
-            # 不更新地理位置信息
-            conn.execute("""
-                UPDATE proxies
-                SET fetcher_name=?,validated=?,latency=?,validate_date=?,to_validate_date=?,validate_failed_cnt=?
-                WHERE protocol=? AND ip=? AND port=?
-            """, (
+            updated.append((
                 p.fetcher_name, p.validated, p.latency, p.validate_date, p.to_validate_date, p.validate_failed_cnt,
                 p.protocol, p.ip, p.port
             ))
-    conn.commit()
-    _release_locks()
+    return removed, updated
+
+@_write_op
+def pushValidateRows(removed, updated):
+    """
+    写入验证结果
+    removed : list[(protocol, ip, port)]，需要删除的代理
+    updated : list[tuple]，需要更新验证信息的代理
+    """
+    if removed:
+        conn.executemany('DELETE FROM proxies WHERE protocol=? AND ip=? AND port=?', removed)
+    if updated:
+        conn.executemany("""
+            UPDATE proxies
+            SET fetcher_name=?,validated=?,latency=?,validate_date=?,to_validate_date=?,validate_failed_cnt=?
+            WHERE protocol=? AND ip=? AND port=?
+        """, updated)
+
+@_write_op
+def pushProxyLocationBatch(locations):
+    """
+    批量写入IP的地理位置信息，只更新还没有地理位置信息的代理
+    locations : list[(ip, country, address)]
+    """
+    conn.executemany("""
+        UPDATE proxies SET country=?, address=?, country_code=?
+        WHERE ip=? AND (country IS NULL OR address IS NULL)
+    """, [(country, address, to_code(country), ip) for ip, country, address in locations])
+
+@_write_op
+def pushIPLocations(rows, expire_before=None):
+    """
+    保存IP地理位置缓存（utils/ip_location.py）
+    rows : list[(ip, country, address, update_time)]，update_time为time.time()
+    expire_before : 不为None时同时删除update_time早于这个时间的缓存
+    """
+    if rows:
+        conn.executemany('INSERT OR REPLACE INTO ip_locations (ip, country, address, update_time) VALUES (?, ?, ?, ?)', rows)
+    if expire_before is not None:
+        conn.execute('DELETE FROM ip_locations WHERE update_time < ?', (expire_before,))
+
+@_write_op
+def pushClientFeedback(failed, succeeded, now):
+    """
+    写入客户端反馈（/report）的汇总结果，只更新当前可用的代理
+    failed : list[(protocol, ip, port)]，客户端连续使用失败的代理，与验证失败一样标记为不可用，并且立即重新验证
+    succeeded : list[(latency, protocol, ip, port)]，客户端使用成功的代理及其平均延迟，与原来的延迟取平均值
+    now : 当前时间，作为validate_date，API进程中的可用代理索引通过validate_date增量刷新
+    """
+    if failed:
+        conn.executemany("""
+            UPDATE proxies
+            SET validated=0,validate_date=?,to_validate_date=?,validate_failed_cnt=validate_failed_cnt+1
+            WHERE protocol=? AND ip=? AND port=? AND validated=1
+        """, [(now, now) + key for key in failed])
+    if succeeded:
+        conn.executemany("""
+            UPDATE proxies
+            SET latency=CASE WHEN latency IS NULL THEN ?1 ELSE (latency + ?1) / 2 END
+            WHERE protocol=?2 AND ip=?3 AND port=?4 AND validated=1
+        """, succeeded)
+
+# 可用代理抽样器，用于getValidatedRandom和get_by_protocol
+_sampler = ValidatedSampler(DB_SAMPLE_REFRESH_INTERVAL)
 
 def getValidatedRandom(max_count):
     """
     从通过了验证的代理中，随机选择max_count个代理返回
-    max_count<=0表示不做数量限制
+    max_count<=0表示不做数量限制，此时按验证时间从新到旧返回全部代理
     返回 : list[Proxy]
     
-    优化：使用更快的查询方式，避免 ORDER BY RANDOM() 在大量数据时性能问题
+    使用ValidatedSampler在可用代理中均匀抽样，耗时只与max_count有关，不使用 ORDER BY RANDOM()
     """
-    _acquire_locks()
-    try:
+    with _read_conn() as c:
         if max_count > 0:
-            # 对于有限制的查询，使用 RANDOM() 限制返回数量
-            # 先获取总数，如果数量不多就直接用 RANDOM()，否则用更快的方式
-            r_count = conn.execute('SELECT count(*) FROM proxies WHERE validated=?', (True,))
-            total = r_count.fetchone()[0]
-            r_count.close()
-            
-            if total <= max_count * 2:
-                # 数据量不大，直接用 RANDOM()
-                r = conn.execute('SELECT * FROM proxies WHERE validated=? ORDER BY RANDOM() LIMIT ?', (True, max_count))
+            return _sampler.sample(c, max_count)
+        r = c.execute('SELECT * FROM proxies WHERE validated=1 ORDER BY validate_date DESC')
+        proxies = [Proxy.decode(row) for row in r]
+        r.close()
+    return proxies
+
+def _validated_filter(protocols=None, countries=None, exclude_countries=None, max_latency=None, max_age=None, keyset=False):
+    """
+    生成筛选可用代理的WHERE条件，queryValidated和iterValidated共用
+    protocols : 协议的列表，None表示不限
+    countries : 国家代码的列表，只返回这些国家的代理，None表示不限
+    exclude_countries : 国家代码的列表，排除这些国家的代理（没有国家信息的代理不会被排除），None表示不限
+    max_latency : 最大延迟，单位毫秒，None表示不限
+    max_age : 最近一次验证距今最多多久，单位s，None表示不限
+    keyset : 为True时查询按validate_date排序并分批读取，协议和国家的条件前加上+号，
+             使SQLite使用validate_date的索引按顺序读取，而不是先按协议或国家的索引读取全部再排序
+    返回 : (WHERE条件, 参数)
+    """
+    # validated=1 不能使用参数，否则不会使用部分索引
+    where = ['validated=1']
+    args = []
+    plus = '+' if keyset else ''
+    if protocols:
+        where.append(f'{plus}protocol IN ({",".join("?" * len(protocols))})')
+        args.extend(protocols)
+    if countries:
+        where.append(f'{plus}country_code IN ({",".join("?" * len(countries))})')
+        args.extend(countries)
+    if exclude_countries:
+        where.append(f'(country_code IS NULL OR country_code NOT IN ({",".join("?" * len(exclude_countries))}))')
+        args.extend(exclude_countries)
+    if max_latency is not None:
+        where.append('latency<=?')
+        args.append(max_latency)
+    if max_age is not None:
+        where.append('validate_date>=?')
+        args.append(datetime.datetime.now() - datetime.timedelta(seconds=max_age))
+    return ' AND '.join(where), tuple(args)
+
+def queryValidated(protocols=None, countries=None, exclude_countries=None, max_latency=None, max_age=None, limit=-1):
+    """
+    按条件获取可用代理，所有筛选都在SQL中完成，limit在筛选之后生效
+    各个筛选参数的含义见_validated_filter
+    limit : 最多返回多少个，<=0表示不限
+    返回 : list[Proxy]，有limit时为符合条件的代理中的随机样本，否则按验证时间从新到旧返回全部
+    
+    有limit并且只按一种协议筛选（或者不筛选）时直接使用ValidatedSampler抽样；
+    其他情况先只读取符合条件的rowid（可以使用协议、国家代码或验证时间的索引），在其中抽样之后再按rowid读取完整的行
+    """
+    if limit > 0 and not (countries or exclude_countries or max_latency is not None or max_age is not None) and \
+            (not protocols or len(protocols) == 1):
+        protocol = protocols[0] if protocols else None
+        return getValidatedRandom(limit) if protocol is None else get_by_protocol(protocol, limit)
+
+    where, args = _validated_filter(protocols, countries, exclude_countries, max_latency, max_age)
+    with _read_conn() as c:
+        if limit <= 0:
+            r = c.execute(f'SELECT * FROM proxies WHERE {where} ORDER BY validate_date DESC', args)
+            proxies = [Proxy.decode(row) for row in r]
+            r.close()
+            return proxies
+        rowids = [row[0] for row in c.execute(f'SELECT rowid FROM proxies WHERE {where}', args)]
+        if len(rowids) > limit:
+            rowids = random.sample(rowids, limit)
+        proxies = []
+        for i in range(0, len(rowids), 500):
+            chunk = rowids[i:i + 500]
+            # 再次检查条件，读取rowid之后状态发生变化的代理会被丢弃
+            r = c.execute(f'SELECT * FROM proxies WHERE rowid IN ({",".join("?" * len(chunk))}) AND {where}', tuple(chunk) + args)
+            proxies.extend(Proxy.decode(row) for row in r)
+            r.close()
+    random.shuffle(proxies)
+    return proxies
+
+def iterValidated(protocol=None, limit=-1, offset=0, chunk_size=1000, **filters):
+    """
+    按验证时间从新到旧分批读取可用代理，用于流式返回全部代理，内存占用只与chunk_size有关
+    每一批按照上一批最后一行的(validate_date, rowid)继续读取，读取每一批时才借用连接，
+    不会在整个响应期间占用连接（以及WAL中的读事务），但是各批之间代理的状态可能发生变化
+    protocol : 协议，None表示不限
+    limit : 最多返回多少个，<=0表示不限
+    offset : 跳过前多少个
+    chunk_size : 每批读取多少个
+    filters : 其他筛选条件（countries、exclude_countries、max_latency、max_age），见_validated_filter
+    返回 : 生成器，每次产生一批 list[(protocol, ip, port)]
+    """
+    where, args = _validated_filter((protocol,) if protocol is not None else None, keyset=True, **filters)
+    remaining = limit if limit > 0 else None
+    cursor = None
+    while remaining is None or remaining > 0:
+        n = chunk_size if remaining is None else min(chunk_size, remaining)
+        with _read_conn() as c:
+            if cursor is None:
+                r = c.execute(f'''
+                    SELECT protocol, ip, port, validate_date, rowid FROM proxies WHERE {where}
+                    ORDER BY validate_date DESC, rowid DESC LIMIT ? OFFSET ?
+                ''', args + (n, max(offset, 0)))
             else:
-                # 数据量大，使用更快的方式：按 validate_date 排序（最近验证的）
-                r = conn.execute('SELECT * FROM proxies WHERE validated=? ORDER BY validate_date DESC LIMIT ?', (True, max_count))
-        else:
-            r = conn.execute('SELECT * FROM proxies WHERE validated=? ORDER BY validate_date DESC', (True,))
-        
+                r = c.execute(f'''
+                    SELECT protocol, ip, port, validate_date, rowid FROM proxies
+                    WHERE {where} AND validate_date<=? AND (validate_date<? OR rowid<?)
+                    ORDER BY validate_date DESC, rowid DESC LIMIT ?
+                ''', args + (cursor[0], cursor[0], cursor[1], n))
+            rows = r.fetchall()
+            r.close()
+        if not rows:
+            return
+        cursor = rows[-1][3:]
+        yield [row[:3] for row in rows]
+        if remaining is not None:
+            remaining -= len(rows)
+        if len(rows) < n:
+            return
+
+def getValidatedSince(since):
+    """
+    获取在指定时间之后进行过验证的代理，包括验证失败的代理，用于增量刷新API进程中的可用代理索引
+    since : datetime，验证时间大于等于该时间的代理
+    返回 : list[Proxy]
+    """
+    with _read_conn() as c:
+        r = c.execute('SELECT * FROM proxies WHERE validate_date>=?', (since,))
         proxies = [Proxy.decode(row) for row in r]
         r.close()
-    finally:
-        _release_locks()
     return proxies
+
+def getChangedSince(seq):
+    """
+    获取变更记录（proxies_changes）中序号大于seq的代理，即国家、账号密码发生了变化的可用代理，
+    这些变化不会更新validate_date，用于增量刷新API进程中的可用代理索引
+    seq : 上次读取到的最大序号，第一次读取之前使用getChangeSeq的返回值
+    返回 : (最大序号, 是否有需要的记录已经被清理, list[Proxy])，记录已经被清理时需要进行全量刷新
+    """
+    with _read_conn() as c:
+        # min和max放在同一个SELECT中会扫描全表，分别查询时只读取B树的两端
+        r = c.execute('SELECT (SELECT min(seq) FROM proxies_changes), (SELECT max(seq) FROM proxies_changes)')
+        low, high = r.fetchone()
+        r.close()
+        if high is None or high <= seq:
+            return seq, False, []
+        r = c.execute("""
+            SELECT p.* FROM proxies_changes c JOIN proxies p ON p.protocol=c.protocol AND p.ip=c.ip AND p.port=c.port
+            WHERE c.seq>? AND c.seq<=?
+        """, (seq, high))
+        proxies = [Proxy.decode(row) for row in r]
+        r.close()
+    return high, low > seq + 1, proxies
+
+def getChangeSeq():
+    """
+    获取变更记录（proxies_changes）当前的最大序号，全量刷新可用代理索引之前读取
+    返回 : int
+    """
+    with _read_conn() as c:
+        r = c.execute('SELECT max(seq) FROM proxies_changes')
+        row = r.fetchone()
+        r.close()
+    return row[0] or 0
     
     #新增方法
 def get_by_protocol(protocol, max_count):
     """
     查询 protocol 字段为指定值的代理服务器记录
     max_count 表示返回记录的最大数量，如果为 0 或负数则返回所有记录
-    返回 : list[Proxy]
+    返回 : list[Proxy]，顺序随机
     """
-    _acquire_locks()
-    if max_count > 0:
-        r = conn.execute('SELECT * FROM proxies WHERE protocol=? AND validated=? ORDER BY RANDOM() LIMIT ?', (protocol, True, max_count))
-    else:
-        r = conn.execute('SELECT * FROM proxies WHERE protocol=? AND validated=? ORDER BY RANDOM()', (protocol, True))
-    proxies = [Proxy.decode(row) for row in r]
-    r.close()
-    _release_locks()
+    with _read_conn() as c:
+        if max_count > 0:
+            return _sampler.sample(c, max_count, protocol)
+        r = c.execute('SELECT * FROM proxies WHERE protocol=? AND validated=1', (protocol,))
+        proxies = [Proxy.decode(row) for row in r]
+        r.close()
+    random.shuffle(proxies)
     return proxies
 
+def _requireFetcher(name):
+    """
+    使用数据库写入进程时，写操作在写入进程中执行，出错也不会传回调用方，
+    因此在发送到写入队列之前先检查爬取器是否存在，不存在时直接在调用方抛出异常
+    """
+    if write_queue is not None and getFetcher(name) is None:
+        raise ValueError(f'ERRROR: can not find fetcher {name}')
+
 def pushFetcherResult(name, proxies_cnt):
     """
     更新爬取器的状态，每次在完成一个网站的爬取之后，调用本函数
     name : 爬取器的名称
     proxies_cnt : 本次爬取到的代理数量
     """
-    _acquire_locks()
+    _requireFetcher(name)
+    _pushFetcherResult(name, proxies_cnt)
+
+@_write_op
+def _pushFetcherResult(name, proxies_cnt):
     c = conn.cursor()
-    c.execute('BEGIN EXCLUSIVE TRANSACTION;')
     c.execute('SELECT * FROM fetchers WHERE name=?', (name,))
     row = c.fetchone()
     if row is None:
@@ -286,8 +685,6 @@ def pushFetcherResult(name, proxies_cnt):
             f.sum_proxies_cnt, f.last_proxies_cnt, f.last_fetch_date, f.name
         ))
     c.close()
-    conn.commit()
-    _release_locks()
 
 def pushFetcherEnable(name, enable):
     """
@@ -295,9 +692,12 @@ def pushFetcherEnable(name, enable):
     name : 爬取器的名称
     enable : True/False, 是否启用
     """
-    _acquire_locks()
+    _requireFetcher(name)
+    _pushFetcherEnable(name, enable)
+
+@_write_op
+def _pushFetcherEnable(name, enable):
     c = conn.cursor()
-    c.execute('BEGIN EXCLUSIVE TRANSACTION;')
     c.execute('SELECT * FROM fetchers WHERE name=?', (name,))
     row = c.fetchone()
     if row is None:
@@ -309,19 +709,16 @@ def pushFetcherEnable(name, enable):
             f.enable, f.name
         ))
     c.close()
-    conn.commit()
-    _release_locks()
 
 def getAllFetchers():
     """
     获取所有的爬取器以及状态
     返回 : list[Fetcher]
     """
-    _acquire_locks()
-    r = conn.execute('SELECT * FROM fetchers')
-    fetchers = [Fetcher.decode(row) for row in r]
-    r.close()
-    _release_locks()
+    with _read_conn() as c:
+        r = c.execute('SELECT * FROM fetchers')
+        fetchers = [Fetcher.decode(row) for row in r]
+        r.close()
     return fetchers
 
 def getFetcher(name):
@@ -329,11 +726,10 @@ def getFetcher(name):
     获取指定爬取器以及状态
     返回 : Fetcher
     """
-    _acquire_locks()
-    r = conn.execute('SELECT * FROM fetchers WHERE name=?', (name,))
-    row = r.fetchone()
-    r.close()
-    _release_locks()
+    with _read_conn() as c:
+        r = c.execute('SELECT * FROM fetchers WHERE name=?', (name,))
+        row = r.fetchone()
+        r.close()
     if row is None:
         return None
     else:
@@ -345,11 +741,10 @@ def getProxyCount(fetcher_name):
     fetcher_name : 爬取器名称
     返回 : int
     """
-    _acquire_locks()
-    r = conn.execute('SELECT count(*) FROM proxies WHERE fetcher_name=?', (fetcher_name,))
-    cnt = r.fetchone()[0]
-    r.close()
-    _release_locks()
+    with _read_conn() as c:
+        r = c.execute('SELECT count(*) FROM proxies WHERE fetcher_name=?', (fetcher_name,))
+        cnt = r.fetchone()[0]
+        r.close()
     return cnt
 
 def getProxyCountAll():
@@ -357,45 +752,61 @@ def getProxyCountAll():
     一次性查询所有爬取器在数据库中的代理数量
     返回 : dict {fetcher_name: count}
     """
-    _acquire_locks()
-    r = conn.execute('SELECT fetcher_name, count(*) FROM proxies GROUP BY fetcher_name')
-    result = {row[0]: row[1] for row in r}
-    r.close()
-    _release_locks()
+    with _read_conn() as c:
+        r = c.execute('SELECT fetcher_name, count(*) FROM proxies GROUP BY fetcher_name')
+        result = {row[0]: row[1] for row in r}
+        r.close()
     return result
 
+def ping():
+    """
+    执行一次简单的查询，用于检查数据库是否可以访问
+    返回 : 查询耗时，单位s
+    """
+    start_time = time.perf_counter()
+    with _read_conn() as c:
+        c.execute('SELECT 1').fetchone()
+    return time.perf_counter() - start_time
+
 def getProxiesStatus():
     """
     获取代理状态，包括`全部代理数量`，`当前可用代理数量`，`等待验证代理数量`
+    数量由触发器维护在proxies_stats和proxies_pending_hist表中，不需要扫描proxies表，
+    其中`等待验证代理数量`精确到分钟，是一个近似值
     返回 : dict
     """
-    _acquire_locks()
-    r = conn.execute('SELECT count(*) FROM proxies')
-    sum_proxies_cnt = r.fetchone()[0]
-    r.close()
-
-    r = conn.execute('SELECT count(*) FROM proxies WHERE validated=?', (True,))
-    validated_proxies_cnt = r.fetchone()[0]
-    r.close()
+    with _read_conn() as c:
+        r = c.execute('SELECT sum_cnt, validated_cnt FROM proxies_stats WHERE id=1')
+        row = r.fetchone()
+        r.close()
 
-    r = conn.execute('SELECT count(*) FROM proxies WHERE to_validate_date<=?', (datetime.datetime.now(),))
-    pending_proxies_cnt = r.fetchone()[0]
-    r.close()
-    _release_locks()
+        r = c.execute(f"SELECT COALESCE(SUM(cnt), 0) FROM proxies_pending_hist WHERE minute<={timestamps.minute_sql('?1')}", (
+            datetime.datetime.now(),
+        ))
+        pending_proxies_cnt = r.fetchone()[0]
+        r.close()
     return dict(
-        sum_proxies_cnt=sum_proxies_cnt,
-        validated_proxies_cnt=validated_proxies_cnt,
+        sum_proxies_cnt=row[0],
+        validated_proxies_cnt=row[1],
         pending_proxies_cnt=pending_proxies_cnt
     )
 
+def getPoolVersion():
+    """
+    获取可用代理集合的版本号，可用代理增加、减少，或者可用代理的国家、账号密码发生变化时加1，由触发器维护
+    返回 : int
+    """
+    with _read_conn() as c:
+        r = c.execute('SELECT version FROM proxies_version WHERE id=1')
+        row = r.fetchone()
+        r.close()
+    return row[0] if row is not None else 0
+
+@_write_op
 def pushClearFetchersStatus():
     """
     清空爬取器的统计信息，包括sum_proxies_cnt,last_proxies_cnt,last_fetch_date
     """
-    _acquire_locks()
     c = conn.cursor()
-    c.execute('BEGIN EXCLUSIVE TRANSACTION;')
     c.execute('UPDATE fetchers SET sum_proxies_cnt=?, last_proxies_cnt=?, last_fetch_date=?', (0, 0, None))
     c.close()
-    conn.commit()
-    _release_locks()
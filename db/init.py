@@ -1,11 +1,26 @@
 # encoding: utf-8
 
-from config import DATABASE_PATH
+from config import DATABASE_PATH, DB_EPOCH_TIMESTAMPS
 from .Proxy import Proxy
 from .Fetcher import Fetcher
+from . import migrate_timestamps
 from fetchers import fetchers
+from utils.country import to_code
 import sqlite3
 
+# IP地理位置缓存（utils/ip_location.py），由GeoEnricher通过conn.pushIPLocations写入
+ip_location_ddls = ["""
+    CREATE TABLE IF NOT EXISTS ip_locations (
+        ip TEXT PRIMARY KEY NOT NULL,
+        country TEXT NOT NULL,
+        address TEXT NOT NULL,
+        update_time REAL NOT NULL
+    )
+    """, """
+    CREATE INDEX IF NOT EXISTS ip_locations_update_time_index ON ip_locations(update_time)
+    """
+]
+
 def init():
     """
     初始化数据库
@@ -13,11 +28,38 @@ def init():
 
     conn = sqlite3.connect(DATABASE_PATH)
 
-    create_tables = Proxy.ddls + Fetcher.ddls
+    # 旧版本的数据库中没有country_code字段，添加之后根据country计算（需要在创建country_code的索引之前）
+    columns = [row[1] for row in conn.execute('PRAGMA table_info(proxies)')]
+    if columns and 'country_code' not in columns:
+        print('正在为代理添加country_code字段...')
+        conn.create_function('to_country_code', 1, to_code)
+        conn.execute('ALTER TABLE proxies ADD COLUMN country_code VARCHAR(2)')
+        conn.execute('UPDATE proxies SET country_code=to_country_code(country) WHERE country IS NOT NULL')
+        conn.commit()
+
+    create_tables = Proxy.ddls + Fetcher.ddls + ip_location_ddls
     for sql in create_tables:
         conn.execute(sql)
         conn.commit()
     
+    # 代理数量的统计信息，第一次创建时根据已有的数据计算
+    c = conn.cursor()
+    c.execute('BEGIN EXCLUSIVE TRANSACTION;')
+    for sql in Proxy.stats_ddls:
+        c.execute(sql)
+    c.execute('SELECT count(*) FROM proxies_stats')
+    if c.fetchone()[0] == 0:
+        for sql in Proxy.stats_rebuild_sqls:
+            c.execute(sql)
+    c.close()
+    conn.commit()
+
+    # 时间字段的存储格式与DB_EPOCH_TIMESTAMPS不一致时进行转换
+    if migrate_timestamps.needs_migration(conn, DB_EPOCH_TIMESTAMPS):
+        print(f'正在将数据库中的时间字段转换为{"epoch毫秒" if DB_EPOCH_TIMESTAMPS else "文本"}格式...')
+        cnt = migrate_timestamps.migrate(conn, DB_EPOCH_TIMESTAMPS)
+        print(f'转换完成，共转换{cnt}行')
+    
     # 注册所有的爬取器
     c = conn.cursor()
     c.execute('BEGIN EXCLUSIVE TRANSACTION;')
@@ -0,0 +1,112 @@
+# encoding: utf-8
+"""
+转换数据库中时间字段的存储格式（见timestamps.py）
+启动时如果发现数据库中的格式与config.py中的DB_EPOCH_TIMESTAMPS不一致，init.py会自动调用migrate进行转换；
+也可以在停止所有进程之后手动运行（在项目根目录下运行）：
+    python -m db.migrate_timestamps epoch   # 文本 -> epoch毫秒
+    python -m db.migrate_timestamps text    # epoch毫秒 -> 文本
+手动转换之后需要同时修改config.py中的DB_EPOCH_TIMESTAMPS，否则下次启动时会被转换回去
+"""
+
+import sys
+import sqlite3
+from .Proxy import Proxy
+from .timestamps import to_datetime, to_epoch_ms, to_text
+
+# 表 -> 时间字段
+COLUMNS = [
+    ('proxies', ('validate_date', 'to_validate_date', 'created_date')),
+    ('fetchers', ('last_fetch_date',)),
+]
+
+# 每次读取和写入多少行
+_CHUNK_SIZE = 10000
+
+
+def needs_migration(c, epoch):
+    """
+    检查数据库中的时间字段是否需要转换
+    proxies表只检查to_validate_date的最小值和最大值（使用索引，不需要扫描整个表）：
+    SQLite中整数总是排在文本之前，两者类型都正确说明所有行都是正确的格式
+    c : 数据库连接
+    epoch : 目标格式，True表示epoch毫秒，False表示文本
+    """
+    target = int if epoch else str
+    lo = c.execute('SELECT MIN(to_validate_date) FROM proxies').fetchone()[0]
+    hi = c.execute('SELECT MAX(to_validate_date) FROM proxies').fetchone()[0]
+    if lo is not None and not (isinstance(lo, target) and isinstance(hi, target)):
+        return True
+    wrong = c.execute('SELECT count(*) FROM fetchers WHERE last_fetch_date IS NOT NULL AND typeof(last_fetch_date)!=?', (
+        'integer' if epoch else 'text',
+    )).fetchone()[0]
+    return wrong > 0
+
+
+def migrate(c, epoch, progress=None):
+    """
+    在一个事务中将所有时间字段转换为目标格式，已经是目标格式的值不会被修改
+    转换期间暂时删除proxies_stats_update触发器（逐行维护统计信息太慢），转换之后重新创建并重新计算统计信息
+    c : 数据库连接，读取时不能使用PARSE_DECLTYPES
+    epoch : 目标格式，True表示epoch毫秒，False表示文本
+    progress : 可选，每处理一批之后调用 progress(表名, 已处理行数, 已转换行数)
+    返回 : 转换了多少行
+    """
+    target = int if epoch else str
+    convert = to_epoch_ms if epoch else to_text
+    converted = 0
+    cur = c.cursor()
+    cur.execute('BEGIN EXCLUSIVE TRANSACTION;')
+    try:
+        cur.execute('DROP TRIGGER IF EXISTS proxies_stats_update')
+        for table, columns in COLUMNS:
+            select = f'SELECT rowid, {", ".join(columns)} FROM {table} WHERE rowid>? ORDER BY rowid LIMIT ?'
+            update = f'UPDATE {table} SET {", ".join(col + "=?" for col in columns)} WHERE rowid=?'
+            last_rowid, scanned = -1, 0
+            while True:
+                rows = cur.execute(select, (last_rowid, _CHUNK_SIZE)).fetchall()
+                if not rows:
+                    break
+                last_rowid = rows[-1][0]
+                scanned += len(rows)
+                updates = []
+                for row in rows:
+                    values = row[1:]
+                    if all(v is None or isinstance(v, target) for v in values):
+                        continue
+                    updates.append(tuple(
+                        v if v is None or isinstance(v, target) else convert(to_datetime(v)) for v in values
+                    ) + (row[0],))
+                cur.executemany(update, updates)
+                converted += len(updates)
+                if progress is not None:
+                    progress(table, scanned, converted)
+        for sql in Proxy.stats_ddls + Proxy.stats_rebuild_sqls:
+            cur.execute(sql)
+        c.commit()
+    except Exception as e:
+        c.rollback()
+        raise e
+    finally:
+        cur.close()
+    return converted
+
+
+def main(argv):
+    if len(argv) != 1 or argv[0] not in ('epoch', 'text'):
+        print(__doc__)
+        return 1
+    from config import DATABASE_PATH
+    epoch = argv[0] == 'epoch'
+    c = sqlite3.connect(DATABASE_PATH)
+    if not needs_migration(c, epoch):
+        print('数据库中的时间字段已经是目标格式')
+    else:
+        cnt = migrate(c, epoch, progress=lambda table, scanned, converted: print(f'{table}：已处理{scanned}行，转换{converted}行'))
+        print(f'转换完成，共转换{cnt}行')
+    c.close()
+    print(f'请确认config.py中 DB_EPOCH_TIMESTAMPS = {epoch}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,250 @@
+# encoding: utf-8
+"""
+检查conn.py中的查询是否使用了索引
+在临时数据库中生成指定数量的代理，将conn模块的连接换成临时数据库的连接，依次调用CALLS中的函数，
+通过set_trace_callback记录实际执行的每一条SQL语句（参数已经展开为字面量），再对每一条语句运行 EXPLAIN QUERY PLAN，
+如果某条语句对proxies表进行了全表扫描（没有使用任何索引），则返回非0的退出码
+SQL语句都来自conn.py和sampling.py中实际执行的查询，不需要在这里另外维护一份；触发器中的语句不在检查范围内
+
+用法（在项目根目录下运行）：
+    python -m db.query_plan [代理数量]
+默认生成100000个代理
+
+conn.py中新增了读写数据库的函数时，需要在下面的CALLS中加入对应的调用，否则检查会失败
+"""
+
+import os
+import re
+import sys
+import random
+import inspect
+import datetime
+import tempfile
+from .Proxy import Proxy
+from .Fetcher import Fetcher
+from .init import ip_location_ddls
+
+_NOW = datetime.datetime.now()
+_COUNTRY_CODES = ('CN', 'US', 'JP', 'HK', 'DE', 'SG', None)
+_FETCHER_CNT = 20
+
+
+def _validate_results(conn):
+    """
+    构造一批验证结果：成功、失败，以及失败次数过多需要删除的代理
+    """
+    p1, p2, p3 = conn.getToValidate(3)
+    p3.validate_failed_cnt = 100
+    return [(p1, True, 100), (p2, False, None), (p3, False, None)]
+
+
+def _fetched(conn):
+    """
+    构造一批爬取结果：一个已经存在的代理（带有账号密码）和一个新代理
+    """
+    p = conn.getValidatedRandom(1)[0]
+    return [(p.protocol, p.ip, p.port, 'user', 'pass', None, None), ('http', '255.255.255.1', 8080, None, None, '美国', None)]
+
+
+def _upsert_fallback(conn):
+    """
+    旧版本SQLite不支持ON CONFLICT DO UPDATE时，pushNewFetchBatch使用INSERT OR IGNORE加UPDATE
+    """
+    conn._SUPPORT_UPSERT, old = False, conn._SUPPORT_UPSERT
+    try:
+        conn.pushNewFetchBatch('fetcher1', _fetched(conn))
+    finally:
+        conn._SUPPORT_UPSERT = old
+
+
+# (名称, 调用)，名称的第一段为conn.py中的函数名，同一个函数有不同的查询分支时用后缀区分
+# 读取在前、写入在后，写入之后的读取（例如getChangedSince）可以读到写入产生的数据
+CALLS = [
+    ('getToValidate', lambda conn: conn.getToValidate(100)),
+    ('getValidatedRandom', lambda conn: conn.getValidatedRandom(10)),
+    ('getValidatedRandom.all', lambda conn: conn.getValidatedRandom(-1)),
+    ('get_by_protocol', lambda conn: conn.get_by_protocol('http', 10)),
+    ('get_by_protocol.all', lambda conn: conn.get_by_protocol('http', -1)),
+    ('queryValidated.protocols', lambda conn: conn.queryValidated(('http', 'https', 'socks5'), limit=10)),
+    ('queryValidated.country', lambda conn: conn.queryValidated(('http', 'socks5'), ['US'], limit=10)),
+    ('queryValidated.exclude', lambda conn: conn.queryValidated(exclude_countries=['CN'], max_latency=1000, limit=10)),
+    ('queryValidated.max_age', lambda conn: conn.queryValidated(max_age=600, limit=10)),
+    ('queryValidated.all', lambda conn: conn.queryValidated(countries=['US'])),
+    ('queryValidated.sample', lambda conn: conn.queryValidated(('http',), limit=10)),
+    ('queryValidated.protocol_all', lambda conn: conn.queryValidated(('http',))),
+    ('iterValidated', lambda conn: list(conn.iterValidated('http', limit=2500))),
+    ('iterValidated.filtered', lambda conn: list(conn.iterValidated(
+        limit=2500, countries=['US', 'JP'], exclude_countries=['CN'], max_latency=1000, max_age=86400))),
+    ('getValidatedSince', lambda conn: conn.getValidatedSince(_NOW - datetime.timedelta(minutes=1))),
+    ('getChangeSeq', lambda conn: conn.getChangeSeq()),
+    ('getAllFetchers', lambda conn: conn.getAllFetchers()),
+    ('getFetcher', lambda conn: conn.getFetcher('fetcher1')),
+    ('getProxyCount', lambda conn: conn.getProxyCount('fetcher1')),
+    ('getProxyCountAll', lambda conn: conn.getProxyCountAll()),
+    ('getProxiesStatus', lambda conn: conn.getProxiesStatus()),
+    ('getPoolVersion', lambda conn: conn.getPoolVersion()),
+    ('ping', lambda conn: conn.ping()),
+    ('pushNewFetch', lambda conn: conn.pushNewFetch('fetcher1', 'http', '255.255.255.2', 8080)),
+    ('pushNewFetchBatch', lambda conn: conn.pushNewFetchBatch('fetcher1', _fetched(conn))),
+    ('pushNewFetchBatch.fallback', _upsert_fallback),
+    ('pushValidateResult', lambda conn: conn.pushValidateResult(*_validate_results(conn)[0])),
+    ('pushValidateResultBatch', lambda conn: conn.pushValidateResultBatch(_validate_results(conn))),
+    ('pushValidateRows', lambda conn: conn.pushValidateRows(*conn.validateResultRows(_validate_results(conn)))),
+    ('pushProxyLocationBatch', lambda conn: conn.pushProxyLocationBatch(
+        [(p.ip, '日本', '东京') for p in conn.getValidatedRandom(5)])),
+    ('pushIPLocations', lambda conn: conn.pushIPLocations(
+        [('1.1.1.1', '美国', '美国', _NOW.timestamp())], _NOW.timestamp() - 86400)),
+    ('pushClientFeedback', lambda conn: conn.pushClientFeedback(
+        [(p.protocol, p.ip, p.port) for p in conn.getValidatedRandom(2)],
+        [(100, p.protocol, p.ip, p.port) for p in conn.getValidatedRandom(2)], datetime.datetime.now())),
+    ('pushFetcherResult', lambda conn: conn.pushFetcherResult('fetcher1', 10)),
+    ('pushFetcherEnable', lambda conn: conn.pushFetcherEnable('fetcher1', True)),
+    ('pushClearFetchersStatus', lambda conn: conn.pushClearFetchersStatus()),
+    ('applyWriteBatch', lambda conn: conn.applyWriteBatch([('_pushFetcherEnable', ('fetcher2', False), {})])),
+    ('getChangedSince', lambda conn: conn.getChangedSince(0)),
+]
+
+# conn.py中不读写数据库的公开函数，不需要出现在CALLS中
+NO_QUERY = ('reopen', 'set_proc_lock', 'set_write_queue', 'getLockWaitStats', 'validateResultRows')
+
+# 这些表很小，允许全表扫描
+SMALL_TABLES = ('fetchers',)
+
+# 只检查这些语句，BEGIN/COMMIT/SAVEPOINT/PRAGMA等没有查询计划
+_STATEMENTS = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH', 'REPLACE')
+
+# SQLite 3.24之前为 SCAN TABLE xxx，之后为 SCAN xxx；使用了索引时后面会带有 USING ... INDEX
+_SCAN_RE = re.compile(r'^SCAN (?:TABLE )?(\w+)(.*)$')
+
+# 去重时把字面量替换为?，同一条语句使用不同的参数只检查一次
+_LITERAL_RE = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+
+
+def seed(c, n):
+    """
+    生成n个代理，大约一半通过了验证，以及_FETCHER_CNT个爬取器
+    """
+    for sql in Proxy.ddls + Fetcher.ddls + ip_location_ddls + Proxy.stats_ddls + Proxy.stats_rebuild_sqls:
+        c.execute(sql)
+    rows = []
+    for i in range(n):
+        p = Proxy()
+        p.fetcher_name = f'fetcher{i % _FETCHER_CNT}'
+        p.protocol = ('http', 'https', 'socks4', 'socks5')[i % 4]
+        p.ip = f'{i >> 24 & 255}.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}'
+        p.port = 8080
+        p.validated = random.random() < 0.5
+        p.validate_date = _NOW - datetime.timedelta(seconds=random.randint(0, 86400))
+        p.to_validate_date = _NOW + datetime.timedelta(seconds=random.randint(-3600, 3600))
+        p.latency = random.randint(50, 5000)
+        p.country_code = random.choice(_COUNTRY_CODES)
+        rows.append(p.params())
+    c.executemany('INSERT INTO proxies VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)', rows)
+    for i in range(_FETCHER_CNT):
+        f = Fetcher()
+        f.name = f'fetcher{i}'
+        c.execute('INSERT INTO fetchers VALUES (?,?,?,?,?)', f.params())
+    c.commit()
+
+
+def capture(conn):
+    """
+    依次调用CALLS中的函数，记录实际执行的SQL语句
+    conn : 已经指向临时数据库的db.conn模块
+    返回 : list[(名称, SQL)]，按语句去重，名称为第一次执行这条语句的调用
+    """
+    executed = []
+
+    def trace(sql):
+        executed.append(sql)
+
+    statements = []
+    seen = set()
+    conn.conn.set_trace_callback(trace)
+    try:
+        for name, call in CALLS:
+            del executed[:]
+            call(conn)
+            for sql in executed:
+                sql = sql.strip()
+                words = sql.split(None, 1)
+                if not words or words[0].upper() not in _STATEMENTS: # 包括触发器中的语句（以--开头）
+                    continue
+                key = _LITERAL_RE.sub('?', ' '.join(sql.split()))
+                if key not in seen:
+                    seen.add(key)
+                    statements.append((name, sql))
+    finally:
+        conn.conn.set_trace_callback(None)
+    return statements
+
+
+def uncovered(conn):
+    """
+    返回 : conn.py中读写数据库、但是没有出现在CALLS中的公开函数
+    """
+    called = set(name.split('.')[0] for name, _ in CALLS)
+    return sorted(
+        name for name, f in vars(conn).items()
+        if inspect.isfunction(f) and f.__module__ == conn.__name__ and not name.startswith('_')
+        and name not in NO_QUERY and name not in called
+    )
+
+
+def full_scans(c, sql):
+    """
+    返回 : (查询计划的每一行, 进行了全表扫描的表)
+    """
+    plan = [row[-1] for row in c.execute('EXPLAIN QUERY PLAN ' + sql)]
+    scanned = []
+    for detail in plan:
+        # 没有FROM的外层查询（例如只包含标量子查询）为SCAN CONSTANT ROW，不读取任何表
+        m = _SCAN_RE.match(detail) if detail != 'SCAN CONSTANT ROW' else None
+        if m and 'INDEX' not in m.group(2) and m.group(1) not in SMALL_TABLES:
+            scanned.append(m.group(1))
+    return plan, scanned
+
+
+def check(n=100000):
+    """
+    检查所有查询
+    返回 : 进行了全表扫描的查询名称列表，没有出现在CALLS中的函数也算作检查失败
+    """
+    # 导入conn时会注册时间字段的适配器（见timestamps.py），生成数据之前导入，使时间字段的格式一致
+    from . import conn
+    failed = []
+    old_conn, old_pool, old_path = conn.conn, conn._read_pool, conn.DATABASE_PATH
+    with tempfile.TemporaryDirectory() as tmp:
+        conn.DATABASE_PATH = os.path.join(tmp, 'query_plan.db')
+        conn.conn = conn._connect()
+        conn._read_pool = None # 读取也使用conn.conn，只需要在这一个连接上记录SQL
+        try:
+            seed(conn.conn, n)
+            for name, sql in capture(conn):
+                plan, scanned = full_scans(conn.conn, sql)
+                print(f'[{"FAIL" if scanned else " OK "}] {name}')
+                print(f'         {" ".join(sql.split())[:160]}')
+                for detail in plan:
+                    print(f'         {detail}')
+                if scanned:
+                    failed.append(name)
+        finally:
+            conn.conn.close()
+            conn.conn, conn._read_pool, conn.DATABASE_PATH = old_conn, old_pool, old_path
+    for name in uncovered(conn):
+        print(f'[FAIL] {name}：没有出现在CALLS中')
+        failed.append(name)
+    return failed
+
+
+def main(argv):
+    failed = check(int(argv[0]) if argv else 100000)
+    if failed:
+        print(f'以下查询没有通过检查：{", ".join(failed)}')
+        return 1
+    print('所有查询都使用了索引')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
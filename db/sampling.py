@@ -0,0 +1,117 @@
+# encoding: utf-8
+"""
+对通过了验证的代理进行均匀随机抽样，不使用 ORDER BY RANDOM()
+"""
+
+import time
+import random
+import threading
+from array import array
+from .Proxy import Proxy
+
+# 每轮抽样最多重试多少次（抽到已经不可用的代理时需要重新抽样）
+_MAX_ROUNDS = 3
+# 每条SQL语句中最多包含多少个参数，旧版本SQLite限制为999
+_MAX_PARAMS = 500
+
+
+class ValidatedSampler(object):
+    """
+    可用代理抽样器
+    在内存中保存所有可用代理的rowid数组（同时按协议分组），每隔一段时间重新从数据库读取一次；
+    抽样时从数组中随机选择rowid，再按rowid读取代理，这样每次抽样的时间只与抽样数量有关。
+    读取rowid数组之后才变为不可用（或被删除）的代理会在读取时被丢弃，并重新抽样，
+    因此结果是在当前仍然可用的代理中均匀抽样；新变为可用的代理要等到下次重新读取rowid数组之后才会被抽到
+    refresh_interval : rowid数组最多多久重新读取一次，单位s
+    """
+
+    def __init__(self, refresh_interval):
+        self.refresh_interval = refresh_interval
+        self.lock = threading.Lock()
+        self.all_ids = None   # array，所有可用代理的rowid
+        self.protocol_ids = {} # 协议 -> array
+        self.load_time = 0
+        self.load_seconds = 0
+
+    def _load(self, c):
+        start = time.perf_counter()
+        all_ids = array('q')
+        protocol_ids = {}
+        # ORDER BY protocol 使得SQLite使用proxies_validated_protocol_index，只需要读取索引
+        for rowid, protocol in c.execute('SELECT rowid, protocol FROM proxies WHERE validated=1 ORDER BY protocol'):
+            all_ids.append(rowid)
+            ids = protocol_ids.get(protocol)
+            if ids is None:
+                ids = protocol_ids[protocol] = array('q')
+            ids.append(rowid)
+        self.all_ids, self.protocol_ids = all_ids, protocol_ids
+        self.load_time = time.time()
+        self.load_seconds = time.perf_counter() - start
+
+    def _get_ids(self, c, protocol, force=False):
+        with self.lock:
+            if force or self.all_ids is None or time.time() - self.load_time >= self.refresh_interval:
+                self._load(c)
+            if protocol is None:
+                return self.all_ids
+            return self.protocol_ids.get(protocol, array('q'))
+
+    @staticmethod
+    def _fetch(c, rowids, protocol):
+        """
+        按rowid读取代理，只返回仍然可用的代理
+        """
+        proxies = []
+        for i in range(0, len(rowids), _MAX_PARAMS):
+            chunk = rowids[i:i + _MAX_PARAMS]
+            sql = f'SELECT * FROM proxies WHERE rowid IN ({",".join("?" * len(chunk))}) AND validated=1'
+            params = list(chunk)
+            if protocol is not None:
+                # 加上+号，避免SQLite使用主键索引按协议扫描，而不是直接按rowid读取
+                sql += ' AND +protocol=?'
+                params.append(protocol)
+            proxies.extend(Proxy.decode(row) for row in c.execute(sql, params))
+        return proxies
+
+    def sample(self, c, k, protocol=None):
+        """
+        随机选择k个可用代理，可用代理不足k个时返回全部
+        c : 数据库连接
+        k : 数量
+        protocol : 协议，None表示不限
+        返回 : list[Proxy]，顺序随机
+        """
+        result = []
+        tried = set()
+        for force in (False, True):
+            ids = self._get_ids(c, protocol, force=force)
+            stale = False
+            for _ in range(_MAX_ROUNDS):
+                need = k - len(result)
+                # 多抽取一些，以弥补已经不可用的代理
+                n = min(len(ids), need * 2 + 8)
+                if need <= 0 or n == 0:
+                    break
+                rowids = [rowid for rowid in (ids[i] for i in random.sample(range(len(ids)), n)) if rowid not in tried]
+                tried.update(rowids)
+                proxies = self._fetch(c, rowids, protocol)
+                stale = stale or len(proxies) < len(rowids)
+                random.shuffle(proxies) # IN查询按rowid顺序返回，需要重新打乱
+                result.extend(proxies[:need])
+                if n == len(ids): # 已经抽取了全部rowid
+                    break
+            # 多轮抽样之后仍然不够，并且抽到了已经不可用的代理，说明rowid数组已经过时，重新读取之后再试一次
+            if len(result) >= k or not stale or time.time() - self.load_time < 1:
+                break
+        return result
+
+    def report(self):
+        """
+        返回抽样器的状态
+        """
+        with self.lock:
+            return dict(
+                size=len(self.all_ids) if self.all_ids is not None else 0,
+                age=round(time.time() - self.load_time, 3),
+                load_ms=round(self.load_seconds * 1000, 3)
+            )
@@ -0,0 +1,107 @@
+# encoding: utf-8
+"""
+时间字段（TIMESTAMP）的存储格式
+默认以文本存储（例如 2024-01-01 12:00:00.123456，与sqlite3模块默认的方式相同）；
+config.py中的DB_EPOCH_TIMESTAMPS为True时以整数存储（epoch毫秒），比较和读取都更快
+数据库连接不再使用 PARSE_DECLTYPES 在读取时转换每一个时间字段，读取到的是原始值（文本或者整数），
+由Proxy/Fetcher在真正用到时通过to_datetime转换
+两种格式之间的转换见 migrate_timestamps.py
+"""
+
+import time
+import sqlite3
+import datetime
+
+_installed = None
+
+
+def install(epoch):
+    """
+    设置写入数据库时datetime的格式，本进程中所有sqlite3连接都会生效
+    epoch : True表示写入epoch毫秒，False表示写入文本
+    """
+    global _installed
+    if _installed == epoch:
+        return
+    if epoch:
+        sqlite3.register_adapter(datetime.datetime, to_epoch_ms)
+    else:
+        sqlite3.register_adapter(datetime.datetime, to_text)
+    _installed = epoch
+
+
+def to_epoch_ms(d):
+    """
+    datetime（本地时间） -> epoch毫秒
+    """
+    return int(d.timestamp() * 1000)
+
+
+def to_text(d):
+    """
+    datetime -> 文本，与sqlite3模块默认的格式相同
+    """
+    return d.isoformat(' ')
+
+
+def from_epoch_ms(ms):
+    """
+    epoch毫秒 -> datetime（本地时间）
+    """
+    return datetime.datetime.fromtimestamp(ms // 1000).replace(microsecond=ms % 1000 * 1000)
+
+
+def parse_text(text):
+    """
+    文本 -> datetime，格式与sqlite3模块默认的timestamp转换器相同，也支持只有日期的文本
+    """
+    datepart, _, timepart = text.partition(' ')
+    year, month, day = map(int, datepart.split('-'))
+    if not timepart:
+        return datetime.datetime(year, month, day)
+    timepart, _, fraction = timepart.partition('.')
+    hours, minutes, seconds = map(int, timepart.split(':'))
+    microseconds = int(f'{fraction:0<6.6}') if fraction else 0
+    return datetime.datetime(year, month, day, hours, minutes, seconds, microseconds)
+
+
+def to_datetime(value):
+    """
+    将数据库中读取到的时间字段转换为datetime
+    value : None、datetime、整数（epoch毫秒）、文本或者bytes
+    """
+    if value is None or isinstance(value, datetime.datetime):
+        return value
+    if isinstance(value, int):
+        return from_epoch_ms(value)
+    if isinstance(value, bytes):
+        value = value.decode()
+    if value.isdigit():
+        return from_epoch_ms(int(value))
+    return parse_text(value)
+
+
+def to_display_text(value):
+    """
+    将时间字段转换为与str(datetime)相同的文本，用于返回给API
+    以文本存储的原始值本身就是这个格式，直接返回，不需要解析
+    """
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, int):
+        # 直接格式化，不创建datetime
+        seconds, ms = divmod(value, 1000)
+        text = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(seconds))
+        return f'{text}.{ms:03d}000' if ms else text
+    return str(value)
+
+
+def minute_sql(expr):
+    """
+    返回一个SQL表达式，计算时间字段所在的分钟，用于proxies_pending_hist
+    同时支持两种存储格式：整数为epoch毫秒，文本按照UTC时间计算（与epoch分钟相差本地时区的偏移）
+    同一个数据库中的时间字段使用同一种格式，查询时的参数也会被写成同样的格式，因此两者可以直接比较
+    expr : 时间字段或者参数，例如 NEW.to_validate_date 或者 ?
+    """
+    return (f"(CASE WHEN typeof({expr}) = 'integer' THEN {expr} / 60000 "
+            f"ELSE CAST(strftime('%s', {expr}) AS INTEGER) / 60 END)")
@@ -4,9 +4,10 @@ import sys, os, signal
 sys.path.append(os.path.dirname(__file__) + os.sep + '../')
 from multiprocessing import Process
 import time
-from proc import run_fetcher, run_validator
+from proc import run_fetcher, run_validator, run_db_writer, run_gateway
 from api import api
 import multiprocessing
+from config import DB_WRITER_MODE, GATEWAY_ENABLE
 
 # 导入单实例管理器
 sys.path.append(os.path.join(os.path.dirname(__file__), 'utils'))
@@ -14,10 +15,40 @@ from single_instance import check_single_instance
 
 # 进程锁
 proc_lock = multiprocessing.Lock()
+# 数据库写入队列，仅在DB_WRITER_MODE下使用
+write_queue = multiprocessing.Queue() if DB_WRITER_MODE else None
 
 # 单实例管理器
 instance_manager = None
 
+def _release_proc_lock():
+    """
+    子进程被结束时可能正持有进程锁，解除进程锁
+    使用DB_WRITER_MODE时没有使用进程锁，不需要解除
+    """
+    if DB_WRITER_MODE:
+        return
+    try:
+        proc_lock.release()
+    except ValueError:
+        pass
+
+def _stop_process(p, timeout=10):
+    """
+    结束子进程，等待其退出之后再判断是否需要解除进程锁
+    验证器收到SIGTERM之后会在退出前写入缓冲区中的结果（需要获取进程锁），正常退出（exitcode为0）时锁已经在子进程中释放；
+    只有异常退出或者被强制结束时才可能仍然持有进程锁，此时才解除，避免解除了仍在运行的子进程持有的锁
+    """
+    p.process.terminate()
+    p.process.join(timeout)
+    if p.process.is_alive():
+        print(f'进程{p.name}没有在{timeout}秒内退出，强制终止')
+        p.process.kill()
+        p.process.join()
+    if p.process.exitcode != 0:
+        _release_proc_lock()
+    p.process = None
+
 class Item:
     def __init__(self, target, name):
         self.target = target
@@ -46,12 +77,21 @@ def main():
     processes.append(Item(target=run_fetcher.main, name='fetcher'))
     processes.append(Item(target=run_validator.main, name='validator'))
     processes.append(Item(target=api.main, name='api'))
+    if GATEWAY_ENABLE:
+        processes.append(Item(target=run_gateway.main, name='gateway'))
+    if DB_WRITER_MODE:
+        # 写入进程放在最后，退出时其他进程先结束，写入进程可以写完队列中剩余的操作
+        processes.append(Item(target=run_db_writer.main, name='db_writer'))
+        # 所有写操作都由写入进程完成，不再需要进程锁
+        args = (None, write_queue)
+    else:
+        args = (proc_lock, )
 
     try:
         while True:
             for p in processes:
                 if p.process is None:
-                    p.process = Process(target=p.target, name=p.name, daemon=False, args=(proc_lock, ))
+                    p.process = Process(target=p.target, name=p.name, daemon=False, args=args)
                     p.process.start()
                     print(f'启动{p.name}进程，pid={p.process.pid}')
                     p.start_time = time.time()
@@ -60,22 +100,10 @@ def main():
                 if p.process is not None:
                     if not p.process.is_alive():
                         print(f'进程{p.name}异常退出, exitcode={p.process.exitcode}')
-                        p.process.terminate()
-                        p.process = None
-                        # 解除进程锁
-                        try:
-                            proc_lock.release()
-                        except ValueError:
-                            pass
-                    elif p.start_time + 60 * 60 < time.time(): # 最长运行1小时就重启
+                        _stop_process(p)
+                    elif p.name not in ('db_writer', 'gateway') and p.start_time + 60 * 60 < time.time(): # 最长运行1小时就重启，写入进程不重启，避免两个写入进程同时执行写操作；网关不重启，避免断开正在转发的连接
                         print(f'进程{p.name}运行太久，重启')
-                        p.process.terminate()
-                        p.process = None
-                        # 解除进程锁
-                        try:
-                            proc_lock.release()
-                        except ValueError:
-                            pass
+                        _stop_process(p)
 
             time.sleep(0.2)
     
@@ -0,0 +1,261 @@
+# encoding: utf-8
+"""
+基于asyncio的验证器逻辑
+在一个事件循环中同时进行大量代理的验证，用于替代多线程验证器
+通过config.py中的VALIDATE_ENGINE选择使用哪一种验证器
+"""
+
+import sys
+import ssl
+import asyncio
+import logging
+import time
+from urllib.parse import urlsplit, urljoin
+from concurrent.futures import ThreadPoolExecutor
+from db import conn
+from utils.proxy_connect import open_socket, open_tunnel, run
+from proc.run_validator import Deadline, stats, STATS_REPORT_INTERVAL
+from proc.run_validator import ValidateResultSink, install_exit_handler
+from proc.precheck import precheck, FAILED_RESULTS
+from proc.geo_enricher import GeoEnricher
+from config import PROC_VALIDATOR_SLEEP, VALIDATE_ASYNC_CONCURRENCY
+from config import VALIDATE_METHOD, VALIDATE_KEYWORD, VALIDATE_HEADER, VALIDATE_URL, VALIDATE_TIMEOUT, VALIDATE_MAX_FAILS
+from config import VALIDATE_PROXY_BUDGET, VALIDATE_PRECHECK
+
+logging.basicConfig(stream=sys.stdout, format="%(asctime)s-%(levelname)s:%(name)s:%(message)s", level='INFO')
+
+# GET验证方式下，最多读取的响应体长度
+_MAX_BODY_SIZE = 2 * 1024 * 1024
+# GET验证方式下，最多跟随的重定向次数
+_MAX_REDIRECTS = 5
+
+_ssl_context = ssl.create_default_context()
+
+
+def main(proc_lock, write_queue=None):
+    """
+    异步验证器
+    主要逻辑与多线程验证器一致，区别在于：
+    每个代理的验证是事件循环中的一个协程，同时最多运行VALIDATE_ASYNC_CONCURRENCY个
+    数据库操作放在一个单独的线程中执行，避免阻塞事件循环
+    """
+    logger = logging.getLogger('validator')
+    conn.set_proc_lock(proc_lock)
+    conn.set_write_queue(write_queue)
+    install_exit_handler()
+    raise_nofile_limit(VALIDATE_ASYNC_CONCURRENCY * 2 + 256)
+    sink = ValidateResultSink()
+    enricher = GeoEnricher().start()
+    try:
+        run(_main_loop(logger, sink, enricher))
+    finally:
+        # 退出前将缓冲区中的结果写入数据库
+        flushed = sink.flush()
+        enricher.flush()
+        logger.info(f'退出前写入了{len(flushed)}个代理的验证结果')
+
+
+def raise_nofile_limit(wanted):
+    """
+    同时打开的socket数量可能超过默认的文件描述符限制，尽量调高软限制
+    """
+    try:
+        import resource
+    except ImportError: # Windows
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft == resource.RLIM_INFINITY or soft >= wanted:
+        return
+    if hard != resource.RLIM_INFINITY:
+        wanted = min(wanted, hard)
+    try:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
+    except (ValueError, OSError):
+        pass
+
+
+async def _main_loop(logger, sink, enricher):
+    logger.info(f'使用async验证引擎，最大并发数{VALIDATE_ASYNC_CONCURRENCY}')
+    loop = asyncio.get_event_loop()
+    db_executor = ThreadPoolExecutor(max_workers=1)
+
+    sem = asyncio.Semaphore(VALIDATE_ASYNC_CONCURRENCY)
+    out_que = asyncio.Queue()
+    running_proxies = set() # 储存哪些代理正在运行，以字符串的形式储存
+    tasks = set()
+
+    last_report_time = time.time()
+    while True:
+        results = []
+        while not out_que.empty():
+            results.append(out_que.get_nowait())
+        out_cnt = len(results)
+        flushed = await loop.run_in_executor(db_executor, sink.put_many, results)
+        # 结果写入数据库之后，才能将代理从正在验证的集合中删除，否则可能被重复取出验证
+        # 验证成功但是缺少地理位置信息的代理，交给enricher在后台补全
+        for proxy, success, _ in flushed:
+            uri = f'{proxy.protocol}://{proxy.ip}:{proxy.port}'
+            running_proxies.remove(uri)
+            if success:
+                enricher.submit(proxy)
+        if out_cnt > 0:
+            logger.info(f'完成了{out_cnt}个代理的验证')
+
+        if time.time() - last_report_time >= STATS_REPORT_INTERVAL:
+            logger.info(stats.report())
+            logger.info(sink.report())
+            logger.info(enricher.report())
+            last_report_time = time.time()
+
+        # 如果正在进行验证的代理足够多，那么就不着急添加新代理
+        if len(running_proxies) >= VALIDATE_ASYNC_CONCURRENCY * 2:
+            await asyncio.sleep(PROC_VALIDATOR_SLEEP)
+            continue
+
+        # 找一些新的待验证的代理，为每个代理创建一个验证协程
+        added_cnt = 0
+        proxies = await loop.run_in_executor(db_executor, conn.getToValidate, VALIDATE_ASYNC_CONCURRENCY * 4)
+        for proxy in proxies:
+            uri = f'{proxy.protocol}://{proxy.ip}:{proxy.port}'
+            # 这里找出的代理有可能是正在进行验证的代理，要避免重复加入
+            if uri not in running_proxies:
+                running_proxies.add(uri)
+                task = asyncio.ensure_future(_validate_task(proxy, sem, out_que))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+                added_cnt += 1
+
+        if added_cnt == 0:
+            await asyncio.sleep(PROC_VALIDATOR_SLEEP)
+
+
+async def _validate_task(proxy, sem, out_que):
+    """
+    验证一个代理，并将结果放入out_que
+    如果启用了预检查，未通过预检查的代理直接判定为验证失败
+    """
+    async with sem:
+        result = None
+        if VALIDATE_PRECHECK:
+            result = await precheck(proxy)
+            stats.record_precheck(result)
+        if result in FAILED_RESULTS:
+            success, latency = False, None
+        else:
+            success, latency = await validate_proxy_async(proxy)
+    await out_que.put((proxy, success, latency))
+
+
+async def validate_proxy_async(proxy):
+    """
+    对一个代理最多进行VALIDATE_MAX_FAILS次验证，只要有一次成功就认为代理可用
+    所有尝试共用VALIDATE_PROXY_BUDGET秒的时间预算，与多线程验证器一致
+    返回 : (success, latency)
+    """
+    budget = Deadline(VALIDATE_PROXY_BUDGET)
+    for _ in range(VALIDATE_MAX_FAILS):
+        if budget.expired():
+            stats.record_budget_exhausted()
+            break
+        start_time = time.time()
+        try:
+            if await asyncio.wait_for(validate_once_async(proxy), budget.sub(VALIDATE_TIMEOUT * 2).remaining()):
+                end_time = time.time()
+                stats.record('success', end_time - start_time)
+                return True, int((end_time-start_time)*1000)
+            stats.record('error', time.time() - start_time)
+        except asyncio.TimeoutError:
+            stats.record('timeout', time.time() - start_time)
+        except Exception:
+            stats.record('error', time.time() - start_time)
+    return False, None
+
+
+async def validate_once_async(proxy):
+    """
+    进行一次验证，如果验证成功则返回True，否则返回False或者是异常
+    判断逻辑与run_validator.validate_once一致：
+    GET方式跟随重定向，在响应内容中查找VALIDATE_KEYWORD
+    HEAD方式不跟随重定向，在响应头VALIDATE_HEADER中查找VALIDATE_KEYWORD
+    """
+    if VALIDATE_METHOD == "GET":
+        url = VALIDATE_URL
+        for _ in range(_MAX_REDIRECTS + 1):
+            status, headers, body = await _http_get(proxy, url, read_body=True)
+            if status in (301, 302, 303, 307, 308) and 'location' in headers:
+                url = urljoin(url, headers['location'])
+                continue
+            html = body.decode('utf-8', 'replace')
+            return VALIDATE_KEYWORD in html
+        return False
+    else:
+        status, headers, _ = await _http_get(proxy, VALIDATE_URL, read_body=False)
+        header = VALIDATE_HEADER.lower()
+        if header in headers and VALIDATE_KEYWORD in headers[header]:
+            return True
+        return False
+
+
+async def _http_get(proxy, url, read_body):
+    """
+    通过代理发送一次GET请求
+    对于HTTP目标地址和HTTP代理，直接向代理发送完整URL的请求；其他情况先通过代理建立隧道
+    为了避免处理分块传输编码，请求使用HTTP/1.0
+    返回 : (状态码, 响应头dict（字段名为小写）, 响应体bytes)
+    """
+    parts = urlsplit(url)
+    https = parts.scheme == 'https'
+    host = parts.hostname
+    port = parts.port or (443 if https else 80)
+    path = parts.path or '/'
+    if parts.query:
+        path = path + '?' + parts.query
+
+    if not https and proxy.protocol in ('http', 'https'):
+        sock = await open_socket(proxy.ip, proxy.port)
+        target = url
+    else:
+        sock = await open_tunnel(proxy.protocol, proxy.ip, proxy.port, host, port)
+        target = path
+
+    try:
+        reader, writer = await asyncio.open_connection(
+            sock=sock,
+            ssl=_ssl_context if https else None,
+            server_hostname=host if https else None
+        )
+    except BaseException:
+        sock.close()
+        raise
+
+    try:
+        request = (
+            f'GET {target} HTTP/1.0\r\n'
+            f'Host: {parts.netloc}\r\n'
+            'User-Agent: Mozilla/5.0\r\n'
+            'Accept: */*\r\n'
+            'Accept-Encoding: identity\r\n'
+            'Connection: close\r\n'
+            '\r\n'
+        )
+        writer.write(request.encode('utf-8'))
+        await writer.drain()
+
+        head = await reader.readuntil(b'\r\n\r\n')
+        lines = head.decode('iso-8859-1').split('\r\n')
+        status = int(lines[0].split()[1])
+        headers = {}
+        for line in lines[1:]:
+            if ':' in line:
+                key, value = line.split(':', 1)
+                headers[key.strip().lower()] = value.strip()
+
+        body = b''
+        while read_body and len(body) < _MAX_BODY_SIZE:
+            chunk = await reader.read(65536)
+            if not chunk:
+                break
+            body += chunk
+        return status, headers, body
+    finally:
+        writer.close()
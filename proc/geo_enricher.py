@@ -0,0 +1,151 @@
+# encoding: utf-8
+"""
+IP地理位置补全
+验证成功但是缺少国家和地址信息的代理，由验证器交给GeoEnricher，
+GeoEnricher在单独的线程中查询地理位置并批量写回数据库，
+避免查询地理位置的网络请求阻塞验证结果的写入
+"""
+
+import sys
+import threading
+import logging
+import time
+from collections import deque
+from db import conn
+from utils.ip_location import fetch_ip_location, peek_ip_location_cached, get_ip_cache_stats, take_ip_cache_unsaved
+from config import GEO_ENRICH_RATE_PER_MINUTE, GEO_ENRICH_QUEUE_SIZE, GEO_ENRICH_BATCH_SIZE, GEO_ENRICH_FLUSH_INTERVAL
+
+logging.basicConfig(stream=sys.stdout, format="%(asctime)s-%(levelname)s:%(name)s:%(message)s", level='INFO')
+
+class TokenBucket(object):
+    """
+    令牌桶，用于限制调用地理位置查询接口的频率
+    rate : 每秒产生的令牌数量
+    capacity : 桶中最多存放的令牌数量
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_time) * self.rate)
+        self.last_time = now
+
+    def acquire(self):
+        """
+        取出一个令牌，如果没有令牌则等待
+        """
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+class GeoEnricher(object):
+    """
+    地理位置补全器
+    submit放入需要补全的代理，后台线程按IP去重之后查询地理位置，结果攒够一批或者超过一定时间之后写入数据库
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger('geo_enricher')
+        self.bucket = TokenBucket(GEO_ENRICH_RATE_PER_MINUTE / 60, GEO_ENRICH_RATE_PER_MINUTE)
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.pending = deque() # 等待查询的IP
+        self.in_flight = set() # 等待查询以及正在查询的IP，用于去重
+        self.results = []      # 等待写入数据库的结果，list[(ip, country, address)]
+        self.last_flush_time = time.time()
+        self.thread = threading.Thread(target=self._run, name='geo_enricher', daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def submit(self, proxy):
+        """
+        放入一个验证成功的代理，如果它缺少地理位置信息，则排队查询
+        这个函数不会阻塞，队列已满时直接丢弃，代理下次验证成功时会再次放入
+        """
+        if proxy.country is not None and proxy.address is not None:
+            return
+        with self.lock:
+            if proxy.ip in self.in_flight or len(self.pending) >= GEO_ENRICH_QUEUE_SIZE:
+                return
+            self.in_flight.add(proxy.ip)
+            self.pending.append(proxy.ip)
+            self.cond.notify()
+
+    def _run(self):
+        while True:
+            with self.lock:
+                if not self.pending:
+                    self.cond.wait(timeout=GEO_ENRICH_FLUSH_INTERVAL)
+                ip = self.pending.popleft() if self.pending else None
+
+            if ip is not None:
+                self._lookup(ip)
+
+            if len(self.results) >= GEO_ENRICH_BATCH_SIZE or time.time() - self.last_flush_time >= GEO_ENRICH_FLUSH_INTERVAL:
+                self.flush()
+
+    def _lookup(self, ip):
+        try:
+            location = peek_ip_location_cached(ip)
+            if location is None:
+                # 只有真正需要访问接口时才消耗令牌；peek已经查过缓存，这里不再查询，避免未命中被统计两次
+                self.bucket.acquire()
+                location = fetch_ip_location(ip)
+            country = location.get('country', '未知')
+            address = location.get('address', '无法获取')
+            with self.lock:
+                self.results.append((ip, country, address))
+        except Exception as e:
+            self.logger.warning(f'获取IP地理位置失败 {ip}: {e}')
+            with self.lock:
+                self.in_flight.discard(ip)
+
+    def flush(self):
+        """
+        将查询到的地理位置写入数据库，同时保存IP地理位置缓存中新增的结果
+        """
+        with self.lock:
+            results = self.results
+            self.results = []
+        self.last_flush_time = time.time()
+        cached, expire_before = take_ip_cache_unsaved()
+        try:
+            if cached or expire_before is not None:
+                conn.pushIPLocations(cached, expire_before)
+        except Exception as e:
+            self.logger.error(f'保存IP地理位置缓存失败: {e}')
+        if not results:
+            return
+        try:
+            conn.pushProxyLocationBatch(results)
+            self.logger.info(f'写入了{len(results)}个IP的地理位置信息')
+        except Exception as e:
+            self.logger.error(f'写入IP地理位置信息失败: {e}')
+        finally:
+            with self.lock:
+                for ip, _, _ in results:
+                    self.in_flight.discard(ip)
+
+    def report(self):
+        """
+        返回一行便于阅读的地理位置查询统计信息
+        """
+        with self.lock:
+            pending = len(self.pending)
+        stats = get_ip_cache_stats()
+        return (f"地理位置：等待查询{pending}个，缓存{stats['size']}个，命中率{stats['hit_rate'] * 100:.1f}%"
+                f"（内存{stats['hits']}次，数据库{stats['disk_hits']}次，未命中{stats['misses']}次），"
+                f"过期{stats['expired']}个，淘汰{stats['evictions']}个")
@@ -0,0 +1,94 @@
+# encoding: utf-8
+"""
+验证前的预检查
+大部分新爬取到的代理都是不可用的，在进行完整的HTTP验证之前，
+先以很短的超时时间批量尝试TCP连接（可选进行代理协议握手），
+连接被拒绝、无法连接或者握手被拒绝的代理直接判定为验证失败，不再进行完整验证
+"""
+
+import errno
+import asyncio
+from urllib.parse import urlsplit
+from utils.proxy_connect import open_socket, handshake, run, ProxyHandshakeError
+from config import VALIDATE_URL
+from config import VALIDATE_PRECHECK_HANDSHAKE, VALIDATE_PRECHECK_TIMEOUT, VALIDATE_PRECHECK_CONCURRENCY
+
+# 预检查结果
+PASSED = 'passed'       # 连接及握手成功
+SLOW = 'slow'           # 可以连接，但是握手超时，交给完整验证判断
+REFUSED = 'refused'     # 连接被拒绝或者网络不可达
+TIMEOUT = 'timeout'     # 连接超时
+REJECTED = 'rejected'   # 可以连接，但不是可用的代理服务器（握手失败）
+UNKNOWN = 'unknown'     # 其他错误，交给完整验证判断
+
+# 这些结果的代理会直接判定为验证失败
+FAILED_RESULTS = (REFUSED, TIMEOUT, REJECTED)
+
+_UNREACHABLE_ERRNOS = (errno.ECONNREFUSED, errno.ECONNRESET, errno.EHOSTUNREACH, errno.ENETUNREACH)
+
+def _handshake_target():
+    """
+    预检查握手时使用的目标地址，与完整验证的目标地址一致
+    返回 : (host, port, https)
+    """
+    parts = urlsplit(VALIDATE_URL)
+    https = parts.scheme == 'https'
+    return parts.hostname, parts.port or (443 if https else 80), https
+
+async def precheck(proxy):
+    """
+    对一个代理进行预检查
+    返回 : 预检查结果，见本文件开头的定义
+    """
+    loop = asyncio.get_event_loop()
+    start_time = loop.time()
+    try:
+        sock = await asyncio.wait_for(open_socket(proxy.ip, proxy.port), VALIDATE_PRECHECK_TIMEOUT)
+    except asyncio.TimeoutError:
+        return TIMEOUT
+    except OSError as e:
+        if isinstance(e, ConnectionError) or e.errno in _UNREACHABLE_ERRNOS:
+            return REFUSED
+        return UNKNOWN
+
+    try:
+        host, port, https = _handshake_target()
+        # 目标地址为HTTP时，HTTP代理是直接转发请求的，不一定支持CONNECT，因此只检查TCP连接
+        if not VALIDATE_PRECHECK_HANDSHAKE or (not https and proxy.protocol in ('http', 'https')):
+            return PASSED
+        remaining = VALIDATE_PRECHECK_TIMEOUT - (loop.time() - start_time)
+        try:
+            await asyncio.wait_for(handshake(sock, proxy.protocol, host, port), max(remaining, 0.1))
+        except asyncio.TimeoutError:
+            return SLOW
+        except ProxyHandshakeError:
+            return REJECTED
+        except ConnectionError:
+            return REJECTED
+        except Exception:
+            return UNKNOWN
+        return PASSED
+    finally:
+        sock.close()
+
+async def precheck_many(proxies):
+    """
+    同时对多个代理进行预检查，最多同时进行VALIDATE_PRECHECK_CONCURRENCY个连接
+    返回 : list，与proxies一一对应的预检查结果
+    """
+    sem = asyncio.Semaphore(VALIDATE_PRECHECK_CONCURRENCY)
+
+    async def limited(proxy):
+        async with sem:
+            return await precheck(proxy)
+
+    return await asyncio.gather(*[limited(p) for p in proxies])
+
+def precheck_batch(proxies):
+    """
+    预检查的同步版本，供多线程验证器使用，在当前线程中运行一个事件循环
+    返回 : list，与proxies一一对应的预检查结果
+    """
+    if len(proxies) == 0:
+        return []
+    return run(precheck_many(proxies))
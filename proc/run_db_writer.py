@@ -0,0 +1,85 @@
+# encoding: utf-8
+"""
+数据库写入进程
+启用DB_WRITER_MODE之后，爬取器、验证器、API进程的所有写操作都通过队列发送到本进程，
+由本进程合并成批在一个事务中写入数据库，其他进程只读取数据库，不再需要进程锁
+"""
+
+import sys
+import time
+import queue
+import signal
+import logging
+from db import conn
+from config import DB_WRITER_BATCH_SIZE
+
+logging.basicConfig(stream=sys.stdout, format="%(asctime)s-%(levelname)s:%(name)s:%(message)s", level='INFO')
+
+STATS_REPORT_INTERVAL = 60
+
+def main(proc_lock, write_queue):
+    """
+    数据库写入进程
+    主要逻辑：
+    While True:
+        从队列中取出一个写操作，再取出当前队列中已有的写操作，最多DB_WRITER_BATCH_SIZE个
+        在一个事务中执行这些写操作
+    收到SIGTERM之后，写入队列中剩余的操作再退出
+    """
+    logger = logging.getLogger('db_writer')
+    conn.set_proc_lock(proc_lock)
+
+    stopping = []
+    def handler(signum, frame):
+        stopping.append(signum)
+    signal.signal(signal.SIGTERM, handler)
+    # 按下Ctrl+C时由main进程负责结束各个进程，写入进程不能在写入途中被打断
+    signal.signal(signal.SIGINT, handler)
+
+    op_cnt, commit_cnt, error_cnt, commit_seconds = 0, 0, 0, 0
+    last_report_time = time.time()
+    while True:
+        batch = []
+        try:
+            batch.append(write_queue.get(timeout=0.5 if not stopping else 0))
+        except queue.Empty:
+            if stopping:
+                break
+        while 0 < len(batch) < DB_WRITER_BATCH_SIZE:
+            try:
+                batch.append(write_queue.get_nowait())
+            except queue.Empty:
+                break
+
+        if batch:
+            start_time = time.time()
+            try:
+                errors = conn.applyWriteBatch(batch)
+            except Exception as e:
+                logger.error(f'写入{len(batch)}个操作失败：{e}')
+                error_cnt += len(batch)
+            else:
+                for name, msg in errors:
+                    logger.error(f'写操作{name}出错：{msg}')
+                op_cnt += len(batch) - len(errors)
+                error_cnt += len(errors)
+                commit_cnt += 1
+            commit_seconds += time.time() - start_time
+
+        if time.time() - last_report_time >= STATS_REPORT_INTERVAL:
+            seconds = time.time() - last_report_time
+            logger.info(f'最近{seconds:.0f}秒：执行写操作{op_cnt}个，出错{error_cnt}个，提交{commit_cnt}次，'
+                        f'写入耗时{commit_seconds:.2f}秒，队列中约有{_queue_size(write_queue)}个操作等待写入')
+            op_cnt, commit_cnt, error_cnt, commit_seconds = 0, 0, 0, 0
+            last_report_time = time.time()
+
+    logger.info('数据库写入进程退出')
+
+def _queue_size(q):
+    """
+    队列的大致长度，部分平台不支持时返回-1
+    """
+    try:
+        return q.qsize()
+    except NotImplementedError:
+        return -1
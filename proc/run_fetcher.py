@@ -16,7 +16,7 @@ from func_timeout.exceptions import FunctionTimedOut
 
 logging.basicConfig(stream=sys.stdout, format="%(asctime)s-%(levelname)s:%(name)s:%(message)s", level='INFO')
 
-def main(proc_lock):
+def main(proc_lock, write_queue=None):
     """
     定时运行爬取器
     主要逻辑：
@@ -30,6 +30,7 @@ def main(proc_lock):
     """
     logger = logging.getLogger('fetcher')
     conn.set_proc_lock(proc_lock)
+    conn.set_write_queue(write_queue)
 
     while True:
         logger.info('开始运行一轮爬取器')
@@ -75,22 +76,25 @@ def main(proc_lock):
         [t.join() for t in threads]
         while not que.empty():
             fetcher_name, proxies = que.get()
+            rows = []
             for proxy in proxies:
                 # 支持多种格式：
                 # 1. (protocol, ip, port) - 只有代理
                 # 2. (protocol, ip, port, username, password) - 有认证
                 # 3. (protocol, ip, port, username, password, country, address) - 完整信息
                 if len(proxy) == 3:
-                    protocol, ip, port = proxy
-                    conn.pushNewFetch(fetcher_name, protocol, ip, port)
+                    rows.append(tuple(proxy) + (None, None, None, None))
                 elif len(proxy) == 5:
-                    protocol, ip, port, username, password = proxy
-                    conn.pushNewFetch(fetcher_name, protocol, ip, port, username, password)
+                    rows.append(tuple(proxy) + (None, None))
                 elif len(proxy) == 7:
-                    protocol, ip, port, username, password, country, address = proxy
-                    conn.pushNewFetch(fetcher_name, protocol, ip, port, username, password, country, address)
+                    rows.append(tuple(proxy))
                 else:
                     logger.warning(f'爬取器{fetcher_name}返回了格式错误的代理: {proxy}，长度={len(proxy)}')
+            start_time = time.time()
+            conn.pushNewFetchBatch(fetcher_name, rows)
+            elapsed = time.time() - start_time
+            if len(rows) > 0:
+                logger.info(f'爬取器{fetcher_name}：写入{len(rows)}个代理，耗时{elapsed:.3f}秒（{len(rows) / max(elapsed, 1e-6):.0f}个/秒）')
             conn.pushFetcherResult(fetcher_name, len(proxies))
         
         logger.info(f'完成运行{len(threads)}个爬取器，睡眠{PROC_FETCHER_SLEEP}秒')
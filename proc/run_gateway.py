@@ -0,0 +1,442 @@
+# encoding: utf-8
+"""
+代理网关
+在GATEWAY_HOST:GATEWAY_PORT上监听，同一个端口同时作为HTTP代理（CONNECT以及普通的HTTP请求）和SOCKS5代理（根据第一个字节区分），
+每个客户端连接从可用代理中随机选择一个上游代理，通过上游代理建立到目标地址的隧道之后，在两个socket之间转发数据；
+连接上游代理失败时，在GATEWAY_CONNECT_BUDGET秒的时间预算内换一个上游代理重试，最多尝试GATEWAY_MAX_ATTEMPTS个
+可用代理来自与API进程相同的内存索引（ProxyPoolIndex），不需要每个连接都查询数据库
+所有连接都在一个asyncio事件循环中处理，转发时每个方向使用一个固定的缓冲区（sock_recv_into，Python 3.7及以上），不为每次读取分配新的bytes
+从索引中选择上游代理可能需要等待索引刷新，因此放在单独的线程中进行，不阻塞事件循环
+直接向网关发送 GET /status 可以查看当前的连接数以及各个上游代理的错误率，统计信息也会定期输出到日志中
+"""
+
+import sys
+import json
+import time
+import socket
+import struct
+import asyncio
+import logging
+import ipaddress
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+from db import conn
+from api.pool_index import ProxyPoolIndex
+from utils.proxy_connect import open_tunnel, run, ProxyHandshakeError
+from proc.run_validator import Deadline, install_exit_handler, STATS_REPORT_INTERVAL
+from proc.async_validator import raise_nofile_limit
+from config import API_POOL_REFRESH_INTERVAL, API_POOL_MAX_STALENESS, API_POOL_FULL_RESYNC_INTERVAL
+from config import GATEWAY_HOST, GATEWAY_PORT, GATEWAY_MAX_CONNECTIONS, GATEWAY_CONNECT_TIMEOUT, GATEWAY_CONNECT_BUDGET
+from config import GATEWAY_MAX_ATTEMPTS, GATEWAY_IDLE_TIMEOUT, GATEWAY_BUFFER_SIZE
+
+logging.basicConfig(stream=sys.stdout, format="%(asctime)s-%(levelname)s:%(name)s:%(message)s", level='INFO')
+
+# 客户端请求头的最大长度
+_MAX_HEAD_SIZE = 65536
+# 最多记录多少个上游代理的错误率，超过之后淘汰最久没有使用的
+_MAX_UPSTREAM_STATS = 2000
+# 检查空闲连接的间隔，单位s
+_SWEEP_INTERVAL = 10
+# 普通HTTP请求转发给目标服务器时去掉的请求头
+_HOP_HEADERS = (b'proxy-connection', b'proxy-authorization', b'connection', b'keep-alive')
+
+
+class GatewayStats(object):
+    """
+    网关的统计信息，只在事件循环所在的线程中修改，不需要加锁
+    """
+
+    def __init__(self):
+        self.start_time = time.time()
+        self.active = 0 # 当前的客户端连接数
+        self.counters = dict(
+            total=0,        # 客户端连接总数
+            connected=0,    # 成功建立隧道的连接数
+            failover=0,     # 换一个上游代理重试的次数
+            no_upstream=0,  # 没有可用代理的连接数
+            failed=0,       # 所有尝试都失败的连接数
+            bad_request=0,  # 无法解析的请求
+            idle_closed=0,  # 因为空闲太久而关闭的连接数
+            bytes_up=0,     # 客户端发送给目标地址的字节数
+            bytes_down=0    # 目标地址发送给客户端的字节数
+        )
+        self.upstreams = OrderedDict() # 'protocol://ip:port' -> [尝试次数, 失败次数]，按最近使用排序
+
+    def record_upstream(self, key, success):
+        """
+        记录一次连接上游代理的结果
+        """
+        item = self.upstreams.pop(key, None)
+        if item is None:
+            item = [0, 0]
+            if len(self.upstreams) >= _MAX_UPSTREAM_STATS:
+                self.upstreams.popitem(last=False)
+        item[0] += 1
+        if not success:
+            item[1] += 1
+        self.upstreams[key] = item
+
+    def report(self, top=20):
+        """
+        返回统计信息，upstreams为失败次数最多的top个上游代理
+        """
+        attempts = sum(item[0] for item in self.upstreams.values())
+        failures = sum(item[1] for item in self.upstreams.values())
+        worst = sorted(self.upstreams.items(), key=lambda kv: (kv[1][1], kv[1][0]), reverse=True)[:top]
+        return dict(
+            active=self.active,
+            uptime=int(time.time() - self.start_time),
+            upstream_attempts=attempts,
+            upstream_error_rate=round(failures / attempts, 4) if attempts else 0,
+            upstreams=[dict(upstream=key, attempts=a, failures=f, error_rate=round(f / a, 4)) for key, (a, f) in worst],
+            **self.counters
+        )
+
+
+class _ClientReader(object):
+    """
+    从客户端socket读取握手数据，多读到的数据保存在buf中，建立隧道之后转发给目标地址
+    """
+
+    def __init__(self, loop, sock):
+        self.loop = loop
+        self.sock = sock
+        self.buf = bytearray()
+
+    async def _fill(self):
+        data = await self.loop.sock_recv(self.sock, 4096)
+        if not data:
+            raise ConnectionError('客户端关闭了连接')
+        self.buf += data
+
+    async def read_exactly(self, n):
+        while len(self.buf) < n:
+            await self._fill()
+        data = bytes(self.buf[:n])
+        del self.buf[:n]
+        return data
+
+    async def read_until(self, sep, limit):
+        while True:
+            i = self.buf.find(sep)
+            if i >= 0:
+                data = bytes(self.buf[:i + len(sep)])
+                del self.buf[:i + len(sep)]
+                return data
+            if len(self.buf) >= limit:
+                raise ValueError('请求头过长')
+            await self._fill()
+
+    async def peek(self):
+        if not self.buf:
+            await self._fill()
+        return self.buf[0]
+
+
+class _Connection(object):
+    """
+    一个客户端连接的状态，用于关闭空闲连接
+    """
+
+    __slots__ = ('last_active', 'task')
+
+    def __init__(self, loop):
+        self.last_active = loop.time()
+        self.task = None
+
+
+class Gateway(object):
+    """
+    代理网关
+    index : ProxyPoolIndex，可用代理索引
+    """
+
+    def __init__(self, index):
+        self.logger = logging.getLogger('gateway')
+        self.index = index
+        self.stats = GatewayStats()
+        self.connections = set()
+        # index.pick在索引过期时会同步刷新，并且与后台刷新线程竞争锁，不能在事件循环中直接调用
+        self.pick_executor = ThreadPoolExecutor(max_workers=2)
+
+    def _pick_upstream(self, tried):
+        """
+        随机选择一个还没有尝试过的可用代理，在pick_executor中运行
+        返回 : Proxy，没有可用代理时返回None
+        """
+        for _ in range(10):
+            p = self.index.pick()
+            if p is None:
+                return None
+            if f'{p.protocol}://{p.ip}:{p.port}' not in tried:
+                return p
+        return None
+
+    async def connect_upstream(self, host, port):
+        """
+        通过上游代理建立到host:port的隧道，失败时在时间预算内换一个上游代理重试
+        返回 : 已完成握手的非阻塞socket；没有可用代理时返回None，所有尝试都失败时抛出ConnectionError
+        """
+        loop = asyncio.get_event_loop()
+        budget = Deadline(GATEWAY_CONNECT_BUDGET)
+        tried = set()
+        for attempt in range(GATEWAY_MAX_ATTEMPTS):
+            if budget.expired():
+                break
+            p = await loop.run_in_executor(self.pick_executor, self._pick_upstream, tried)
+            if p is None:
+                if attempt == 0:
+                    self.stats.counters['no_upstream'] += 1
+                    return None
+                break
+            key = f'{p.protocol}://{p.ip}:{p.port}'
+            tried.add(key)
+            if attempt > 0:
+                self.stats.counters['failover'] += 1
+            try:
+                sock = await asyncio.wait_for(
+                    open_tunnel(p.protocol, p.ip, p.port, host, port, p.username, p.password),
+                    budget.sub(GATEWAY_CONNECT_TIMEOUT).remaining()
+                )
+            except (OSError, asyncio.TimeoutError, ProxyHandshakeError):
+                self.stats.record_upstream(key, False)
+                continue
+            self.stats.record_upstream(key, True)
+            return sock
+        self.stats.counters['failed'] += 1
+        raise ConnectionError(f'连接{host}:{port}失败，尝试了{len(tried)}个上游代理')
+
+    async def _pipe(self, loop, src, dst, state, counter):
+        """
+        将src读到的数据转发给dst，直到src关闭
+        每个方向使用一个固定的缓冲区，读取时直接写入缓冲区，发送时使用memoryview，不复制数据
+        """
+        buf = bytearray(GATEWAY_BUFFER_SIZE)
+        view = memoryview(buf)
+        recv_into = getattr(loop, 'sock_recv_into', None) # Python 3.6没有sock_recv_into
+        counters = self.stats.counters
+        try:
+            while True:
+                if recv_into is not None:
+                    n = await recv_into(src, buf)
+                    data = view[:n]
+                else:
+                    data = await loop.sock_recv(src, GATEWAY_BUFFER_SIZE)
+                    n = len(data)
+                if n == 0:
+                    break
+                await loop.sock_sendall(dst, data)
+                counters[counter] += n
+                state.last_active = loop.time()
+        except OSError:
+            pass
+        finally:
+            # 通知另一端不会再有数据，另一个方向的转发仍然继续
+            try:
+                dst.shutdown(socket.SHUT_WR)
+            except OSError:
+                pass
+
+    async def _relay(self, loop, client, upstream, state, initial=b''):
+        """
+        在客户端和上游之间双向转发数据
+        initial : 握手时多读到的客户端数据，先发送给上游
+        """
+        if initial:
+            await loop.sock_sendall(upstream, initial)
+        await asyncio.gather(
+            self._pipe(loop, client, upstream, state, 'bytes_up'),
+            self._pipe(loop, upstream, client, state, 'bytes_down')
+        )
+
+    async def _handle_socks5(self, loop, client, reader, state):
+        """
+        SOCKS5，只支持无认证和CONNECT命令
+        """
+        _, nmethods = await reader.read_exactly(2)
+        methods = await reader.read_exactly(nmethods)
+        if 0 not in methods:
+            await loop.sock_sendall(client, b'\x05\xff')
+            self.stats.counters['bad_request'] += 1
+            return
+        await loop.sock_sendall(client, b'\x05\x00')
+
+        ver, cmd, _, atyp = await reader.read_exactly(4)
+        if atyp == 1:
+            host = str(ipaddress.IPv4Address(await reader.read_exactly(4)))
+        elif atyp == 4:
+            host = str(ipaddress.IPv6Address(await reader.read_exactly(16)))
+        elif atyp == 3:
+            length = (await reader.read_exactly(1))[0]
+            host = (await reader.read_exactly(length)).decode('idna')
+        else:
+            await loop.sock_sendall(client, b'\x05\x08\x00\x01\x00\x00\x00\x00\x00\x00')
+            self.stats.counters['bad_request'] += 1
+            return
+        port, = struct.unpack('>H', await reader.read_exactly(2))
+        if ver != 5 or cmd != 1:
+            await loop.sock_sendall(client, b'\x05\x07\x00\x01\x00\x00\x00\x00\x00\x00')
+            self.stats.counters['bad_request'] += 1
+            return
+
+        try:
+            upstream = await self.connect_upstream(host, port)
+        except ConnectionError:
+            upstream = None
+        if upstream is None:
+            await loop.sock_sendall(client, b'\x05\x01\x00\x01\x00\x00\x00\x00\x00\x00')
+            return
+        try:
+            await loop.sock_sendall(client, b'\x05\x00\x00\x01\x00\x00\x00\x00\x00\x00')
+            self.stats.counters['connected'] += 1
+            await self._relay(loop, client, upstream, state, bytes(reader.buf))
+        finally:
+            upstream.close()
+
+    async def _handle_http(self, loop, client, reader, state):
+        """
+        HTTP代理，CONNECT请求建立隧道；普通的HTTP请求（绝对URL）通过隧道连接目标服务器之后转发，并在响应之后关闭连接
+        GET /status 返回网关的统计信息
+        """
+        head = await reader.read_until(b'\r\n\r\n', _MAX_HEAD_SIZE)
+        request_line, _, header_block = head.partition(b'\r\n')
+        parts = request_line.split()
+        if len(parts) != 3:
+            await self._http_response(loop, client, 400, 'Bad Request')
+            return
+        method, target, version = parts
+
+        if method == b'CONNECT':
+            host, _, port = target.decode('ascii', 'replace').rpartition(':')
+            host = host.strip('[]')
+            forward = None
+        elif target.startswith(b'http://'):
+            url = urlsplit(target.decode('ascii', 'replace'))
+            host, port = url.hostname, url.port or 80
+            path = (url.path or '/') + ('?' + url.query if url.query else '')
+            headers = [line for line in header_block.split(b'\r\n')
+                       if line and line.split(b':', 1)[0].strip().lower() not in _HOP_HEADERS]
+            forward = b'\r\n'.join([b' '.join([method, path.encode('ascii'), version])] + headers + [b'Connection: close']) + b'\r\n\r\n'
+        elif method == b'GET' and target == b'/status':
+            body = json.dumps(dict(self.stats.report(), pool_size=self.index.report()['size']), ensure_ascii=False)
+            await self._http_response(loop, client, 200, 'OK', body, 'application/json; charset=utf-8')
+            return
+        else:
+            await self._http_response(loop, client, 400, 'Bad Request')
+            self.stats.counters['bad_request'] += 1
+            return
+        try:
+            port = int(port)
+        except (TypeError, ValueError):
+            port = 0
+        if not host or not 0 < port < 65536:
+            await self._http_response(loop, client, 400, 'Bad Request')
+            self.stats.counters['bad_request'] += 1
+            return
+
+        try:
+            upstream = await self.connect_upstream(host, port)
+        except ConnectionError as e:
+            await self._http_response(loop, client, 502, 'Bad Gateway', str(e))
+            return
+        if upstream is None:
+            await self._http_response(loop, client, 503, 'Service Unavailable', '没有可用代理')
+            return
+        try:
+            self.stats.counters['connected'] += 1
+            if forward is None:
+                await loop.sock_sendall(client, b'HTTP/1.1 200 Connection established\r\n\r\n')
+                await self._relay(loop, client, upstream, state, bytes(reader.buf))
+            else:
+                await self._relay(loop, client, upstream, state, forward + bytes(reader.buf))
+        finally:
+            upstream.close()
+
+    @staticmethod
+    async def _http_response(loop, client, status, reason, body='', content_type='text/plain; charset=utf-8'):
+        data = body.encode('utf-8')
+        head = (f'HTTP/1.1 {status} {reason}\r\nContent-Type: {content_type}\r\n'
+                f'Content-Length: {len(data)}\r\nConnection: close\r\n\r\n')
+        await loop.sock_sendall(client, head.encode('utf-8') + data)
+
+    async def _handle_client(self, loop, client, state):
+        self.stats.active += 1
+        self.stats.counters['total'] += 1
+        try:
+            reader = _ClientReader(loop, client)
+            if await reader.peek() == 5:
+                await self._handle_socks5(loop, client, reader, state)
+            else:
+                await self._handle_http(loop, client, reader, state)
+        except (ConnectionError, ValueError, UnicodeError):
+            self.stats.counters['bad_request'] += 1
+        except OSError:
+            pass
+        finally:
+            self.stats.active -= 1
+            client.close()
+
+    async def _sweep(self, loop):
+        """
+        定期关闭空闲太久的连接，并输出统计信息
+        """
+        last_report_time = time.time()
+        while True:
+            await asyncio.sleep(_SWEEP_INTERVAL)
+            deadline = loop.time() - GATEWAY_IDLE_TIMEOUT
+            for state in [s for s in self.connections if s.last_active < deadline]:
+                state.task.cancel()
+                self.stats.counters['idle_closed'] += 1
+            if time.time() - last_report_time >= STATS_REPORT_INTERVAL:
+                report = self.stats.report(top=5)
+                self.logger.info(f'网关统计：{json.dumps(report, ensure_ascii=False)}')
+                last_report_time = time.time()
+
+    async def serve(self, host, port):
+        loop = asyncio.get_event_loop()
+        family, _, _, _, sockaddr = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM, flags=socket.AI_PASSIVE)[0]
+        server = socket.socket(family, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind(sockaddr)
+        server.listen(1024)
+        server.setblocking(False)
+        self.logger.info(f'代理网关监听在{host}:{port}（HTTP/SOCKS5）')
+
+        sweeper = asyncio.ensure_future(self._sweep(loop))
+        sem = asyncio.Semaphore(GATEWAY_MAX_CONNECTIONS)
+        try:
+            while True:
+                # 连接数达到上限时不再accept，新的连接在内核的队列中等待
+                await sem.acquire()
+                try:
+                    client, _ = await loop.sock_accept(server)
+                except OSError as e:
+                    sem.release()
+                    self.logger.error(f'accept失败：{e}')
+                    await asyncio.sleep(0.1)
+                    continue
+                client.setblocking(False)
+                client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                state = _Connection(loop)
+                state.task = asyncio.ensure_future(self._handle_client(loop, client, state))
+                self.connections.add(state)
+                state.task.add_done_callback(lambda _, state=state: (self.connections.discard(state), sem.release()))
+        finally:
+            sweeper.cancel()
+            server.close()
+            self.pick_executor.shutdown(wait=False)
+
+
+def main(proc_lock, write_queue=None):
+    """
+    代理网关进程
+    """
+    logger = logging.getLogger('gateway')
+    conn.set_proc_lock(proc_lock)
+    conn.set_write_queue(write_queue)
+    install_exit_handler()
+    raise_nofile_limit(GATEWAY_MAX_CONNECTIONS * 2 + 256)
+    index = ProxyPoolIndex(API_POOL_MAX_STALENESS, API_POOL_REFRESH_INTERVAL, API_POOL_FULL_RESYNC_INTERVAL).start()
+    logger.info(f'可用代理索引加载完成，共{index.report()["size"]}个代理')
+    run(Gateway(index).serve(GATEWAY_HOST, GATEWAY_PORT))
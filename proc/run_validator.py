@@ -4,21 +4,270 @@
 """
 
 import sys
+import signal
 import socket
 import threading
 from queue import Queue
 import logging
 import time
 import requests
-from func_timeout import func_set_timeout
-from func_timeout.exceptions import FunctionTimedOut
+from urllib3.exceptions import ReadTimeoutError
 from db import conn
-from config import PROC_VALIDATOR_SLEEP, VALIDATE_THREAD_NUM
+from config import PROC_VALIDATOR_SLEEP, VALIDATE_THREAD_NUM, VALIDATE_ENGINE
 from config import VALIDATE_METHOD, VALIDATE_KEYWORD, VALIDATE_HEADER, VALIDATE_URL, VALIDATE_TIMEOUT, VALIDATE_MAX_FAILS
+from config import VALIDATE_PROXY_BUDGET, VALIDATE_PRECHECK
+from config import VALIDATE_SINK_BATCH_SIZE, VALIDATE_SINK_FLUSH_INTERVAL
+from proc.precheck import precheck_batch, FAILED_RESULTS
+from proc.geo_enricher import GeoEnricher
 
 logging.basicConfig(stream=sys.stdout, format="%(asctime)s-%(levelname)s:%(name)s:%(message)s", level='INFO')
 
-def main(proc_lock):
+# 验证统计信息的输出间隔，单位秒
+STATS_REPORT_INTERVAL = 60
+
+class DeadlineExceeded(Exception):
+    """
+    本次验证超过了截止时间
+    """
+    pass
+
+class Deadline(object):
+    """
+    截止时间，验证过程中主动检查是否超时，不需要为每次验证额外创建线程
+    """
+
+    def __init__(self, seconds):
+        self.expire_time = time.monotonic() + seconds
+
+    def remaining(self):
+        """
+        返回距离截止时间还剩多少秒，可能为负数
+        """
+        return self.expire_time - time.monotonic()
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def sub(self, seconds):
+        """
+        返回一个不晚于自身的子截止时间
+        """
+        return Deadline(max(0, min(seconds, self.remaining())))
+
+    def check(self):
+        """
+        如果已经超过截止时间，抛出DeadlineExceeded
+        """
+        if self.expired():
+            raise DeadlineExceeded()
+
+class ValidateStats(object):
+    """
+    验证尝试的统计信息，用于观察有多少时间浪费在了超时的代理上
+    多个验证线程会同时调用，因此需要加锁
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.start_time = time.time()
+        self.attempts = 0          # 验证尝试次数
+        self.success = 0           # 成功的尝试次数
+        self.timeouts = 0          # 因连接/读取超时或者超过截止时间而失败的尝试次数
+        self.errors = 0            # 其他原因失败的尝试次数（连接被拒绝、响应不匹配等）
+        self.budget_exhausted = 0  # 因为总时间预算用完而提前放弃的代理数量
+        self.attempt_seconds = 0.0 # 所有尝试的总耗时
+        self.timeout_seconds = 0.0 # 超时的尝试的总耗时
+        self.precheck = {}         # 预检查各种结果的数量
+
+    def record(self, result, elapsed):
+        """
+        记录一次验证尝试
+        result : 'success' / 'timeout' / 'error'
+        elapsed : 本次尝试的耗时，单位秒
+        """
+        with self.lock:
+            self.attempts += 1
+            self.attempt_seconds += elapsed
+            if result == 'success':
+                self.success += 1
+            elif result == 'timeout':
+                self.timeouts += 1
+                self.timeout_seconds += elapsed
+            else:
+                self.errors += 1
+
+    def record_budget_exhausted(self):
+        with self.lock:
+            self.budget_exhausted += 1
+
+    def record_precheck(self, result):
+        """
+        记录一次预检查的结果
+        """
+        with self.lock:
+            self.precheck[result] = self.precheck.get(result, 0) + 1
+
+    def snapshot(self, reset=False):
+        """
+        返回当前的统计信息
+        reset : 是否在返回之后清零，用于按时间段输出
+        返回 : dict
+        """
+        with self.lock:
+            data = dict(
+                seconds=time.time() - self.start_time,
+                attempts=self.attempts,
+                success=self.success,
+                timeouts=self.timeouts,
+                errors=self.errors,
+                budget_exhausted=self.budget_exhausted,
+                attempt_seconds=self.attempt_seconds,
+                timeout_seconds=self.timeout_seconds,
+                precheck=dict(self.precheck)
+            )
+            if reset:
+                self._reset()
+        return data
+
+    def report(self):
+        """
+        返回一行便于阅读的统计信息，并清零
+        """
+        s = self.snapshot(reset=True)
+        wasted = s['timeout_seconds'] / s['attempt_seconds'] * 100 if s['attempt_seconds'] > 0 else 0
+        prechecked = sum(s['precheck'].values())
+        precheck_failed = sum(s['precheck'].get(r, 0) for r in FAILED_RESULTS)
+        return (f"最近{s['seconds']:.0f}秒：预检查{prechecked}个代理，直接淘汰{precheck_failed}个，"
+                f"验证尝试{s['attempts']}次，成功{s['success']}次，"
+                f"超时{s['timeouts']}次，其他失败{s['errors']}次，预算用尽{s['budget_exhausted']}个代理，"
+                f"超时耗时占比{wasted:.1f}%")
+
+stats = ValidateStats()
+
+class ValidateResultSink(object):
+    """
+    验证结果的写缓冲区
+    验证结果先放在内存中，攒够VALIDATE_SINK_BATCH_SIZE个或者距离第一个结果超过VALIDATE_SINK_FLUSH_INTERVAL秒之后，
+    调用conn.pushValidateRows在一个事务中写入数据库，减少加锁和提交的次数
+    放入时就调用conn.validateResultRows更新代理的状态并生成需要写入的行，
+    写入失败时这些行留在缓冲区中，max_delay秒之后重新写入同样的行（不会再次更新代理的状态），期间不会因为缓冲区已满而反复写入
+    """
+
+    def __init__(self, max_size=VALIDATE_SINK_BATCH_SIZE, max_delay=VALIDATE_SINK_FLUSH_INTERVAL):
+        self.logger = logging.getLogger('validator')
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.lock = threading.Lock()
+        self.buffer = []  # list[(proxy, success, latency)]，写入成功之后返回给调用方
+        self.removed = [] # 缓冲区中需要删除的代理，见conn.pushValidateRows
+        self.updated = [] # 缓冲区中需要更新验证信息的代理
+        self.first_put_time = None
+        self.retry_time = 0 # 上次写入失败之后，在这个时间之前不再自动写入
+        self._reset_stats()
+
+    def _reset_stats(self):
+        self.stats_start_time = time.time()
+        self.commit_cnt = 0
+        self.row_cnt = 0
+        self.max_batch = 0
+        self.commit_seconds = 0.0
+        self.fail_cnt = 0
+
+    def put(self, proxy, success, latency):
+        """
+        放入一个验证结果，如果缓冲区已满则写入数据库
+        返回 : list[(proxy, success, latency)]，本次写入数据库的结果，没有写入则为空
+        """
+        with self.lock:
+            if not self.buffer:
+                self.first_put_time = time.time()
+            removed, updated = conn.validateResultRows([(proxy, success, latency)])
+            self.buffer.append((proxy, success, latency))
+            self.removed.extend(removed)
+            self.updated.extend(updated)
+            if len(self.buffer) >= self.max_size and time.time() >= self.retry_time:
+                return self._flush()
+        return []
+
+    def put_many(self, results):
+        """
+        放入多个验证结果，并检查是否需要写入数据库
+        results : list[(proxy, success, latency)]
+        返回 : list[(proxy, success, latency)]，本次写入数据库的结果，没有写入则为空
+        """
+        flushed = []
+        for proxy, success, latency in results:
+            flushed.extend(self.put(proxy, success, latency))
+        flushed.extend(self.maybe_flush())
+        return flushed
+
+    def maybe_flush(self):
+        """
+        如果缓冲区中最早的结果已经等待了足够长的时间，则写入数据库
+        返回 : list[(proxy, success, latency)]，本次写入数据库的结果，没有写入则为空
+        """
+        with self.lock:
+            now = time.time()
+            if self.buffer and now - self.first_put_time >= self.max_delay and now >= self.retry_time:
+                return self._flush()
+        return []
+
+    def flush(self):
+        """
+        将缓冲区中的全部结果写入数据库
+        返回 : list[(proxy, success, latency)]，本次写入数据库的结果
+        """
+        with self.lock:
+            return self._flush()
+
+    def _flush(self):
+        batch = self.buffer
+        if not batch:
+            return []
+        start_time = time.time()
+        try:
+            conn.pushValidateRows(self.removed, self.updated)
+        except Exception as e:
+            # 保留缓冲区中的结果，这些代理仍然被认为正在验证，不会被重复取出
+            self.fail_cnt += 1
+            self.retry_time = time.time() + self.max_delay
+            self.logger.error(f'写入{len(batch)}个验证结果失败，{self.max_delay}秒后重试：{e}')
+            return []
+        self.buffer = []
+        self.removed = []
+        self.updated = []
+        self.commit_seconds += time.time() - start_time
+        self.commit_cnt += 1
+        self.row_cnt += len(batch)
+        self.max_batch = max(self.max_batch, len(batch))
+        return batch
+
+    def report(self):
+        """
+        返回一行便于阅读的写入统计信息，并清零
+        """
+        with self.lock:
+            seconds = time.time() - self.stats_start_time
+            commit_cnt, row_cnt, max_batch, commit_seconds = self.commit_cnt, self.row_cnt, self.max_batch, self.commit_seconds
+            fail_cnt, pending = self.fail_cnt, len(self.buffer)
+            self._reset_stats()
+        avg_batch = row_cnt / commit_cnt if commit_cnt > 0 else 0
+        return (f"最近{seconds:.0f}秒：写入验证结果{row_cnt}条，提交{commit_cnt}次（{commit_cnt / max(seconds, 1):.2f}次/秒），"
+                f"平均每批{avg_batch:.1f}条，最大{max_batch}条，写入耗时{commit_seconds:.2f}秒，"
+                f"写入失败{fail_cnt}次，缓冲区中{pending}条")
+
+def install_exit_handler():
+    """
+    进程被terminate时（SIGTERM）以SystemExit的方式退出，使得finally中的清理代码（写入缓冲区中的结果）可以执行
+    """
+    def handler(signum, frame):
+        sys.exit(0)
+    signal.signal(signal.SIGTERM, handler)
+
+def main(proc_lock, write_queue=None):
     """
     验证器
     主要逻辑：
@@ -27,71 +276,160 @@ def main(proc_lock):
         检查验证线程是否返回了代理的验证结果
         从数据库中获取若干当前待验证的代理
         将代理发送给前面创建的线程
+    如果VALIDATE_ENGINE配置为async，则使用async_validator中基于asyncio的验证器
     """
+    if VALIDATE_ENGINE == 'async':
+        from proc import async_validator
+        return async_validator.main(proc_lock, write_queue)
+
     logger = logging.getLogger('validator')
     conn.set_proc_lock(proc_lock)
+    conn.set_write_queue(write_queue)
+    install_exit_handler()
 
     in_que = Queue()
     out_que = Queue()
+    sink = ValidateResultSink()
+    enricher = GeoEnricher().start()
     running_proxies = set() # 储存哪些代理正在运行，以字符串的形式储存
 
     threads = []
     for _ in range(VALIDATE_THREAD_NUM):
-        threads.append(threading.Thread(target=validate_thread, args=(in_que, out_que)))
+        # 设置为daemon线程，主线程退出时不需要等待验证线程
+        threads.append(threading.Thread(target=validate_thread, args=(in_que, out_que), daemon=True))
     [_.start() for _ in threads]
 
+    try:
+        _main_loop(logger, in_que, out_que, sink, enricher, running_proxies)
+    finally:
+        # 退出前将缓冲区中的结果写入数据库
+        flushed = sink.flush()
+        enricher.flush()
+        logger.info(f'退出前写入了{len(flushed)}个代理的验证结果')
+
+def _main_loop(logger, in_que, out_que, sink, enricher, running_proxies):
+    last_report_time = time.time()
     while True:
-        out_cnt = 0
+        results = []
         while not out_que.empty():
-            proxy, success, latency = out_que.get()
-            conn.pushValidateResult(proxy, success, latency)
+            results.append(out_que.get())
+        out_cnt = len(results)
+        flushed = sink.put_many(results)
+        # 结果写入数据库之后，才能将代理从正在验证的集合中删除，否则可能被重复取出验证
+        # 验证成功但是缺少地理位置信息的代理，交给enricher在后台补全
+        for proxy, success, _ in flushed:
             uri = f'{proxy.protocol}://{proxy.ip}:{proxy.port}'
             running_proxies.remove(uri)
-            out_cnt = out_cnt + 1
+            if success:
+                enricher.submit(proxy)
         if out_cnt > 0:
             logger.info(f'完成了{out_cnt}个代理的验证')
 
-        # 如果正在进行验证的代理足够多，那么就不着急添加新代理        
+        if time.time() - last_report_time >= STATS_REPORT_INTERVAL:
+            logger.info(stats.report())
+            logger.info(sink.report())
+            logger.info(enricher.report())
+            last_report_time = time.time()
+
+        # 如果正在进行验证的代理足够多，那么就不着急添加新代理
         if len(running_proxies) >= VALIDATE_THREAD_NUM * 2:
             time.sleep(PROC_VALIDATOR_SLEEP)
             continue
 
-        # 找一些新的待验证的代理放入队列中
-        added_cnt = 0
+        # 找一些新的待验证的代理
+        new_proxies = []
         for proxy in conn.getToValidate(VALIDATE_THREAD_NUM * 4):
             uri = f'{proxy.protocol}://{proxy.ip}:{proxy.port}'
             # 这里找出的代理有可能是正在进行验证的代理，要避免重复加入
             if uri not in running_proxies:
                 running_proxies.add(uri)
+                new_proxies.append(proxy)
+
+        # 先批量进行预检查，未通过的代理直接作为验证失败的结果，其余的放入队列中进行完整验证
+        if VALIDATE_PRECHECK:
+            results = precheck_batch(new_proxies)
+        else:
+            results = [None] * len(new_proxies)
+        for proxy, result in zip(new_proxies, results):
+            if result is not None:
+                stats.record_precheck(result)
+            if result in FAILED_RESULTS:
+                out_que.put((proxy, False, None))
+            else:
                 in_que.put(proxy)
-                added_cnt += 1
-        
-        if added_cnt == 0:
+
+        if len(new_proxies) == 0:
             time.sleep(PROC_VALIDATOR_SLEEP)
 
-@func_set_timeout(VALIDATE_TIMEOUT * 2)
-def validate_once(proxy):
+def validate_once(proxy, deadline=None):
     """
     进行一次验证，如果验证成功则返回True，否则返回False或者是异常
+    deadline : 本次验证的截止时间，默认为VALIDATE_TIMEOUT * 2秒之后
+    连接和每次读取的超时时间由socket控制，读取响应的过程中主动检查截止时间，超时抛出异常
     """
+    if deadline is None:
+        deadline = Deadline(VALIDATE_TIMEOUT * 2)
+    deadline.check()
+    timeout = min(VALIDATE_TIMEOUT, deadline.remaining())
     proxies = {
         'http': f'{proxy.protocol}://{proxy.ip}:{proxy.port}',
         'https': f'{proxy.protocol}://{proxy.ip}:{proxy.port}'
     }
     if VALIDATE_METHOD == "GET":
-        r = requests.get(VALIDATE_URL, timeout=VALIDATE_TIMEOUT, proxies=proxies)
-        r.encoding = "utf-8"
-        html = r.text
+        r = requests.get(VALIDATE_URL, timeout=(timeout, timeout), proxies=proxies, stream=True)
+        try:
+            content = b''
+            for chunk in r.iter_content(chunk_size=8192):
+                content += chunk
+                deadline.check()
+        finally:
+            r.close()
+        html = content.decode('utf-8', 'replace')
         if VALIDATE_KEYWORD in html:
             return True
         return False
     else:
-        r = requests.get(VALIDATE_URL, timeout=VALIDATE_TIMEOUT, proxies=proxies, allow_redirects=False)
+        # 只需要响应头，不读取响应体
+        r = requests.get(VALIDATE_URL, timeout=(timeout, timeout), proxies=proxies, allow_redirects=False, stream=True)
+        r.close()
         resp_headers = r.headers
         if VALIDATE_HEADER in resp_headers.keys() and VALIDATE_KEYWORD in resp_headers[VALIDATE_HEADER]:
             return True
         return False
 
+def is_timeout_error(e):
+    """
+    判断验证时抛出的异常是否是超时导致的
+    """
+    if isinstance(e, (DeadlineExceeded, requests.exceptions.Timeout, socket.timeout)):
+        return True
+    # 读取响应体的过程中超时，requests会将其包装为ConnectionError
+    if isinstance(e, requests.exceptions.ConnectionError) and e.args and isinstance(e.args[0], ReadTimeoutError):
+        return True
+    return False
+
+def validate_proxy(proxy):
+    """
+    对一个代理最多进行VALIDATE_MAX_FAILS次验证，只要有一次成功就认为代理可用
+    所有尝试共用VALIDATE_PROXY_BUDGET秒的时间预算，预算用完后不再重试
+    返回 : (success, latency)
+    """
+    budget = Deadline(VALIDATE_PROXY_BUDGET)
+    for _ in range(VALIDATE_MAX_FAILS):
+        if budget.expired():
+            stats.record_budget_exhausted()
+            break
+        start_time = time.time()
+        try:
+            if validate_once(proxy, budget.sub(VALIDATE_TIMEOUT * 2)):
+                end_time = time.time()
+                stats.record('success', end_time - start_time)
+                return True, int((end_time-start_time)*1000)
+            stats.record('error', time.time() - start_time)
+        except Exception as e:
+            stats.record('timeout' if is_timeout_error(e) else 'error', time.time() - start_time)
+    return False, None
+
 def validate_thread(in_que, out_que):
     """
     验证函数，这个函数会在一个线程中被调用
@@ -102,20 +440,5 @@ def validate_thread(in_que, out_que):
 
     while True:
         proxy = in_que.get()
-
-        success = False
-        latency = None
-        for _ in range(VALIDATE_MAX_FAILS):
-            try:
-                start_time = time.time()
-                if validate_once(proxy):
-                    end_time = time.time()
-                    latency = int((end_time-start_time)*1000)
-                    success = True
-                    break
-            except Exception as e:
-                pass
-            except FunctionTimedOut:
-                pass
-
+        success, latency = validate_proxy(proxy)
         out_que.put((proxy, success, latency))
@@ -0,0 +1,120 @@
+# encoding: utf-8
+
+"""
+国家名称与国家代码（ISO 3166-1 alpha-2）之间的转换
+数据库中的country字段保存的是地理位置接口或者爬取器给出的名称（大多是中文，也可能是英文），
+写入时同时保存规范化之后的country_code，订阅和获取代理的接口按country_code筛选
+"""
+
+import re
+
+# (国家代码, 中文名称, 英文名称, 其他名称...)
+COUNTRIES = [
+    ('CN', '中国', 'China', '中华人民共和国'),
+    ('HK', '香港', 'Hong Kong', '中国香港'),
+    ('TW', '台湾', 'Taiwan', '中国台湾'),
+    ('MO', '澳门', 'Macao', '中国澳门', 'Macau'),
+    ('US', '美国', 'United States', 'United States of America', 'USA'),
+    ('CA', '加拿大', 'Canada'),
+    ('JP', '日本', 'Japan'),
+    ('SG', '新加坡', 'Singapore'),
+    ('AU', '澳大利亚', 'Australia'),
+    ('RU', '俄罗斯', 'Russia', '俄罗斯联邦', 'Russian Federation'),
+    ('CH', '瑞士', 'Switzerland'),
+    ('DE', '德国', 'Germany'),
+    ('FR', '法国', 'France'),
+    ('GB', '英国', 'United Kingdom', 'Great Britain'),
+    ('NL', '荷兰', 'Netherlands', 'The Netherlands'),
+    ('KR', '韩国', 'South Korea', '大韩民国', 'Korea'),
+    ('IN', '印度', 'India'),
+    ('TH', '泰国', 'Thailand'),
+    ('VN', '越南', 'Vietnam', 'Viet Nam'),
+    ('PH', '菲律宾', 'Philippines'),
+    ('ID', '印度尼西亚', 'Indonesia', '印尼'),
+    ('MY', '马来西亚', 'Malaysia'),
+    ('BR', '巴西', 'Brazil'),
+    ('AR', '阿根廷', 'Argentina'),
+    ('MX', '墨西哥', 'Mexico'),
+    ('CL', '智利', 'Chile'),
+    ('CO', '哥伦比亚', 'Colombia'),
+    ('ES', '西班牙', 'Spain'),
+    ('IT', '意大利', 'Italy'),
+    ('PL', '波兰', 'Poland'),
+    ('TR', '土耳其', 'Turkey', 'Türkiye'),
+    ('IL', '以色列', 'Israel'),
+    ('AE', '阿联酋', 'United Arab Emirates', '阿拉伯联合酋长国'),
+    ('ZA', '南非', 'South Africa'),
+    ('EG', '埃及', 'Egypt'),
+    ('NG', '尼日利亚', 'Nigeria'),
+    ('UA', '乌克兰', 'Ukraine'),
+    ('RO', '罗马尼亚', 'Romania'),
+    ('CZ', '捷克', 'Czechia', '捷克共和国', 'Czech Republic'),
+    ('GR', '希腊', 'Greece'),
+    ('PT', '葡萄牙', 'Portugal'),
+    ('SE', '瑞典', 'Sweden'),
+    ('NO', '挪威', 'Norway'),
+    ('DK', '丹麦', 'Denmark'),
+    ('FI', '芬兰', 'Finland'),
+    ('AT', '奥地利', 'Austria'),
+    ('BE', '比利时', 'Belgium'),
+    ('IE', '爱尔兰', 'Ireland'),
+    ('AL', '阿尔巴尼亚', 'Albania'),
+    ('BG', '保加利亚', 'Bulgaria'),
+    ('RS', '塞尔维亚', 'Serbia'),
+    ('HR', '克罗地亚', 'Croatia'),
+    ('HU', '匈牙利', 'Hungary'),
+    ('SK', '斯洛伐克', 'Slovakia'),
+    ('SI', '斯洛文尼亚', 'Slovenia'),
+    ('LT', '立陶宛', 'Lithuania'),
+    ('LV', '拉脱维亚', 'Latvia'),
+    ('EE', '爱沙尼亚', 'Estonia'),
+    ('UY', '乌拉圭', 'Uruguay'),
+    ('PY', '巴拉圭', 'Paraguay'),
+    ('NZ', '新西兰', 'New Zealand'),
+    ('PK', '巴基斯坦', 'Pakistan'),
+    ('BD', '孟加拉国', 'Bangladesh', '孟加拉'),
+]
+
+# 名称（英文为小写） -> 国家代码
+_NAME_TO_CODE = {}
+for _code, *_names in COUNTRIES:
+    for _name in _names:
+        _NAME_TO_CODE[_name.lower()] = _code
+del _code, _names, _name
+
+_CODE_RE = re.compile(r'^[A-Za-z]{2}$')
+
+
+def to_code(country):
+    """
+    将国家名称或者国家代码规范化为大写的国家代码
+    country : 名称（中文或英文）或者两位的国家代码
+    返回 : 国家代码，无法识别（包括'未知'、'本地'）时返回None
+    """
+    if not country:
+        return None
+    country = country.strip()
+    if _CODE_RE.match(country):
+        return country.upper()
+    return _NAME_TO_CODE.get(country.lower())
+
+
+def parse_codes(value):
+    """
+    解析逗号分隔的国家列表，例如订阅接口的c、nc参数
+    value : 例如 'US,JP' 或者 'us,日本'
+    返回 : tuple，国家代码，无法识别的项保留原样（大写），不会匹配到任何代理；没有任何项时返回None
+    """
+    if not value:
+        return None
+    codes = tuple(to_code(item) or item.strip().upper() for item in value.split(',') if item.strip())
+    return codes or None
+
+
+def flag(code):
+    """
+    国家代码对应的旗帜emoji（由两个区域指示符组成），没有国家代码时返回地球
+    """
+    if not code or not _CODE_RE.match(code):
+        return '🌍'
+    return ''.join(chr(0x1F1E6 + ord(c) - ord('A')) for c in code.upper())
@@ -0,0 +1,229 @@
+# encoding: utf-8
+
+"""
+离线IP地理位置数据库
+将CSV格式的IP段数据转换为紧凑的二进制文件，查询时通过mmap映射文件并二分查找，不需要网络请求
+多个进程打开同一个文件时，通过操作系统的页缓存共享内存
+
+文件格式（小端序）：
+    文件头   : magic(8字节) IPv4段数量(uint32) IPv6段数量(uint32) 字符串数量(uint32) 保留(uint32)
+    IPv4段表 : 每项为 起始IP(uint32) 结束IP(uint32) 字符串编号(uint32)，按起始IP排序
+    IPv6段表 : 每项为 起始IP(16字节，大端) 结束IP(16字节，大端) 字符串编号(uint32)，按起始IP排序
+    字符串表 : 每项为 偏移(uint32) 长度(uint32)，偏移相对于字符串数据的开头
+    字符串数据 : UTF-8编码的 国家\\0地址
+
+命令行用法：
+    python -m utils.geoip_db convert <输入.csv> <输出.dat>   转换CSV文件
+    python -m utils.geoip_db lookup <数据库.dat> <IP>        查询一个IP
+    python -m utils.geoip_db bench <数据库.dat> [次数]       查询性能测试
+
+CSV每行的格式为：起始IP,结束IP,国家[,地址...]
+起始IP和结束IP可以是IP字符串，也可以是整数；也可以只有一列CIDR，即：网段,国家[,地址...]
+"""
+
+import os
+import sys
+import csv
+import mmap
+import time
+import random
+import struct
+import socket
+import ipaddress
+
+MAGIC = b'PPGEOIP1'
+_HEADER = struct.Struct('<8sIIII')
+_V4_RECORD = struct.Struct('<III')
+_V6_RECORD = struct.Struct('<16s16sI')
+_STR_RECORD = struct.Struct('<II')
+_U32 = struct.Struct('<I')
+_U32_BE = struct.Struct('>I')
+
+
+class GeoIPDatabase(object):
+    """
+    通过mmap只读打开的离线IP地理位置数据库
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.v4_count, self.v6_count, self.str_count, _ = _HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC:
+            self.mm.close()
+            raise ValueError(f'不是有效的离线IP数据库文件: {path}')
+        self.v4_offset = _HEADER.size
+        self.v6_offset = self.v4_offset + self.v4_count * _V4_RECORD.size
+        self.str_offset = self.v6_offset + self.v6_count * _V6_RECORD.size
+        self.data_offset = self.str_offset + self.str_count * _STR_RECORD.size
+
+    def close(self):
+        self.mm.close()
+
+    def _string(self, idx):
+        offset, length = _STR_RECORD.unpack_from(self.mm, self.str_offset + idx * _STR_RECORD.size)
+        start = self.data_offset + offset
+        country, _, address = self.mm[start:start + length].decode('utf-8').partition('\0')
+        return {'country': country, 'address': address or country}
+
+    def _lookup_v4(self, value):
+        # 二分查找最后一个起始IP <= value的IP段
+        lo, hi = 0, self.v4_count
+        mm, base, size = self.mm, self.v4_offset, _V4_RECORD.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if _U32.unpack_from(mm, base + mid * size)[0] <= value:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == 0:
+            return None
+        start, end, idx = _V4_RECORD.unpack_from(mm, base + (lo - 1) * size)
+        return idx if value <= end else None
+
+    def _lookup_v6(self, packed):
+        lo, hi = 0, self.v6_count
+        mm, base, size = self.mm, self.v6_offset, _V6_RECORD.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            offset = base + mid * size
+            if mm[offset:offset + 16] <= packed:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == 0:
+            return None
+        start, end, idx = _V6_RECORD.unpack_from(mm, base + (lo - 1) * size)
+        return idx if packed <= end else None
+
+    def lookup(self, ip):
+        """
+        查询IP地址的地理位置
+        返回: {'country': '国家', 'address': '详细地址'}，没有找到则返回None
+        """
+        if ':' in ip:
+            try:
+                idx = self._lookup_v6(ipaddress.IPv6Address(ip).packed)
+            except ValueError:
+                return None
+        else:
+            try:
+                idx = self._lookup_v4(_U32_BE.unpack(socket.inet_aton(ip))[0])
+            except OSError:
+                return None
+        if idx is None:
+            return None
+        return self._string(idx)
+
+
+def _parse_ip(text):
+    """
+    解析CSV中的IP，可以是IP字符串或者整数
+    返回 : ipaddress.IPv4Address / ipaddress.IPv6Address
+    """
+    text = text.strip()
+    if text.isdigit():
+        value = int(text)
+        return ipaddress.IPv4Address(value) if value <= 0xFFFFFFFF else ipaddress.IPv6Address(value)
+    return ipaddress.ip_address(text)
+
+
+def convert(csv_path, out_path):
+    """
+    将CSV格式的IP段数据转换为二进制数据库文件
+    返回 : (IPv4段数量, IPv6段数量)
+    """
+    v4, v6 = [], []
+    strings = {}
+    skipped = 0
+    with open(csv_path, 'r', encoding='utf-8', newline='') as f:
+        for row in csv.reader(f):
+            if not row or row[0].startswith('#'):
+                continue
+            try:
+                if '/' in row[0]:
+                    network = ipaddress.ip_network(row[0].strip(), strict=False)
+                    start, end, rest = network[0], network[-1], row[1:]
+                else:
+                    start, end, rest = _parse_ip(row[0]), _parse_ip(row[1]), row[2:]
+            except (ValueError, IndexError):
+                skipped += 1 # 表头或者格式错误的行
+                continue
+            if not rest or start.version != end.version or start > end:
+                skipped += 1
+                continue
+            country = rest[0].strip()
+            address = ' '.join(part.strip() for part in rest[1:] if part.strip())
+            key = f'{country}\0{address}' if address else country
+            idx = strings.setdefault(key, len(strings))
+            (v4 if start.version == 4 else v6).append((int(start), int(end), idx))
+
+    v4.sort()
+    v6.sort()
+    # 去掉与前一个IP段重叠的IP段，保证二分查找的正确性
+    for table in (v4, v6):
+        kept = []
+        for item in table:
+            if kept and item[0] <= kept[-1][1]:
+                skipped += 1
+                continue
+            kept.append(item)
+        table[:] = kept
+
+    data = bytearray()
+    str_table = bytearray()
+    for key in sorted(strings, key=strings.get):
+        encoded = key.encode('utf-8')
+        str_table += _STR_RECORD.pack(len(data), len(encoded))
+        data += encoded
+
+    tmp_path = out_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(_HEADER.pack(MAGIC, len(v4), len(v6), len(strings), 0))
+        for start, end, idx in v4:
+            f.write(_V4_RECORD.pack(start, end, idx))
+        for start, end, idx in v6:
+            f.write(_V6_RECORD.pack(start.to_bytes(16, 'big'), end.to_bytes(16, 'big'), idx))
+        f.write(str_table)
+        f.write(data)
+    # 原子替换，已经打开旧文件的进程不受影响
+    os.replace(tmp_path, out_path)
+    if skipped:
+        print(f'跳过了{skipped}行无效或者重叠的数据')
+    return len(v4), len(v6)
+
+
+def bench(path, n=100000):
+    """
+    查询性能测试，随机生成n个IPv4地址进行查询
+    """
+    db = GeoIPDatabase(path)
+    ips = [socket.inet_ntoa(struct.pack('>I', random.getrandbits(32))) for _ in range(n)]
+    hits = 0
+    start = time.perf_counter()
+    for ip in ips:
+        if db.lookup(ip) is not None:
+            hits += 1
+    elapsed = time.perf_counter() - start
+    print(f'IPv4段{db.v4_count}个，IPv6段{db.v6_count}个')
+    print(f'查询{n}次，命中{hits}次，耗时{elapsed:.3f}秒，平均每次{elapsed / n * 1e6:.2f}微秒')
+    db.close()
+
+
+def main(argv):
+    if len(argv) >= 3 and argv[0] == 'convert':
+        v4_cnt, v6_cnt = convert(argv[1], argv[2])
+        print(f'转换完成：IPv4段{v4_cnt}个，IPv6段{v6_cnt}个 -> {argv[2]}')
+    elif len(argv) >= 3 and argv[0] == 'lookup':
+        print(GeoIPDatabase(argv[1]).lookup(argv[2]))
+    elif len(argv) >= 2 and argv[0] == 'bench':
+        bench(argv[1], int(argv[2]) if len(argv) >= 3 else 100000)
+    else:
+        print(__doc__)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
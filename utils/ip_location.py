@@ -1,7 +1,13 @@
 # encoding: utf-8
 
+import os
 import requests
 import time
+import sqlite3
+import threading
+from collections import OrderedDict, deque
+from config import DATABASE_PATH, GEOIP_DB_PATH, IP_LOCATION_CACHE_SIZE, IP_LOCATION_CACHE_TTL
+from utils.geoip_db import GeoIPDatabase
 
 class IPLocation:
     """
@@ -85,25 +91,211 @@ class IPLocation:
         
         return None
 
+# 离线IP数据库，文件不存在时每隔一段时间重新检查一次
+_local_db = None
+_local_db_lock = threading.Lock()
+_local_db_check_time = 0
+_local_db_check_interval = 60
+
+def _get_local_db():
+    """
+    获取离线IP数据库，不存在则返回None
+    """
+    global _local_db, _local_db_check_time
+    if _local_db is not None:
+        return _local_db
+    if time.time() - _local_db_check_time < _local_db_check_interval:
+        return None
+    with _local_db_lock:
+        _local_db_check_time = time.time()
+        if _local_db is None and os.path.exists(GEOIP_DB_PATH):
+            try:
+                _local_db = GeoIPDatabase(GEOIP_DB_PATH)
+            except Exception as e:
+                print(f"加载离线IP数据库失败({GEOIP_DB_PATH}): {e}")
+    return _local_db
+
+def get_local_location(ip: str):
+    """
+    使用离线IP数据库查询
+    返回: {'country': '国家', 'address': '详细地址'}，没有离线数据库或者没有找到则返回None
+    """
+    db = _get_local_db()
+    if db is None:
+        return None
+    return db.lookup(ip)
+
+class IPLocationCache(object):
+    """
+    IP地理位置缓存
+    内存中为限制大小的LRU缓存，条目超过有效期之后失效；
+    查询成功的结果同时保存到数据库中的ip_locations表（表在db/init.py中创建），重启之后以及其他进程（验证器、API）也可以使用
+    这里只读取ip_locations表，需要保存的结果先放在unsaved中，由GeoEnricher.flush取出之后通过conn.pushIPLocations写入，
+    与其他写操作一样获取进程锁，或者交给数据库写入进程
+    max_size : 内存中最多缓存多少个IP，同时也是unsaved的长度上限
+    ttl : 缓存有效期，单位s
+    db_path : 数据库文件路径，为None时只使用内存缓存
+    """
+
+    # 每保存多少个结果，清理一次数据库中已过期的缓存
+    expire_every = 1000
+
+    def __init__(self, max_size, ttl, db_path=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.items = OrderedDict() # ip -> (地理位置信息, 写入时间)
+        self.db = None
+        self.db_pid = None
+        self.unsaved = deque() # 等待写入数据库的结果，(ip, country, address, update_time)
+        self.put_count = 0
+        self.stats = {'hits': 0, 'disk_hits': 0, 'misses': 0, 'expired': 0, 'evictions': 0}
+
+    def _get_db(self):
+        """
+        获取只读的数据库连接，fork出来的子进程会重新连接
+        调用时需要持有self.lock
+        """
+        if self.db_path is None:
+            return None
+        if self.db is None or self.db_pid != os.getpid():
+            self.db = sqlite3.connect(self.db_path, timeout=10.0, check_same_thread=False)
+            self.db_pid = os.getpid()
+        return self.db
+
+    def _put_memory(self, ip, location, update_time):
+        self.items[ip] = (location, update_time)
+        self.items.move_to_end(ip)
+        while len(self.items) > self.max_size:
+            self.items.popitem(last=False)
+            self.stats['evictions'] += 1
+
+    def _get_disk(self, ip, now):
+        try:
+            db = self._get_db()
+            if db is None:
+                return None
+            row = db.execute('SELECT country, address, update_time FROM ip_locations WHERE ip=?', (ip,)).fetchone()
+        except sqlite3.Error as e:
+            print(f"读取IP地理位置缓存失败: {e}")
+            return None
+        if row is None or now - row[2] >= self.ttl:
+            return None
+        location = {'country': row[0], 'address': row[1]}
+        self._put_memory(ip, location, row[2])
+        return location
+
+    def get(self, ip):
+        """
+        查询缓存，先查内存，再查数据库
+        返回: 地理位置信息，没有找到或者已过期则返回None
+        """
+        now = time.time()
+        with self.lock:
+            item = self.items.get(ip)
+            if item is not None:
+                if now - item[1] < self.ttl:
+                    self.items.move_to_end(ip)
+                    self.stats['hits'] += 1
+                    return item[0]
+                del self.items[ip]
+                self.stats['expired'] += 1
+            location = self._get_disk(ip, now)
+            if location is not None:
+                self.stats['disk_hits'] += 1
+                return location
+            self.stats['misses'] += 1
+            return None
+
+    def put(self, ip, location, persist=True):
+        """
+        写入缓存
+        persist : 是否同时保存到数据库，查询失败的结果只缓存在内存中，重启之后会重新查询
+        """
+        now = time.time()
+        with self.lock:
+            self._put_memory(ip, location, now)
+            if not persist or self.db_path is None:
+                return
+            self.unsaved.append((ip, location['country'], location['address'], now))
+            while len(self.unsaved) > self.max_size:
+                self.unsaved.popleft()
+
+    def take_unsaved(self):
+        """
+        取出等待写入数据库的结果
+        返回 : (list[(ip, country, address, update_time)], expire_before)，参数见conn.pushIPLocations
+               每取出expire_every个结果，expire_before为清理过期缓存的时间点，否则为None
+        """
+        with self.lock:
+            rows = list(self.unsaved)
+            self.unsaved.clear()
+            expire_before = None
+            if rows and (self.put_count + len(rows)) // self.expire_every > self.put_count // self.expire_every:
+                expire_before = time.time() - self.ttl
+            self.put_count += len(rows)
+        return rows, expire_before
+
+    def report(self):
+        """
+        返回缓存的统计信息
+        """
+        with self.lock:
+            stats = dict(self.stats)
+            stats['size'] = len(self.items)
+        total = stats['hits'] + stats['disk_hits'] + stats['misses']
+        stats['hit_rate'] = (stats['hits'] + stats['disk_hits']) / total if total else 0.0
+        return stats
+
 # 缓存，避免重复查询同一个IP
-_ip_cache = {}
-_cache_expire_time = 3600  # 缓存1小时
+_ip_cache = IPLocationCache(IP_LOCATION_CACHE_SIZE, IP_LOCATION_CACHE_TTL, DATABASE_PATH)
+
+def get_ip_cache_stats():
+    """
+    IP地理位置缓存的统计信息
+    返回: dict，包括命中次数、未命中次数、淘汰次数等
+    """
+    return _ip_cache.report()
+
+def take_ip_cache_unsaved():
+    """
+    取出需要保存到数据库的IP地理位置缓存，由GeoEnricher.flush写入
+    返回: (list[(ip, country, address, update_time)], expire_before)
+    """
+    return _ip_cache.take_unsaved()
+
+def peek_ip_location_cached(ip: str):
+    """
+    只查询离线IP数据库和缓存，不进行网络请求
+    返回: 地理位置信息，没有找到或者缓存已过期则返回None
+    """
+    result = get_local_location(ip)
+    if result is not None:
+        return result
+    return _ip_cache.get(ip)
 
 def get_ip_location_cached(ip: str) -> dict:
     """
     带缓存的IP位置查询
+    优先使用离线IP数据库，没有找到时才使用网络接口查询
     """
-    current_time = time.time()
-    
+    result = get_local_location(ip)
+    if result is not None:
+        return result
+
     # 检查缓存
-    if ip in _ip_cache:
-        cached_data, cache_time = _ip_cache[ip]
-        if current_time - cache_time < _cache_expire_time:
-            return cached_data
+    result = _ip_cache.get(ip)
+    if result is not None:
+        return result
     
-    # 查询新数据
+    return fetch_ip_location(ip)
+
+def fetch_ip_location(ip: str) -> dict:
+    """
+    不检查缓存，直接使用网络接口查询，并将结果放入缓存
+    用于已经通过peek_ip_location_cached确认缓存中没有的IP，避免再查一次缓存导致未命中被统计两次
+    """
     result = IPLocation.get_location(ip)
-    _ip_cache[ip] = (result, current_time)
-    
+    _ip_cache.put(ip, result, persist=result.get('address') != '无法获取')
     return result
-
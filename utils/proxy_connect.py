@@ -0,0 +1,228 @@
+# encoding: utf-8
+
+"""
+基于asyncio的代理连接工具
+在非阻塞socket上建立到代理服务器的TCP连接，并完成 HTTP CONNECT / SOCKS4 / SOCKS5 握手
+"""
+
+import asyncio
+import base64
+import ipaddress
+import socket
+import struct
+
+# 读取握手响应头时允许的最大长度
+_MAX_HEAD_SIZE = 8192
+
+
+class ProxyHandshakeError(Exception):
+    """
+    代理服务器可以连接，但是握手失败（响应格式错误或者拒绝了请求）
+    """
+    pass
+
+
+def run(coro):
+    """
+    在一个新的事件循环中运行coro直到完成，结束后关闭事件循环
+    asyncio.run需要Python 3.7，这里只使用3.6中已有的接口
+    返回 : coro的返回值
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        asyncio.set_event_loop(loop)
+        return loop.run_until_complete(coro)
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+async def _resolve(loop, host, port):
+    """
+    解析地址，IP字面量直接返回，避免占用线程池
+    返回 : (family, sockaddr)
+    """
+    try:
+        addr = ipaddress.ip_address(host)
+        if addr.version == 6:
+            return socket.AF_INET6, (host, port, 0, 0)
+        return socket.AF_INET, (host, port)
+    except ValueError:
+        pass
+    infos = await loop.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    if not infos:
+        raise OSError(f'无法解析地址: {host}')
+    family, _, _, _, sockaddr = infos[0]
+    return family, sockaddr
+
+
+async def open_socket(host, port):
+    """
+    以非阻塞方式建立TCP连接，超时由调用方通过asyncio.wait_for控制
+    返回 : 已连接的非阻塞socket
+    """
+    loop = asyncio.get_event_loop()
+    family, sockaddr = await _resolve(loop, host, port)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setblocking(False)
+    try:
+        await loop.sock_connect(sock, sockaddr)
+    except BaseException:
+        sock.close()
+        raise
+    return sock
+
+
+async def _recv_exactly(loop, sock, n):
+    """
+    从socket读取恰好n个字节
+    """
+    buf = b''
+    while len(buf) < n:
+        chunk = await loop.sock_recv(sock, n - len(buf))
+        if not chunk:
+            raise ProxyHandshakeError('代理服务器关闭了连接')
+        buf += chunk
+    return buf
+
+
+async def _recv_http_head(loop, sock):
+    """
+    读取HTTP响应头，逐字节读取以免读走隧道中的后续数据
+    返回 : bytes，以\\r\\n\\r\\n结尾
+    """
+    buf = bytearray()
+    while not buf.endswith(b'\r\n\r\n'):
+        if len(buf) >= _MAX_HEAD_SIZE:
+            raise ProxyHandshakeError('代理服务器响应头过长')
+        chunk = await loop.sock_recv(sock, 1)
+        if not chunk:
+            raise ProxyHandshakeError('代理服务器关闭了连接')
+        buf += chunk
+    return bytes(buf)
+
+
+def _basic_auth(username, password):
+    return base64.b64encode(f'{username}:{password}'.encode('utf-8')).decode('ascii')
+
+
+async def _http_connect(loop, sock, dest_host, dest_port, username, password):
+    """
+    HTTP CONNECT 握手
+    """
+    lines = [
+        f'CONNECT {dest_host}:{dest_port} HTTP/1.1',
+        f'Host: {dest_host}:{dest_port}',
+    ]
+    if username and password:
+        lines.append(f'Proxy-Authorization: Basic {_basic_auth(username, password)}')
+    await loop.sock_sendall(sock, ('\r\n'.join(lines) + '\r\n\r\n').encode('utf-8'))
+    head = await _recv_http_head(loop, sock)
+    status_line = head.split(b'\r\n', 1)[0].split()
+    if len(status_line) < 2 or not status_line[0].startswith(b'HTTP/'):
+        raise ProxyHandshakeError('代理服务器返回了非HTTP响应')
+    if status_line[1] != b'200':
+        raise ProxyHandshakeError(f'CONNECT 被拒绝: {status_line[1].decode("ascii", "replace")}')
+
+
+def _socks5_address(host):
+    """
+    编码SOCKS5请求中的目标地址
+    """
+    try:
+        addr = ipaddress.ip_address(host)
+        if addr.version == 6:
+            return b'\x04' + addr.packed
+        return b'\x01' + addr.packed
+    except ValueError:
+        data = host.encode('idna')
+        return b'\x03' + bytes([len(data)]) + data
+
+
+async def _socks5_connect(loop, sock, dest_host, dest_port, username, password):
+    """
+    SOCKS5 握手，支持无认证以及用户名密码认证(RFC1929)
+    """
+    if username and password:
+        await loop.sock_sendall(sock, b'\x05\x02\x00\x02')
+    else:
+        await loop.sock_sendall(sock, b'\x05\x01\x00')
+    ver, method = await _recv_exactly(loop, sock, 2)
+    if ver != 5:
+        raise ProxyHandshakeError('代理服务器返回了非SOCKS5响应')
+    if method == 2:
+        if not (username and password):
+            raise ProxyHandshakeError('SOCKS5 代理需要认证')
+        user = username.encode('utf-8')
+        pwd = password.encode('utf-8')
+        await loop.sock_sendall(sock, b'\x01' + bytes([len(user)]) + user + bytes([len(pwd)]) + pwd)
+        _, status = await _recv_exactly(loop, sock, 2)
+        if status != 0:
+            raise ProxyHandshakeError('SOCKS5 认证失败')
+    elif method != 0:
+        raise ProxyHandshakeError('SOCKS5 没有可用的认证方式')
+
+    await loop.sock_sendall(sock, b'\x05\x01\x00' + _socks5_address(dest_host) + struct.pack('>H', dest_port))
+    ver, rep, _, atyp = await _recv_exactly(loop, sock, 4)
+    if ver != 5:
+        raise ProxyHandshakeError('代理服务器返回了非SOCKS5响应')
+    if rep != 0:
+        raise ProxyHandshakeError(f'SOCKS5 CONNECT 被拒绝: {rep}')
+    # 读掉BND.ADDR和BND.PORT
+    if atyp == 1:
+        await _recv_exactly(loop, sock, 4 + 2)
+    elif atyp == 4:
+        await _recv_exactly(loop, sock, 16 + 2)
+    elif atyp == 3:
+        length = (await _recv_exactly(loop, sock, 1))[0]
+        await _recv_exactly(loop, sock, length + 2)
+    else:
+        raise ProxyHandshakeError('SOCKS5 响应地址类型错误')
+
+
+async def _socks4_connect(loop, sock, dest_host, dest_port, username):
+    """
+    SOCKS4 / SOCKS4a 握手，目标为域名时使用SOCKS4a由代理服务器解析
+    """
+    user = (username or '').encode('utf-8') + b'\x00'
+    try:
+        addr = ipaddress.IPv4Address(dest_host)
+        req = b'\x04\x01' + struct.pack('>H', dest_port) + addr.packed + user
+    except ValueError:
+        req = b'\x04\x01' + struct.pack('>H', dest_port) + b'\x00\x00\x00\x01' + user + dest_host.encode('idna') + b'\x00'
+    await loop.sock_sendall(sock, req)
+    reply = await _recv_exactly(loop, sock, 8)
+    if reply[0] != 0:
+        raise ProxyHandshakeError('代理服务器返回了非SOCKS4响应')
+    if reply[1] != 0x5A:
+        raise ProxyHandshakeError(f'SOCKS4 CONNECT 被拒绝: {reply[1]}')
+
+
+async def handshake(sock, protocol, dest_host, dest_port, username=None, password=None):
+    """
+    在已经连接到代理服务器的socket上完成握手，握手成功后socket即为到目标地址的隧道
+    protocol : 代理协议，http/https 使用 CONNECT，socks4/socks5 使用对应的SOCKS协议
+    """
+    loop = asyncio.get_event_loop()
+    if protocol in ('http', 'https'):
+        await _http_connect(loop, sock, dest_host, dest_port, username, password)
+    elif protocol == 'socks5':
+        await _socks5_connect(loop, sock, dest_host, dest_port, username, password)
+    elif protocol == 'socks4':
+        await _socks4_connect(loop, sock, dest_host, dest_port, username)
+    else:
+        raise ProxyHandshakeError(f'不支持的代理协议: {protocol}')
+
+
+async def open_tunnel(protocol, ip, port, dest_host, dest_port, username=None, password=None):
+    """
+    连接到代理服务器并建立到目标地址的隧道，超时由调用方通过asyncio.wait_for控制
+    返回 : 已完成握手的非阻塞socket
+    """
+    sock = await open_socket(ip, port)
+    try:
+        await handshake(sock, protocol, dest_host, dest_port, username, password)
+    except BaseException:
+        sock.close()
+        raise
+    return sock